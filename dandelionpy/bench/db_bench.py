@@ -0,0 +1,83 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Benchmark of the content data base backends on synchronization workloads.
+
+Fills a SQLite and an in-memory data base with the same N messages (default 
+10000) in batches, as received from remote nodes, and times the queries a 
+server transaction makes for a remote node: the message ids since a time 
+cookie, the missing message lookup and the message fetch.
+
+Run from the dandelionpy directory: python bench/db_bench.py [N]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dandelion.database import SQLiteContentDB
+from dandelion.memorydb import MemoryContentDB
+from dandelion.message import Message
+
+_BATCH_SIZE = 100
+
+def _report(backend, name, count, seconds):
+    rate = count / seconds if seconds > 0 else float('inf')
+    print('{0:<10}{1:<24}{2:>10.3f} s {3:>12.0f} items/s'.format(backend, name, seconds, rate))
+
+def _timed(backend, name, count, fn):
+    t1 = time.time()
+    result = fn()
+    t2 = time.time()
+    _report(backend, name, count, t2 - t1)
+    return result
+
+def _sync_workload(backend, db, msgs):
+    """Time a node receiving the messages and serving them to a remote node"""
+
+    batches = [msgs[i:i + _BATCH_SIZE] for i in range(0, len(msgs), _BATCH_SIZE)]
+    half = len(batches) // 2
+
+    def add(batches):
+        cookies = [db.add_messages(batch) for batch in batches]
+        return cookies[-1]
+
+    tc = _timed(backend, 'add_messages', half * _BATCH_SIZE, lambda: add(batches[:half]))
+    _timed(backend, 'add_messages (more)', len(msgs) - half * _BATCH_SIZE, lambda: add(batches[half:]))
+
+    _, msgids = _timed(backend, 'get_message_ids', len(msgs), db.get_message_ids)
+    _, new_ids = _timed(backend, 'get_message_ids (tc)', len(msgs) // 2, lambda: db.get_message_ids(tc))
+    _timed(backend, 'missing_messages', len(msgids), lambda: db.missing_messages(msgids))
+    _timed(backend, 'get_messages (ids)', len(new_ids), lambda: db.get_messages(new_ids))
+    _timed(backend, 'get_messages (tc)', len(new_ids), lambda: db.get_messages(time_cookie=tc))
+    _timed(backend, 'add_messages (known)', len(msgs), lambda: add(batches))
+
+def run(count=10000):
+    msgs = [Message('Message {0}'.format(i), timestamp=i) for i in range(count)]
+    for m in msgs:
+        m.id # Hash up front, not in the first run
+
+    _sync_workload('sqlite', SQLiteContentDB(tempfile.NamedTemporaryFile().name), msgs)
+    _sync_workload('memory', MemoryContentDB(), msgs)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
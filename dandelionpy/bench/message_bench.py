@@ -0,0 +1,69 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Memory benchmark for resident messages.
+
+Keeps N messages (default 1M) alive, built the way the data base read path 
+builds them (dandelion.message.restore from stored columns), and reports 
+the memory used per message. A plain object with a per instance dict is 
+measured for reference.
+
+Run from the dandelionpy directory: python bench/message_bench.py [N]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dandelion.message
+
+class _DictMessage:
+    """A message with a per instance dict, laid out like the unslotted Message."""
+
+    def __init__(self, msgid, text, timestamp, receiver_fp, sender_fp, signature):
+        self._id = msgid
+        self._text = text
+        self._timestamp = timestamp
+        self._receiver_fp = receiver_fp
+        self._sender_fp = sender_fp
+        self._signature = signature
+
+def _measure(name, factory, rows):
+    tracemalloc.start()
+    t1 = time.time()
+    msgs = [factory(*row) for row in rows]
+    t2 = time.time()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{0:<12}{1:>10} msgs {2:>8.1f} MiB {3:>7.1f} B/msg {4:>7.2f} s'.format(
+          name, len(msgs), size / 2 ** 20, size / len(msgs), t2 - t1))
+
+def run(count=1000000):
+    # The field values are shared so only the message objects are measured
+    rows = [(i.to_bytes(12, 'big'), 'A message', 1337, None, None, None) for i in range(count)]
+
+    _measure('slotted', dandelion.message.restore, rows)
+    _measure('dict', _DictMessage, rows)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
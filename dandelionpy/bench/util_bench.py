@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Benchmark of the integer and Base64 codecs in dandelion.util.
+
+Prints the per-call cost of the codecs for 64-bit values (time stamps) and 
+2048-bit values (key components). The hex string based codecs that were 
+used before are included for reference.
+
+Run from the dandelionpy directory: python bench/util_bench.py
+"""
+
+import base64
+import binascii
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dandelion.util import encode_int, decode_int, encode_b64_int, decode_b64_int, \
+    encode_int_list, decode_b64_int_list
+
+def _hex_encode_int(x):
+    hstr = '{0:X}'.format(x)
+    if len(hstr) % 2 != 0:
+        hstr = ''.join(['0', hstr])
+    return binascii.a2b_hex(hstr.encode())
+
+def _hex_decode_int(bstr):
+    return int(binascii.b2a_hex(bstr), 16)
+
+def _hex_encode_b64_int(x):
+    return base64.b64encode(_hex_encode_int(x))
+
+def _hex_decode_b64_int(bstr):
+    return _hex_decode_int(base64.b64decode(bstr))
+
+def _per_call_ns(func, args, number):
+    """Best of three runs, in ns per call"""
+    t = min(timeit.repeat(lambda: func(*args), number=number, repeat=3))
+    return t / number * 1e9
+
+def run(number=200000):
+    for bits in (64, 2048):
+        x = random.getrandbits(bits) | (1 << (bits - 1))
+        b = encode_int(x)
+        b64 = encode_b64_int(x)
+        xs = [random.getrandbits(bits) for _ in range(100)]
+        b64s = [encode_b64_int(v) for v in xs]
+
+        print('{0}-bit values'.format(bits))
+        for name, func, args in [('encode_int', encode_int, (x,)),
+                                 ('encode_int (hex)', _hex_encode_int, (x,)),
+                                 ('decode_int', decode_int, (b,)),
+                                 ('decode_int (hex)', _hex_decode_int, (b,)),
+                                 ('encode_b64_int', encode_b64_int, (x,)),
+                                 ('encode_b64_int (hex)', _hex_encode_b64_int, (x,)),
+                                 ('decode_b64_int', decode_b64_int, (b64,)),
+                                 ('decode_b64_int (hex)', _hex_decode_b64_int, (b64,))]:
+            print('  {0:<24}{1:>10.1f} ns/call'.format(name, _per_call_ns(func, args, number)))
+
+        for name, func, args in [('encode_int_list', encode_int_list, (xs,)),
+                                 ('decode_b64_int_list', decode_b64_int_list, (b64s,))]:
+            ns = _per_call_ns(func, args, number // 100) / len(xs)
+            print('  {0:<24}{1:>10.1f} ns/item'.format(name, ns))
+
+if __name__ == '__main__':
+    run()
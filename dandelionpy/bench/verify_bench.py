@@ -0,0 +1,74 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Throughput benchmark for the message signature verification stage.
+
+Verifies N signed messages (default 20000) with a cold cache, first in the 
+calling process and then with a pool of worker processes, and reports 
+verifications/sec in total and per core. A second pass over the same 
+messages shows the cost of a cache hit.
+
+Note: Identity.verify is still a stub, so until real DSA verification lands 
+this measures the overhead of the pipeline itself.
+
+Run from the dandelionpy directory: python bench/verify_bench.py [N]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dandelion.database import SQLiteContentDB
+from dandelion.verifier import MessageVerifier
+import dandelion.identity
+import dandelion.message
+
+def _report(name, cores, count, seconds):
+    rate = count / seconds if seconds > 0 else float('inf')
+    print('{0:<20}{1:>3} cores {2:>12.0f} verifications/s {3:>12.0f} /s/core'.format(name, cores, rate, rate / cores))
+
+def run(count=20000):
+    db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+    senders = [dandelion.identity.generate() for _ in range(10)]
+    db.add_identities(senders)
+    msgs = [dandelion.message.create(str(i), sender=senders[i % len(senders)]) for i in range(count)]
+
+    for workers in sorted({1, os.cpu_count() or 1}):
+        verifier = MessageVerifier(db, workers=workers)
+        if workers > 1:
+            verifier.verify(msgs[:4 * MessageVerifier._BATCH_SIZE]) # Warm up the pool
+            verifier._cache.clear()
+
+        t1 = time.time()
+        verifier.verify(msgs)
+        t2 = time.time()
+        _report('cold cache', workers, count, t2 - t1)
+
+        t1 = time.time()
+        verifier.verify(msgs)
+        t2 = time.time()
+        _report('warm cache', workers, count, t2 - t1)
+
+        verifier.close()
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+import dandelion.protocol
+from dandelion.protocol import ProtocolParseError, ProtocolVersionError
+from dandelion.service import Service
+
+class Announcer(Service):
+    """The announcer tells the other nodes when the data base has new content.
+    
+    It broadcasts a small UDP datagram (see dandelion.protocol.create_announcement) 
+    with the data base id and current time cookie, periodically and as soon as 
+    content has been added. The announcements of other nodes are passed on to 
+    the discoverer, so that the synchronizer can pick the nodes with news first.
+    """
+
+    _POLL_SEC = 0.1 # How often the work loop checks for a stop request
+    _MAX_DATAGRAM = 1024
+
+    def __init__(self, config, server_config, db, discoverer):
+        self._config = config
+        self._server_config = server_config
+        self._db = db
+        self._discoverer = discoverer
+        self._running = False
+        self._stop_requested = True
+        self._thread = None
+        self._sock = None
+        self._lock = threading.Lock()
+
+        self._db.add_event_listener(self._content_added)
+
+    def start(self):
+        """Start the service. Block until the service is running."""
+
+        if self._running:
+            return # Starting twice is a nop
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'): # Other nodes on this host
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(('', self._config.port))
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+
+        with self._lock:
+            self._sock = sock
+
+        self._stop_requested = False
+        self._thread = threading.Thread(target=self._work_loop)
+        self._thread.start()
+        self._running = True
+
+    def stop(self):
+        """Stop the service. Block until the service is stopped."""
+
+        if not self._running:
+            return # Stopping twice is a nop
+
+        self._stop_requested = True
+        if self._thread is not None:
+            self._thread.join(1)
+            if self._thread.is_alive():
+                raise Exception # Timeout
+
+        with self._lock:
+            self._sock.close()
+            self._sock = None
+
+        self._running = False
+
+    @property
+    def running(self):
+        """Returns True if the service is running, False otherwise"""
+        return self._running
+
+    def announce(self, time_cookie=None):
+        """Broadcast the current time cookie (or the specified one) now."""
+
+        if time_cookie is None:
+            time_cookie = self._db.get_last_time_cookie()
+
+        datagram = dandelion.protocol.create_announcement(self._db.id, time_cookie, self._server_config.port).encode()
+
+        with self._lock:
+            if self._sock is None:
+                return
+            try:
+                self._sock.sendto(datagram, (self._config.address, self._config.port))
+            except OSError:
+                pass # No route (yet), the next announcement will be retried
+
+    def _content_added(self, type, content, time_cookie):
+        """Data base event listener. Announce the new content right away."""
+        if self._running:
+            self.announce(time_cookie)
+
+    def _work_loop(self):
+
+        selector = selectors.DefaultSelector()
+        selector.register(self._sock, selectors.EVENT_READ)
+
+        next_announcement = time.monotonic()
+        try:
+            while not self._stop_requested:
+                if time.monotonic() >= next_announcement:
+                    self.announce()
+                    next_announcement = time.monotonic() + self._config.interval_sec
+
+                if selector.select(min(Announcer._POLL_SEC, max(0, next_announcement - time.monotonic()))):
+                    self._receive()
+        finally:
+            selector.close()
+
+    def _receive(self):
+        """Pass the pending announcements of other nodes to the discoverer"""
+
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(Announcer._MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            try:
+                dbid, time_cookie, port = dandelion.protocol.parse_announcement(data.decode())
+            except (UnicodeDecodeError, ProtocolParseError, ProtocolVersionError):
+                continue # Not an announcement we understand
+
+            if dbid != self._db.id: # Our own are looped back
+                self._discoverer.announced(addr[0], port, dbid, time_cookie)
@@ -17,29 +17,86 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
+_IMPORT_START = time.perf_counter()
+
 from dandelion.config import ConfigManager
 from dandelion.network import Server
 from dandelion.synchronizer import Synchronizer
 from dandelion.discoverer import Discoverer
+from dandelion.announcer import Announcer
+from dandelion.retention import Pruner
 from dandelion.ui import UI
 #from dandelion.gui.gui import GUI
+import contextlib
 import sys
 
+_IMPORT_SEC = time.perf_counter() - _IMPORT_START
+
+class StartupProfile:
+    """Time the phases of the startup (when enabled)"""
+
+    def __init__(self, enabled=False):
+        self._enabled = enabled
+        self._phases = [('imports', _IMPORT_SEC)]
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context timing a named phase"""
+        start = time.perf_counter()
+        yield
+        self._phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        """Print the time spent in each phase"""
+        if not self._enabled:
+            return
+
+        print(' --- STARTUP PROFILE --- ')
+        for name, sec in self._phases:
+            print('{0:<20} {1:8.1f} ms'.format(name, sec * 1000))
+        print('{0:<20} {1:8.1f} ms'.format('total', sum(sec for _, sec in self._phases) * 1000))
+
 class DandelionApp:
+    """The services and the UI of a node.
+    
+    The content data base is opened when the app is created, since every 
+    service is handed it. Only the discovery backend (pybonjour) and the 
+    private identity are set up later, on first use.
+    """
 
-    def __init__(self, config_file=None):
-        self._config_manager = ConfigManager(config_file)
+    def __init__(self, config_file=None, profile=None):
+        self._profile = StartupProfile() if profile is None else profile
+
+        with self._profile.phase('config'):
+            self._config_manager = ConfigManager(config_file)
+
+        """Opened here (rather than by the first service using it) to time it on its own"""
+        with self._profile.phase('content db'):
+            self._config_manager.content_db
 
         self._server = Server(self._config_manager.server_config,
-                              self._config_manager.content_db,
-                              self._config_manager.identity)
+                              self._config_manager.content_db)
 
         self._discoverer = Discoverer(self._config_manager.discoverer_config, server_config=self._config_manager.server_config)
 
+        self._announcer = Announcer(self._config_manager.announcer_config,
+                                    self._config_manager.server_config,
+                                    self._config_manager.content_db,
+                                    self._discoverer)
+
         self._synchronizer = Synchronizer(self._discoverer,
                                           self._config_manager.synchronizer_config,
                                           self._config_manager.content_db)
 
+        self._pruner = Pruner(self._config_manager.content_db,
+                              self._config_manager.retention_config.policy,
+                              self._config_manager.retention_config.interval_sec)
+
     def run_ui(self):
 
         self._ui = UI(self._config_manager.ui_config,
@@ -60,20 +117,39 @@ class DandelionApp:
                         self._synchronizer)
 
     def exit(self):
+        self._pruner.stop()
         self._synchronizer.stop()
+        self._announcer.stop()
         self._discoverer.stop()
         self._server.stop()
         self._config_manager.write_file()
 
 def run():
-    app = DandelionApp('dandelion.conf')
+    profile = StartupProfile("--profile-startup" in sys.argv)
+    app = DandelionApp('dandelion.conf', profile)
 
     if "--no-server" not in sys.argv:
-        app._server.start()
+        with profile.phase('server'):
+            app._server.start()
+
+    if not app._pruner.policy.unlimited:
+        app._pruner.start()
 
     if "--no-discovery" not in sys.argv:
-        app._discoverer.start()
-        app._synchronizer.start()
+        with profile.phase('discovery'):
+            app._discoverer.start()
+            if app._config_manager.announcer_config.enabled:
+                app._announcer.start()
+            app._synchronizer.start()
+
+    with profile.phase('identity'):
+        app._config_manager.identity # Generated here, after the services are up, if there is none
+
+    if "--no-gui" not in sys.argv:
+        with profile.phase('gui import'):
+            import dandelion.gui.gui
+
+    profile.report()
 
     if "--no-gui" in sys.argv:
         app.run_ui()
@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import math
+
+class BloomFilter:
+    """A Bloom filter over bytes keys.
+    
+    Answers "definitely not added" or "possibly added". Keys can't be removed.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Create a filter sized for capacity keys at the specified false positive rate."""
+
+        if not isinstance(capacity, int) or not isinstance(error_rate, float):
+            raise TypeError
+
+        if capacity <= 0 or not 0.0 < error_rate < 1.0:
+            raise ValueError
+
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._nbits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._nhashes = max(1, int(round(self._nbits / capacity * math.log(2))))
+        self._bits = bytearray((self._nbits + 7) // 8)
+        self._count = 0
+
+    @property
+    def capacity(self):
+        """The number of keys the filter was sized for"""
+        return self._capacity
+
+    @property
+    def count(self):
+        """The (approximate) number of distinct keys added"""
+        return self._count
+
+    @property
+    def memory_bytes(self):
+        """The size of the bit array in bytes"""
+        return len(self._bits)
+
+    @property
+    def false_positive_rate(self):
+        """The estimated false positive rate with the current number of keys"""
+        return (1.0 - math.exp(-self._nhashes * self._count / self._nbits)) ** self._nhashes
+
+    @property
+    def stats(self):
+        """A dict with the filter size and estimated false positive rate"""
+        return {'count' : self._count,
+                'capacity' : self._capacity,
+                'bits' : self._nbits,
+                'hashes' : self._nhashes,
+                'memory_bytes' : self.memory_bytes,
+                'false_positive_rate' : self.false_positive_rate}
+
+    def add(self, key):
+        """Add a key (bytes). Return True if the key was not in the filter before."""
+
+        new = False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not self._bits[pos >> 3] & mask:
+                self._bits[pos >> 3] |= mask
+                new = True
+
+        if new:
+            self._count += 1
+
+        return new
+
+    def clear(self):
+        """Remove all keys."""
+        self._bits = bytearray(len(self._bits))
+        self._count = 0
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def _positions(self, key):
+        """The bit positions for the key (double hashing)"""
+
+        if not isinstance(key, (bytes, bytearray)):
+            raise TypeError
+
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._nbits for i in range(self._nhashes)]
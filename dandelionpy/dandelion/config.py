@@ -17,7 +17,8 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from dandelion.database import ContentDB
+from dandelion.database import SQLiteContentDB
+from dandelion.retention import RetentionPolicy
 import configparser
 import dandelion.identity
 from dandelion.util import decode_b64_bytes, encode_b64_bytes
@@ -45,10 +46,30 @@ class ServerConfig(Config):
     _DB_FILE_NAME = "db_file"
     _DB_FILE_DEFAULT = "dandelion.sqlite"
 
+    _DB_SYNCHRONOUS_NAME = "db_synchronous"
+    _DB_SYNCHRONOUS_DEFAULT = "NORMAL"
+
+    _DB_CACHE_SIZE_NAME = "db_cache_size"
+    _DB_CACHE_SIZE_DEFAULT = -8192 # KiB
+
+    _DB_MMAP_SIZE_NAME = "db_mmap_size"
+    _DB_MMAP_SIZE_DEFAULT = 0
+
+    _DB_TEMP_STORE_NAME = "db_temp_store"
+    _DB_TEMP_STORE_DEFAULT = "MEMORY"
+
+    _DB_PARTITION_SEC_NAME = "db_partition_sec"
+    _DB_PARTITION_SEC_DEFAULT = 0 # No partitions
+
     def __init__(self):
         self._port = ServerConfig._PORT_DEFAULT
         self._ip = ServerConfig._IP_DEFAULT
         self._db_file = ServerConfig._DB_FILE_DEFAULT
+        self._db_synchronous = ServerConfig._DB_SYNCHRONOUS_DEFAULT
+        self._db_cache_size = ServerConfig._DB_CACHE_SIZE_DEFAULT
+        self._db_mmap_size = ServerConfig._DB_MMAP_SIZE_DEFAULT
+        self._db_temp_store = ServerConfig._DB_TEMP_STORE_DEFAULT
+        self._db_partition_sec = ServerConfig._DB_PARTITION_SEC_DEFAULT
 
     @property
     def port(self):
@@ -70,6 +91,35 @@ class ServerConfig(Config):
     def db_file(self):
         return self._db_file
 
+    @property
+    def db_synchronous(self):
+        return self._db_synchronous
+
+    @property
+    def db_cache_size(self):
+        return self._db_cache_size
+
+    @property
+    def db_mmap_size(self):
+        return self._db_mmap_size
+
+    @property
+    def db_temp_store(self):
+        return self._db_temp_store
+
+    @property
+    def db_partition_sec(self):
+        """Length of the message partition time windows (None if not partitioned)"""
+        return self._db_partition_sec if self._db_partition_sec > 0 else None
+
+    @property
+    def db_pragmas(self):
+        """The data base connection pragmas (dict)"""
+        return {'synchronous' : self._db_synchronous,
+                'cache_size' : self._db_cache_size,
+                'mmap_size' : self._db_mmap_size,
+                'temp_store' : self._db_temp_store}
+
     def load(self, confparser):
         if not confparser.has_section(ServerConfig._SECTION_NAME):
             confparser.add_section(ServerConfig._SECTION_NAME)
@@ -84,27 +134,158 @@ class ServerConfig(Config):
         if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_FILE_NAME):
             self._db_file = confparser.get(ServerConfig._SECTION_NAME, ServerConfig._DB_FILE_NAME)
 
+        if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_SYNCHRONOUS_NAME):
+            self._db_synchronous = confparser.get(ServerConfig._SECTION_NAME, ServerConfig._DB_SYNCHRONOUS_NAME)
+
+        if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_CACHE_SIZE_NAME):
+            self._db_cache_size = confparser.getint(ServerConfig._SECTION_NAME, ServerConfig._DB_CACHE_SIZE_NAME)
+
+        if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_MMAP_SIZE_NAME):
+            self._db_mmap_size = confparser.getint(ServerConfig._SECTION_NAME, ServerConfig._DB_MMAP_SIZE_NAME)
+
+        if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_TEMP_STORE_NAME):
+            self._db_temp_store = confparser.get(ServerConfig._SECTION_NAME, ServerConfig._DB_TEMP_STORE_NAME)
+
+        if confparser.has_option(ServerConfig._SECTION_NAME, ServerConfig._DB_PARTITION_SEC_NAME):
+            self._db_partition_sec = confparser.getint(ServerConfig._SECTION_NAME, ServerConfig._DB_PARTITION_SEC_NAME)
+
     def store(self, confparser):
         confparser.add_section(ServerConfig._SECTION_NAME)
         confparser.set(ServerConfig._SECTION_NAME, ServerConfig._PORT_NAME, str(self._port))
         confparser.set(ServerConfig._SECTION_NAME, ServerConfig._IP_NAME, self._ip)
         confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_FILE_NAME, self._db_file)
+        confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_SYNCHRONOUS_NAME, self._db_synchronous)
+        confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_CACHE_SIZE_NAME, str(self._db_cache_size))
+        confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_MMAP_SIZE_NAME, str(self._db_mmap_size))
+        confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_TEMP_STORE_NAME, self._db_temp_store)
+        confparser.set(ServerConfig._SECTION_NAME, ServerConfig._DB_PARTITION_SEC_NAME, str(self._db_partition_sec))
 
 
 class SynchronizerConfig(Config):
 
     _SECTION_NAME = 'synchronizer'
 
+    _BOOTSTRAP_SNAPSHOT_NAME = 'bootstrap_snapshot'
+    _BOOTSTRAP_SNAPSHOT_DEFAULT = False
+
+    _KEEP_ALIVE_NAME = 'keep_alive'
+    _KEEP_ALIVE_DEFAULT = True
+
+    _IDLE_TIMEOUT_NAME = 'idle_timeout_sec'
+    _IDLE_TIMEOUT_DEFAULT = 60
+
+    _HEARTBEAT_NAME = 'heartbeat_sec'
+    _HEARTBEAT_DEFAULT = 5 # Must be shorter than the server read timeout (10 s)
+
     def __init__(self):
-        pass
+        self._bootstrap_snapshot = SynchronizerConfig._BOOTSTRAP_SNAPSHOT_DEFAULT
+        self._keep_alive = SynchronizerConfig._KEEP_ALIVE_DEFAULT
+        self._idle_timeout_sec = SynchronizerConfig._IDLE_TIMEOUT_DEFAULT
+        self._heartbeat_sec = SynchronizerConfig._HEARTBEAT_DEFAULT
+
+    @property
+    def bootstrap_snapshot(self):
+        """True if an empty data base should start by importing a snapshot from a peer"""
+        return self._bootstrap_snapshot
+
+    @property
+    def keep_alive(self):
+        """True if connections should be kept open for reuse by later synchronizations"""
+        return self._keep_alive
+
+    @property
+    def idle_timeout_sec(self):
+        """Time an unused connection is kept open"""
+        return self._idle_timeout_sec
+
+    @property
+    def heartbeat_sec(self):
+        """Time between the heartbeats on idle connections"""
+        return self._heartbeat_sec
 
     def load(self, confparser):
         if not confparser.has_section(SynchronizerConfig._SECTION_NAME):
-            raise ConfigException
+            return
+
+        if confparser.has_option(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._BOOTSTRAP_SNAPSHOT_NAME):
+            self._bootstrap_snapshot = confparser.getboolean(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._BOOTSTRAP_SNAPSHOT_NAME)
 
+        if confparser.has_option(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._KEEP_ALIVE_NAME):
+            self._keep_alive = confparser.getboolean(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._KEEP_ALIVE_NAME)
+
+        if confparser.has_option(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._IDLE_TIMEOUT_NAME):
+            self._idle_timeout_sec = confparser.getint(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._IDLE_TIMEOUT_NAME)
+
+        if confparser.has_option(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._HEARTBEAT_NAME):
+            self._heartbeat_sec = confparser.getint(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._HEARTBEAT_NAME)
 
     def store(self, confparser):
         confparser.add_section(SynchronizerConfig._SECTION_NAME)
+        confparser.set(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._BOOTSTRAP_SNAPSHOT_NAME, str(self._bootstrap_snapshot))
+        confparser.set(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._KEEP_ALIVE_NAME, str(self._keep_alive))
+        confparser.set(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._IDLE_TIMEOUT_NAME, str(self._idle_timeout_sec))
+        confparser.set(SynchronizerConfig._SECTION_NAME, SynchronizerConfig._HEARTBEAT_NAME, str(self._heartbeat_sec))
+
+class RetentionConfig(Config):
+
+    _SECTION_NAME = 'retention'
+
+    _MAX_AGE_NAME = 'max_age_sec'
+    _MAX_MESSAGES_NAME = 'max_messages'
+    _MAX_DB_BYTES_NAME = 'max_db_bytes'
+
+    _KEEP_OWN_MESSAGES_NAME = 'keep_own_messages'
+    _KEEP_OWN_MESSAGES_DEFAULT = True
+
+    _INTERVAL_NAME = 'interval_sec'
+    _INTERVAL_DEFAULT = 60
+
+    def __init__(self):
+        self._max_age_sec = None # Unlimited
+        self._max_messages = None
+        self._max_db_bytes = None
+        self._keep_own_messages = RetentionConfig._KEEP_OWN_MESSAGES_DEFAULT
+        self._interval_sec = RetentionConfig._INTERVAL_DEFAULT
+
+    @property
+    def interval_sec(self):
+        return self._interval_sec
+
+    @property
+    def policy(self):
+        return RetentionPolicy(self._max_age_sec, self._max_messages, self._max_db_bytes, self._keep_own_messages)
+
+    def load(self, confparser):
+        if not confparser.has_section(RetentionConfig._SECTION_NAME):
+            return
+
+        if confparser.has_option(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_AGE_NAME):
+            self._max_age_sec = confparser.getint(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_AGE_NAME)
+
+        if confparser.has_option(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_MESSAGES_NAME):
+            self._max_messages = confparser.getint(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_MESSAGES_NAME)
+
+        if confparser.has_option(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_DB_BYTES_NAME):
+            self._max_db_bytes = confparser.getint(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_DB_BYTES_NAME)
+
+        if confparser.has_option(RetentionConfig._SECTION_NAME, RetentionConfig._KEEP_OWN_MESSAGES_NAME):
+            self._keep_own_messages = confparser.getboolean(RetentionConfig._SECTION_NAME, RetentionConfig._KEEP_OWN_MESSAGES_NAME)
+
+        if confparser.has_option(RetentionConfig._SECTION_NAME, RetentionConfig._INTERVAL_NAME):
+            self._interval_sec = confparser.getint(RetentionConfig._SECTION_NAME, RetentionConfig._INTERVAL_NAME)
+
+    def store(self, confparser):
+        confparser.add_section(RetentionConfig._SECTION_NAME)
+
+        if self._max_age_sec is not None:
+            confparser.set(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_AGE_NAME, str(self._max_age_sec))
+        if self._max_messages is not None:
+            confparser.set(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_MESSAGES_NAME, str(self._max_messages))
+        if self._max_db_bytes is not None:
+            confparser.set(RetentionConfig._SECTION_NAME, RetentionConfig._MAX_DB_BYTES_NAME, str(self._max_db_bytes))
+
+        confparser.set(RetentionConfig._SECTION_NAME, RetentionConfig._KEEP_OWN_MESSAGES_NAME, str(self._keep_own_messages))
+        confparser.set(RetentionConfig._SECTION_NAME, RetentionConfig._INTERVAL_NAME, str(self._interval_sec))
 
 class DiscovererConfig(Config):
 
@@ -112,14 +293,23 @@ class DiscovererConfig(Config):
     
     _EXTRA_SERVERS = 'extra_servers'
 
+    _BACKEND_NAME = 'backend'
+    _BACKEND_DEFAULT = 'mdns'
+    _BACKENDS = ('mdns', 'bonjour')
+
     def __init__(self):
         self._extra_servers = []
-        pass
+        self._backend = DiscovererConfig._BACKEND_DEFAULT
 
     @property
     def extra_servers(self):
         return self._extra_servers
 
+    @property
+    def backend(self):
+        """The discovery backend, 'mdns' (pure Python) or 'bonjour' (needs the native dns_sd library)"""
+        return self._backend
+
     _ip_port_pattern = re.compile(r'^(?P<ip>\d+\.\d+\.\d+\.\d+):(?P<port>\d+)$')
     
     def _parse_ip_port(self, s):
@@ -139,11 +329,90 @@ class DiscovererConfig(Config):
         if confparser.has_option(DiscovererConfig._SECTION_NAME, DiscovererConfig._EXTRA_SERVERS):
             self._extra_servers = [self._parse_ip_port(s) for s in confparser.get(DiscovererConfig._SECTION_NAME, DiscovererConfig._EXTRA_SERVERS).split(",")]
 
+        if confparser.has_option(DiscovererConfig._SECTION_NAME, DiscovererConfig._BACKEND_NAME):
+            backend = confparser.get(DiscovererConfig._SECTION_NAME, DiscovererConfig._BACKEND_NAME)
+            if backend not in DiscovererConfig._BACKENDS:
+                raise ConfigException
+            self._backend = backend
 
     def store(self, confparser):
         confparser.add_section(DiscovererConfig._SECTION_NAME)
         if self._extra_servers:
             confparser.set(DiscovererConfig._SECTION_NAME, DiscovererConfig._EXTRA_SERVERS, ",".join([self._write_ip_port(server) for server in self._extra_servers]))
+        confparser.set(DiscovererConfig._SECTION_NAME, DiscovererConfig._BACKEND_NAME, self._backend)
+
+class AnnouncerConfig(Config):
+
+    _SECTION_NAME = 'announcer'
+
+    _ENABLED_NAME = 'enabled'
+    _ENABLED_DEFAULT = True
+
+    _PORT_NAME = 'port'
+    _PORT_DEFAULT = 1338
+
+    _ADDRESS_NAME = 'address'
+    _ADDRESS_DEFAULT = '255.255.255.255'
+
+    _INTERVAL_NAME = 'interval_sec'
+    _INTERVAL_DEFAULT = 30
+
+    def __init__(self):
+        self._enabled = AnnouncerConfig._ENABLED_DEFAULT
+        self._port = AnnouncerConfig._PORT_DEFAULT
+        self._address = AnnouncerConfig._ADDRESS_DEFAULT
+        self._interval_sec = AnnouncerConfig._INTERVAL_DEFAULT
+
+    @property
+    def enabled(self):
+        """True if the node should announce new content (and listen to the announcements of others)"""
+        return self._enabled
+
+    @property
+    def port(self):
+        """The UDP port of the announcements"""
+        return self._port
+
+    @port.setter
+    def port(self, value):
+        self._port = value
+
+    @property
+    def address(self):
+        """The (broadcast) address the announcements are sent to"""
+        return self._address
+
+    @address.setter
+    def address(self, value):
+        self._address = value
+
+    @property
+    def interval_sec(self):
+        """Time between the periodic announcements"""
+        return self._interval_sec
+
+    def load(self, confparser):
+        if not confparser.has_section(AnnouncerConfig._SECTION_NAME):
+            return
+
+        if confparser.has_option(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ENABLED_NAME):
+            self._enabled = confparser.getboolean(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ENABLED_NAME)
+
+        if confparser.has_option(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._PORT_NAME):
+            self._port = confparser.getint(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._PORT_NAME)
+
+        if confparser.has_option(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ADDRESS_NAME):
+            self._address = confparser.get(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ADDRESS_NAME)
+
+        if confparser.has_option(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._INTERVAL_NAME):
+            self._interval_sec = confparser.getint(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._INTERVAL_NAME)
+
+    def store(self, confparser):
+        confparser.add_section(AnnouncerConfig._SECTION_NAME)
+        confparser.set(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ENABLED_NAME, str(self._enabled))
+        confparser.set(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._PORT_NAME, str(self._port))
+        confparser.set(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._ADDRESS_NAME, self._address)
+        confparser.set(AnnouncerConfig._SECTION_NAME, AnnouncerConfig._INTERVAL_NAME, str(self._interval_sec))
 
 class UiConfig(Config):
 
@@ -329,7 +598,8 @@ class IdentityConfig(Config):
 
     def store(self, confparser):
         confparser.add_section(IdentityConfig._SECTION_NAME)
-        confparser.set(IdentityConfig._SECTION_NAME, IdentityConfig._MY_ID_NAME, self._my_id)
+        if self._my_id is not None:
+            confparser.set(IdentityConfig._SECTION_NAME, IdentityConfig._MY_ID_NAME, self._my_id)
 
 class ConfigManager:
 
@@ -338,28 +608,41 @@ class ConfigManager:
         self._server_config = ServerConfig()
         self._synchronizer_config = SynchronizerConfig()
         self._discoverer_config = DiscovererConfig()
+        self._announcer_config = AnnouncerConfig()
+        self._retention_config = RetentionConfig()
         self._id_manager_config = IdentityConfig()
         self._ui_config = UiConfig()
 
         self.read_file()
 
-        self._content_db = ContentDB(self._server_config.db_file)
+        self._content_db = None # Opened on first use
+        self._identity = None # Loaded (or generated) on first use
+
+    def _open_content_db(self):
+        self._content_db = SQLiteContentDB(self._server_config.db_file,
+                                     pragmas=self._server_config.db_pragmas,
+                                     partition_sec=self._server_config.db_partition_sec)
 
-        if self._id_manager_config.my_id is not None and not self._content_db.contains_identity(decode_b64_bytes(self._id_manager_config.my_id.encode())) :
+    def _load_identity(self):
+        """Get the configured private identity from the data base or generate a new one"""
+
+        content_db = self.content_db
+
+        if self._id_manager_config.my_id is not None and not content_db.contains_identity(decode_b64_bytes(self._id_manager_config.my_id.encode())) :
             print("WARNING! Bad or non existing ID requested in config. Requested:", self._id_manager_config.my_id)
             self._id_manager_config.my_id = None
 
         if self._id_manager_config.my_id is not None:
             fp = decode_b64_bytes(self._id_manager_config.my_id.encode())
             try:
-                self._identity = self._content_db.get_private_identity(fp)
+                self._identity = content_db.get_private_identity(fp)
                 print("My claimed ID:", self._id_manager_config.my_id)
                 return
             except ValueError:
                 pass
             
         self._identity = dandelion.identity.generate()
-        self._content_db.add_private_identity(self._identity)
+        content_db.add_private_identity(self._identity)
         id_str = encode_b64_bytes(self._identity.fingerprint).decode()
         self._id_manager_config.my_id = id_str
 
@@ -379,6 +662,14 @@ class ConfigManager:
     def discoverer_config(self):
         return self._discoverer_config
 
+    @property
+    def announcer_config(self):
+        return self._announcer_config
+
+    @property
+    def retention_config(self):
+        return self._retention_config
+
     @property
     def identity_manager_config(self):
         return self._id_manager_config
@@ -389,10 +680,14 @@ class ConfigManager:
 
     @property
     def content_db(self):
+        if self._content_db is None:
+            self._open_content_db()
         return self._content_db
 
     @property
     def identity(self):
+        if self._identity is None:
+            self._load_identity()
         return self._identity
 
     def write_file(self):
@@ -400,9 +695,12 @@ class ConfigManager:
         confparser = configparser.ConfigParser()
 
         self._server_config.store(confparser)
+        self._synchronizer_config.store(confparser)
         self._ui_config.store(confparser)
         self._id_manager_config.store(confparser)
         self._discoverer_config.store(confparser)
+        self._announcer_config.store(confparser)
+        self._retention_config.store(confparser)
 
         with open(self._cfg_file_name, 'w') as configfile:
             confparser.write(configfile)
@@ -413,7 +711,10 @@ class ConfigManager:
         confparser.read(self._cfg_file_name)
 
         self._server_config.load(confparser)
+        self._synchronizer_config.load(confparser)
         self._ui_config.load(confparser)
         self._id_manager_config.load(confparser)
         self._discoverer_config.load(confparser)
+        self._announcer_config.load(confparser)
 
+        self._retention_config.load(confparser)
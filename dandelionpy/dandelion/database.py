@@ -16,20 +16,605 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
+from concurrent.futures import Future
+from dandelion.bloomfilter import BloomFilter
 from dandelion.identity import Identity, PrivateIdentity, DSA_key, RSA_key, IdentityInfo
-from dandelion.message import Message
+from dandelion.message import Message, restore
+from dandelion.snapshot import SnapshotReader, SnapshotWriter
 from dandelion.util import encode_b64_bytes, decode_b64_bytes, encode_b64_int, \
-    decode_b64_int
+    decode_b64_int, decode_b64_int_list, LRUCache
+from dandelion.verifier import MessageVerifier
+import collections
+import contextlib
+import os
+import queue
 import random
+import re
 import sqlite3
+import threading
+import time
+import traceback
 import dandelion
 
 
 class ContentDBException(Exception):
     '''Exception from the operations on the ContentDB'''
 
+class _ContentFilter:
+    """A Bloom filter front for an id column in the data base.
+    
+    Keys are added after they have been committed to the data base. Removed keys 
+    stay in the filter until it is rebuilt from the data base, which happens when 
+    too many keys have been removed or when the filter is full.
+    """
+
+    _MIN_CAPACITY = 1024
+
+    def __init__(self, load_keys, keys):
+        """Create the filter from the keys (bytes) currently in the data base. 
+        
+        The load_keys function is used to read the keys again when rebuilding.
+        """
+
+        self._load_keys = load_keys
+        self._lock = threading.Lock()
+        with self._lock:
+            self._rebuild(keys)
+
+    def might_contain(self, key):
+        """Returns False if the key is definitely not in the data base"""
+        return key in self._filter
+
+    def added(self, keys):
+        """Record keys added to the data base"""
+
+        with self._lock:
+            for key in keys:
+                self._filter.add(key)
+
+            if self._filter.count > self._filter.capacity:
+                self._rebuild()
+
+    def removed(self, count=None):
+        """Record that count keys (all keys if None) were removed from the data base"""
+
+        with self._lock:
+            if count is None:
+                self._rebuild()
+                return
+
+            self._removed += count
+            if self._removed > self._filter.capacity // 2:
+                self._rebuild()
+
+    @property
+    def stats(self):
+        """The filter stats plus the number of removed keys still in the filter"""
+
+        with self._lock:
+            stats = self._filter.stats
+            stats['removed'] = self._removed
+            return stats
+
+    def _rebuild(self, keys=None):
+        """Rebuild the filter from the data base. Should only be executed inside the lock."""
+
+        if keys is None:
+            keys = self._load_keys()
+
+        bloom = BloomFilter(max(self._MIN_CAPACITY, 2 * len(keys)))
+        for key in keys:
+            bloom.add(key)
+
+        self._filter = bloom
+        self._removed = 0
+
+class _ContentWriter:
+    """A thread that adds content to the data base.
+    
+    Concurrent add requests are coalesced into one transaction (group commit) 
+    with one new time cookie. Each request gets a Future that resolves to the 
+    time cookie after the commit. The number of pending requests is bounded; 
+    submitting blocks while the queue is full.
+    
+    Other writes (updates and removals) are run by the same thread, each in a 
+    transaction of its own, so that only one connection ever writes.
+    
+    The thread is started on demand and exits when it has been idle for a while.
+    """
+
+    _MAX_BATCH = 64 # Requests per transaction
+    _IDLE_TIMEOUT_SEC = 5.0
+
+    def __init__(self, connect, insert_new_tc, get_last_time_cookie, max_pending=256, prepare=None):
+        """Connections are opened with connect(**kwargs) (sqlite3.connect arguments). 
+        
+        The prepare function is called with the connection before each transaction.
+        """
+
+        self._connect = connect
+        self._prepare = prepare
+        self._insert_new_tc = insert_new_tc
+        self._get_last_time_cookie = get_last_time_cookie
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._conn = None
+
+    def submit(self, sql_insert_statement, rows, on_commit=None):
+        """Queue rows for insertion with the sql statement (taking the time cookie id last).
+        
+        The statement can also be a function of the connection and the row, 
+        returning the statement to use for that row.
+        
+        The on_commit function is called in the writer thread after the rows have 
+        been committed, before the returned Future is resolved. It is called with 
+        the time cookie and the indices (list) of the rows that were inserted.
+        
+        Requests submitted from the writer thread itself (e.g. by an on_commit 
+        function) are written right away, since waiting for them would deadlock.
+        """
+
+        future = Future()
+
+        if threading.current_thread() is self._thread:
+            self._write_batch(self._conn, [(sql_insert_statement, rows, on_commit, future)])
+            return future
+
+        self._put((sql_insert_statement, rows, on_commit, future))
+        return future
+
+    def execute(self, write):
+        """Run write(cursor) in a transaction in the writer thread. 
+        
+        Return a Future that resolves to the return value of write. The 
+        transaction is rolled back if write raises.
+        """
+
+        future = Future()
+
+        if threading.current_thread() is self._thread:
+            self._execute(self._conn, (write, None, None, future))
+            return future
+
+        self._put((write, None, None, future))
+        return future
+
+    def close(self):
+        """Write all pending requests and stop the thread."""
+
+        with self._lock:
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+
+        if thread is not None:
+            thread.join()
+
+    def _put(self, request):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work_loop, daemon=True)
+                self._thread.start()
+            self._queue.put(request)
+
+    def _work_loop(self):
+        conn = self._conn = self._connect(isolation_level=None)
+        pending = []
+        try:
+            while True:
+                if pending:
+                    request = pending.pop()
+                else:
+                    try:
+                        request = self._queue.get(timeout=self._IDLE_TIMEOUT_SEC)
+                    except queue.Empty:
+                        with self._lock:
+                            if self._queue.empty():
+                                self._thread = None
+                                return
+                        continue
+
+                if request is None: # Closed
+                    with self._lock:
+                        self._thread = None
+                    return
+
+                if request[1] is None: # Not an insert (see execute)
+                    self._execute(conn, request)
+                    continue
+
+                batch = [request]
+                while len(batch) < self._MAX_BATCH:
+                    try:
+                        request = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if request is None or request[1] is None: # Handle after this batch
+                        pending.append(request)
+                        break
+                    batch.append(request)
+
+                self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _execute(self, conn, request):
+        """Run a write function in a transaction of its own"""
+
+        write, _, _, future = request
+        if not future.set_running_or_notify_cancel():
+            return
+
+        c = conn.cursor()
+        try:
+            if self._prepare is not None:
+                self._prepare(conn)
+
+            c.execute("BEGIN IMMEDIATE")
+            result = write(c)
+            c.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _write_batch(self, conn, batch):
+        """Insert all requests in one transaction. Failing requests are rolled back individually."""
+
+        c = conn.cursor()
+        committed = []
+
+        try:
+            if self._prepare is not None:
+                self._prepare(conn)
+
+            c.execute("BEGIN IMMEDIATE")
+            tcid = self._insert_new_tc(c)
+            changes = 0
+
+            for sql_insert_statement, rows, on_commit, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                c.execute("SAVEPOINT add_content")
+                try:
+                    inserted = []
+                    for i, row in enumerate(rows):
+                        statement = sql_insert_statement(conn, row) if callable(sql_insert_statement) else sql_insert_statement
+                        c.execute(statement, row + (tcid,))
+                        if c.rowcount > 0:
+                            inserted.append(i)
+                except Exception as e:
+                    c.execute("ROLLBACK TO add_content")
+                    c.execute("RELEASE add_content")
+                    future.set_exception(e)
+                    continue
+
+                c.execute("RELEASE add_content")
+                changes += len(inserted)
+                committed.append((on_commit, inserted, future))
+
+            """No new content? Rollback tc insert and use old value"""
+            c.execute("COMMIT" if changes > 0 else "ROLLBACK")
+            tc = self._get_last_time_cookie(c)
+
+        except Exception as e:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for on_commit, inserted, future in committed:
+            try:
+                if on_commit is not None:
+                    on_commit(tc, inserted)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(tc)
+
+class _EventDispatcher:
+    """Delivers the content events to the listeners. 
+    
+    Every listener has its own queue and delivery thread, so a slow listener 
+    doesn't hold up the writers or the other listeners. The events queued for 
+    a listener while it is busy are coalesced: consecutive events of the same 
+    type are delivered as one, with all the content and the latest time cookie.
+    
+    The delivery threads are started on demand and exit when their queue is empty.
+    """
+
+    class _ListenerQueue:
+        def __init__(self, listener):
+            self._listener = listener
+            self._events = collections.deque()
+            self._cond = threading.Condition()
+            self._thread = None
+
+        def put(self, event):
+            with self._cond:
+                self._events.append(event)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._deliver, daemon=True)
+                    self._thread.start()
+
+        def join(self, timeout=None):
+            """Wait until the queued events have been delivered"""
+            with self._cond:
+                return self._cond.wait_for(lambda: self._thread is None, timeout)
+
+        def _deliver(self):
+            while True:
+                with self._cond:
+                    if not self._events:
+                        self._thread = None
+                        self._cond.notify_all()
+                        return
+
+                    events = self._coalesce(list(self._events))
+                    self._events.clear()
+
+                for type, content, time_cookie in events:
+                    try:
+                        self._listener(type, content, time_cookie)
+                    except Exception: # A failing listener shouldn't stop the delivery
+                        print("WARNING! Data base event listener failed:", self._listener)
+                        traceback.print_exc()
+
+        def _coalesce(self, events):
+            coalesced = []
+            for type, content, time_cookie in events:
+                if coalesced and coalesced[-1][0] == type:
+                    coalesced[-1] = (type, coalesced[-1][1] + content, time_cookie)
+                else:
+                    coalesced.append((type, list(content), time_cookie))
+            return coalesced
+
+    def __init__(self):
+        self._queues = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._queues.append(_EventDispatcher._ListenerQueue(listener))
+
+    def post(self, type, content, time_cookie):
+        """Queue an event for all the listeners"""
+        with self._lock:
+            queues = list(self._queues)
+
+        for q in queues:
+            q.put((type, content, time_cookie))
+
+    def join(self, timeout=None):
+        """Wait until the events posted so far have been delivered. Return False on timeout."""
+        with self._lock:
+            queues = list(self._queues)
+
+        return all([q.join(timeout) for q in queues])
+
+class _Connection(sqlite3.Connection):
+    """A data base connection that keeps track of the message partitions attached to it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation = None
+        self.windows = [] # (start, end, schema) of the attached partitions
+        self.insert_statements = {}
+
+    @property
+    def schemas(self):
+        """The names of the data bases holding messages (list)"""
+        return ['main'] + [schema for _, _, schema in self.windows]
+
+class _MessagePartitions:
+    """Messages stored in separate data base files, one per time window of the 
+    message timestamps.
+    
+    The partition files are attached to every connection, where a temporary 
+    view named messages (shadowing the main table) unites them with the main 
+    messages table. The main table keeps the messages without timestamp and 
+    the ones that didn't fit in a partition. Inserts are routed to the partition 
+    for the timestamp. Dropping a partition is just detaching and deleting a file.
+    
+    The messages are numbered (rowid) across all partitions in storage order.
+    
+    Note: A transaction spanning several partitions is only atomic per file. 
+    Partitions added or dropped are only seen by the ContentDB that did it 
+    (until the others are reopened).
+    """
+
+    _MAX_PARTITIONS = 8 # SQLite attaches at most 10 data bases by default
+    _SCHEMA_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size')
+
+    _CREATE_TABLE_MESSAGES = """CREATE TABLE IF NOT EXISTS {0}.messages
+        (msgid TEXT PRIMARY KEY,
+        msg TEXT NOT NULL,
+        timestamp INTEGER,
+        receiver TEXT,
+        sender TEXT,
+        signature TEXT,
+        cookieid INTEGER NOT NULL)"""
+
+    _QUERY_ADD_MESSAGE = """INSERT INTO {0}.messages (rowid, msgid, msg, timestamp, receiver, sender, signature, cookieid)
+        SELECT {1}, * FROM (SELECT ? AS msgid, ? AS msg, ? AS timestamp, ? AS receiver, ? AS sender, ? AS signature, ? AS cookieid) AS new
+        WHERE NOT EXISTS (SELECT 1 FROM messages WHERE messages.msgid = new.msgid)"""
+
+    def __init__(self, db_file, window_sec, pragmas, windows, create_statements):
+        """Partitions for the (start, end) windows registered in the main data base. 
+        
+        The create statements (indexes etc.) are run for the messages table of new 
+        partitions, with the schema as format argument.
+        """
+
+        self._db_file = db_file
+        self._window_sec = window_sec
+        self._pragmas = [(name, value) for name, value in pragmas.items() if name in self._SCHEMA_PRAGMAS]
+        self._create_statements = create_statements
+        self._windows = sorted(windows)
+        self._evicted = [] # Starts of the windows waiting to be merged into the main table
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def window_sec(self):
+        return self._window_sec
+
+    @property
+    def windows(self):
+        """The (start, end) time windows of the partitions (list)"""
+        with self._lock:
+            return list(self._windows)
+
+    def file_name(self, start):
+        """The file of the partition starting at start"""
+        return "{0}.{1}.part".format(self._db_file, start)
+
+    def attach(self, conn):
+        """Attach the current partitions to the connection (unless already done)"""
+
+        with self._lock:
+            generation, windows = self._generation, list(self._windows)
+
+        if conn.generation == generation:
+            return
+
+        conn.execute("DROP VIEW IF EXISTS temp.messages")
+        for _, _, schema in conn.windows:
+            conn.execute("DETACH DATABASE {0}".format(schema))
+        conn.windows = []
+
+        for start, end in windows:
+            schema = "part{0}".format(len(conn.windows))
+            conn.execute("ATTACH DATABASE ? AS {0}".format(schema), (self.file_name(start),))
+            for name, value in self._pragmas:
+                conn.execute("PRAGMA {0}.{1}={2}".format(schema, name, value))
+            conn.windows.append((start, end, schema))
+
+        conn.execute("CREATE TEMP VIEW messages AS " +
+                     " UNION ALL ".join("SELECT rowid AS rowid, * FROM {0}.messages".format(schema)
+                                        for schema in conn.schemas))
+
+        next_rowid = "max(0, {0}) + 1".format(", ".join("coalesce((SELECT max(rowid) FROM {0}.messages), 0)".format(schema)
+                                                         for schema in conn.schemas))
+        conn.insert_statements = dict((schema, self._QUERY_ADD_MESSAGE.format(schema, next_rowid))
+                                      for schema in conn.schemas)
+        conn.generation = generation
+
+    def insert_statement(self, conn, row):
+        """The statement inserting the message row (timestamp third) into its partition on the connection"""
+
+        timestamp = row[2]
+        if timestamp is not None:
+            for start, end, schema in conn.windows:
+                if start <= timestamp < end:
+                    return conn.insert_statements[schema]
+
+        return conn.insert_statements['main']
+
+    def add(self, timestamps, now):
+        """Create partitions for the time windows of the timestamps near now (int).
+        
+        Only the windows from _MAX_PARTITIONS - 2 before the current one up to the 
+        next one are partitioned, so that remote clocks can't use up the partitions. 
+        Messages with other timestamps are kept in the main table. Older (or farther 
+        ahead) windows are evicted to make room, see merge_evicted.
+        """
+
+        with self._lock:
+            current = now - now % self._window_sec
+            first, last = current - (self._MAX_PARTITIONS - 2) * self._window_sec, current + self._window_sec
+
+            starts = set()
+            for timestamp in timestamps:
+                if (timestamp is not None and first <= timestamp < last + self._window_sec and 
+                    not any(start <= timestamp < end for start, end in self._windows)):
+                    starts.add(timestamp - timestamp % self._window_sec)
+
+            if not starts:
+                return
+
+            for start, end in list(self._windows):
+                if len(self._windows) + len(starts) <= self._MAX_PARTITIONS:
+                    break
+                if start < first or start > last: # Oldest first
+                    self._windows.remove((start, end))
+                    self._evicted.append(start)
+
+            room = self._MAX_PARTITIONS - len(self._windows)
+            for start in sorted(starts, reverse=True)[:room]: # Newest first
+                self._create(start, start + self._window_sec)
+                self._windows.append((start, start + self._window_sec))
+
+            self._windows.sort()
+            self._generation += 1
+
+    def merge_evicted(self, conn):
+        """Move the messages of the evicted partitions to the main table of the 
+        connection and delete the partitions. 
+        
+        Only done by the writer, so that no messages are inserted into them meanwhile.
+        """
+
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+
+        for start in evicted:
+            conn.execute("ATTACH DATABASE ? AS evicted", (self.file_name(start),))
+            try:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("""INSERT OR IGNORE INTO main.messages (rowid, msgid, msg, timestamp, receiver, sender, signature, cookieid)
+                                    SELECT rowid, msgid, msg, timestamp, receiver, sender, signature, cookieid FROM evicted.messages""")
+            finally:
+                conn.execute("DETACH DATABASE evicted")
+
+            self.remove(start)
+
+    def remove(self, start):
+        """Forget the partition and delete its files. Should be done after the content has been taken care of."""
+
+        with self._lock:
+            self._windows = [window for window in self._windows if window[0] != start]
+            self._generation += 1
+
+            with contextlib.closing(sqlite3.connect(self._db_file)) as conn:
+                with conn:
+                    conn.execute("DELETE FROM message_partitions WHERE start=?", (start,))
+
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(self.file_name(start) + suffix)
+            except OSError:
+                pass # Already gone (or still open elsewhere)
+
+    def _create(self, start, end):
+        with contextlib.closing(sqlite3.connect(self.file_name(start))) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(self._CREATE_TABLE_MESSAGES.format('main'))
+                for sql_statement in self._create_statements:
+                    conn.execute(sql_statement.format('main'))
+
+        with contextlib.closing(sqlite3.connect(self._db_file)) as conn:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO message_partitions (start, end) VALUES (?,?)", (start, end))
+
 class ContentDB:
-    """A content database with a sqlite backend."""
+    """A content database. 
+    
+    This is the interface of the data base backends, see SQLiteContentDB 
+    (the default) and MemoryContentDB. 
+    
+    Time cookies (bytes) mark points in the history of a data base. Content 
+    added to a data base gets a new time cookie, so that remote data bases can 
+    ask for the content added after the last time cookie they know of.
+    """
 
     class _classproperty(property):
         """Class property (mix of classmethod and property)"""
@@ -37,8 +622,8 @@ class ContentDB:
             return self.fget.__get__(None, type_)()
 
     _DBID_LENGTH_BYTES = 12
+    _CLOSE_TIMEOUT_SEC = 5.0 # Wait for the event listeners
     _TCID_LENGTH_BYTES = 9
-
     __instance = None # Singleton instance
 
     @classmethod
@@ -54,7 +639,7 @@ class ContentDB:
         if db is None or not isinstance(db, ContentDB):
             raise ContentDBException
 
-        cls.__instance = db
+        ContentDB.__instance = db
 
     @classmethod
     def unregister(cls):
@@ -63,7 +648,7 @@ class ContentDB:
         if cls.__instance is None:
             raise ContentDBException
 
-        cls.__instance = None
+        ContentDB.__instance = None
 
     @_classproperty
     @classmethod
@@ -96,6 +681,391 @@ class ContentDB:
         """Text to binary decoding of id's"""
         return decode_b64_bytes(id.encode())
 
+    def __init__(self, id=None):
+        """Set up the data base id (bytes). A new id is generated if None."""
+
+        self._id = ContentDB._generate_random_db_id() if id is None else id
+        self._encoded_id = ContentDB._encode_id(self._id)
+        self._dispatcher = _EventDispatcher()
+
+    @property
+    def id(self):
+        """The data base id (bytes)"""
+        return self._id
+
+    def get_last_time_cookie(self, dbfp=None):
+        """Get the latest time cookie known in the data base for the remote 
+        data base with fingerprint dbfp. 
+        
+        If there is no record of the remote data base, return None.
+        
+        If dbfp is None, get the latest time cookie for the own database.
+        """
+
+    def update_last_time_cookie(self, dbfp, time_cookie):
+        """Create a time cookie entry (or update an existing one) for a remote data base"""
+
+    def contains_time_cookie(self, time_cookie):
+        """Returns true if the time cookie (bytes) is known to the data base"""
+
+    def compact_time_cookies(self, limit=None):
+        """Remove time cookies no longer referred to by any content. Return the number removed (int). 
+        
+        Only the cookies older than every message are removed, so remote nodes 
+        can keep asking for the content added after the newer ones. The current 
+        time cookie is always kept.
+        """
+
+    def add_event_listener(self, listener):
+        """Call listener(type, content, time_cookie) when content has been added.
+        
+        The type is "message" or "identity" and the content is a list of the 
+        messages or identities that were actually added, i.e. not already in 
+        the data base. The time cookie (bytes) is the one after the addition.
+        
+        The listeners are called from a thread of their own, see _EventDispatcher.
+        """
+        self._dispatcher.add_listener(listener)
+
+    def wait_for_listeners(self, timeout=None):
+        """Wait until the listeners have been called for the content added so far. Return False on timeout."""
+        return self._dispatcher.join(timeout)
+
+    def add_messages(self, msgs):
+        """Add a a list of messages to the data base.
+        
+        Will add all messages, not already in the data base to the data base and return a 
+        time cookie (bytes) that represents the point in time after the messages have been added.
+        If no messages were added, it just returns the current time cookie. 
+        """
+
+        return self._submit_messages(msgs).result()
+
+    def add_messages_async(self, msgs):
+        """Queue a list of messages to be added to the data base.
+        
+        Same as add_messages but returns a concurrent.futures.Future that resolves 
+        to the time cookie once the messages have been written. 
+        """
+
+        return self._submit_messages(msgs)
+
+    def close(self):
+        """Finish all pending writes and deliver the pending events (waiting at most _CLOSE_TIMEOUT_SEC)."""
+        if not self.wait_for_listeners(ContentDB._CLOSE_TIMEOUT_SEC):
+            print("WARNING! Data base closed before all event listeners returned")
+        MessageVerifier.release_shared(self)
+
+    def search_messages(self, search_term):
+        """Search the data base of messages."""
+
+    def remove_messages(self, msgs=None):
+        """Removes messages from the data base.
+        
+        The specified list of messages will be removed from the data base. 
+        If the message parameter is omitted, all messages in the data base will be removed.
+        """
+
+    def prune_messages(self, older_than=None, max_count=None, max_bytes=None, keep_own=True, limit=None):
+        """Remove old messages from the data base. Return the number of removed messages (int).
+        
+        Removes messages with a timestamp before older_than (int), then the 
+        earliest stored messages until there are at most max_count messages and 
+        the data base content uses at most max_bytes. If keep_own is True, 
+        messages signed by a private identity are never removed. At most limit 
+        messages are removed per call.
+        """
+
+    def drop_partitions(self, older_than, keep_own=True):
+        """Drop the message partitions for time windows ending before older_than (int). 
+        
+        Return the number of removed messages (int). Without partitions nothing is removed.
+        """
+
+        if isinstance(older_than, bool) or not isinstance(older_than, int):
+            raise TypeError
+
+        return 0
+
+    @property
+    def partition_windows(self):
+        """The (start, end) time windows of the message partitions (list)"""
+        return []
+
+    @property
+    def message_count(self):
+        """Returns the number of messages currently in the data base (int)"""
+
+    @property
+    def used_bytes(self):
+        """Returns the size of the data base content (int)"""
+
+    def contains_message(self, msgid):
+        """Returns true if the database contains the msgid"""
+
+    def missing_messages(self, msgids):
+        """Returns the message ids (bytes) from the list that are not in the data base"""
+
+    def get_messages(self, msgids=None, time_cookie=None):
+        """Get a list of all msg_rows with specified message id.
+        
+        If a time cookie is specified, all messages in the database from (and 
+        including) the time specified by the time cookie will be returned. 
+        The messages are in storage order.
+        """
+
+    def get_messages_for_receiver(self, fingerprint, limit=None):
+        """Get the messages (list) addressed to the identity with the fingerprint (bytes), in storage order."""
+
+    def get_messages_by_sender(self, fingerprint, limit=None):
+        """Get the messages (list) signed by the identity with the fingerprint (bytes), in storage order."""
+
+    def get_recent_messages(self, limit, before=None):
+        """Get the (at most) limit latest messages, newest first, as a (cursor, messages) tuple. 
+        
+        Messages without timestamp are not included. The cursor marks the position 
+        of the last message returned (the before argument if there was none). If before 
+        (a cursor) is specified, only the messages after it are returned (for paging).
+        """
+
+    def find_messages(self, limit=None, offset=None, time_cookie=None, sender=None, receiver=None, text=None):
+        """Iterate over the messages matching all the specified filters, in storage order.
+        
+        The messages are skipped up to offset (int) and at most limit (int) are returned. 
+        If a time cookie is specified, only messages added after it are included. Sender and 
+        receiver are fingerprints (bytes) and text (str) is matched case insensitively as a 
+        substring of the message text. The messages are read as the iterator is consumed.
+        """
+
+    def get_inbox(self, limit=None):
+        """Get the messages to the private identities in the data base, in storage order.
+        
+        Returns a list of (message, plaintext) pairs. Messages are only decrypted once.
+        """
+
+    def get_message_ids(self, time_cookie=None):
+        """Get a list of the ids (bytes) of all messages in the data base.
+        
+        If a time cookie is specified, only the ids of the messages added after
+        the time specified by the time cookie will be returned.
+        """
+
+    def add_private_identity(self, identity):
+        """Add a private identity to the data base."""
+
+    def remove_private_identity(self, identity, keep_public_identity=False):
+        """Remove a private identity to the data base."""
+
+    def get_private_identity(self, fingerprint):
+        """Get a private identity from the data base"""
+
+    def add_identities(self, identities):
+        """Add a a list of identities to the data base.
+        
+        Will add all identities, not already in the data base to the data base and return a 
+        time cookie (bytes) that represents the point in time after the identities have been added.
+        If no identities were added, it just returns the current time cookie. 
+        """
+
+        return self._submit_identities(identities).result()
+
+    def add_identities_async(self, identities):
+        """Queue a list of identities to be added to the data base.
+        
+        See add_messages_async.
+        """
+
+        return self._submit_identities(identities)
+
+    def remove_identities(self, identities=None):
+        """Removes identities from the data base.
+        
+        The specified list of identities will be removed from the data base. 
+        If the identities parameter is omitted, all identities in the data base will be removed.
+        """
+
+    def set_nick(self, fingerprint, nick):
+        """Set the nick of a specific identity."""
+
+    def get_nick(self, fingerprint):
+        """Get the nick of a specific identity"""
+
+    @property
+    def identity_count(self):
+        """Returns the number of identities currently in the data base (int)"""
+
+    def contains_identity(self, fingerprint):
+        """Returns true if the database contains the identity fingerprint"""
+
+    def missing_identities(self, fingerprints):
+        """Returns the identity fingerprints (bytes) from the list that are not in the data base"""
+
+    def get_identities(self, fingerprints=None, time_cookie=None):
+        """Get a list of all identities with specified fingerprints.
+        
+        If the parameter is None, all identities are returned.
+        
+        If a time cookie is specified, all identities in the database after
+        the time specified by the time cookie will be returned. The identities 
+        are in storage order.
+        """
+
+    def find_identities(self, limit=None, offset=None, time_cookie=None, nick=None):
+        """Iterate over the (public) identities matching all the specified filters, in storage order.
+        
+        Limit, offset and time cookie are as for find_messages. The nick (str) is matched 
+        case insensitively as a substring of the nick of the identity.
+        """
+
+    def export_snapshot(self, out):
+        """Write a snapshot of the content to the binary stream out. Return the time cookie of the snapshot.
+        
+        The messages are read and written a block at a time. Content added while 
+        the snapshot is written is left for the incremental synchronization.
+        """
+
+        time_cookie, msgids = self.get_message_ids()
+        writer = SnapshotWriter(out, self.id, time_cookie)
+
+        writer.write_identities(self.get_identities()[1]) # Senders before their messages
+
+        for i in range(0, len(msgids), SnapshotWriter.BLOCK_SIZE):
+            writer.write_messages(self.get_messages(msgids[i:i + SnapshotWriter.BLOCK_SIZE])[1])
+
+        writer.close()
+        return time_cookie
+
+    def import_snapshot(self, inp, verify=None):
+        """Add the content of a snapshot read from the binary stream inp. Return the (db id, time cookie) of the snapshot.
+        
+        Each block is added as soon as it has been read and checked. The optional 
+        verify function filters the messages of a block (e.g. MessageVerifier.verify). 
+        When the whole snapshot is imported, the time cookie is recorded for the 
+        source data base, so the synchronization can continue from it. Raises a 
+        SnapshotError if the snapshot is corrupt or truncated.
+        """
+
+        reader = SnapshotReader(inp)
+
+        for kind, content in reader:
+            if kind == 'message':
+                self.add_messages(content if verify is None else verify(content))
+            else:
+                self.add_identities(content)
+
+        self.update_last_time_cookie(reader.dbid, reader.time_cookie)
+        return (reader.dbid, reader.time_cookie)
+
+    def _submit_messages(self, msgs):
+        """Queue messages to be added. Return a Future resolving to the time cookie. 
+        
+        The backend calls _content_added with the messages that were added.
+        """
+
+    def _submit_identities(self, identities):
+        """Queue identities to be added. Return a Future resolving to the time cookie.
+        
+        The backend calls _content_added with the identities that were added.
+        """
+
+    def _content_added(self, type, content, time_cookie):
+        """Notify the listeners about added content (unless empty)"""
+
+        if content:
+            self._dispatcher.post(type, content, time_cookie)
+
+    def _check_content(self, content, type):
+        """Return the content (iterable) as a list. Raise a TypeError unless all items are of the type."""
+
+        if content is None or not hasattr(content, '__iter__'):
+            raise TypeError
+
+        content = list(content)
+        if not all(isinstance(item, type) for item in content):
+            raise TypeError
+
+        return content
+
+    def _check_limit(self, limit):
+        if isinstance(limit, bool) or not isinstance(limit, int):
+            raise TypeError
+
+        if limit < 0:
+            raise ValueError
+
+    def _check_cursor(self, cursor):
+        """Raise TypeError unless the cursor is None or a (timestamp, position) pair from get_recent_messages."""
+
+        if cursor is None:
+            return
+
+        if (not isinstance(cursor, tuple) or len(cursor) != 2 or
+            any(isinstance(n, bool) or not isinstance(n, int) for n in cursor)):
+            raise TypeError
+
+    def _check_filters(self, limit, offset, fingerprints, terms):
+        """Raise the appropriate exception for an invalid find_* argument (None is no filter)."""
+
+        for n in (limit, offset):
+            if n is not None:
+                self._check_limit(n)
+
+        for fingerprint in fingerprints:
+            if fingerprint is not None:
+                if not isinstance(fingerprint, bytes):
+                    raise TypeError
+                if len(fingerprint) == 0:
+                    raise ValueError
+
+        for term in terms:
+            if term is not None and not isinstance(term, str):
+                raise TypeError
+
+
+class SQLiteContentDB(ContentDB):
+    """A content database with a sqlite backend."""
+
+    _IDENTITY_CACHE_SIZE = 1024
+    _MAX_IDLE_READERS = 4
+    _MAX_PENDING_WRITES = 256
+    _PRUNE_BATCH_SIZE = 100 # Messages removed per call when the data base is too big
+    _FETCH_SIZE = 100 # Rows fetched at a time by the find_* iterators
+
+    """Default connection pragmas. WAL lets readers run concurrently with the writer,
+    which makes synchronous=NORMAL safe against corruption (a power loss can only 
+    lose the last commits)."""
+    _PRAGMAS = {'synchronous' : 'NORMAL',
+                'cache_size' : -8192, # KiB
+                'mmap_size' : 0,
+                'temp_store' : 'MEMORY'}
+
+    _PRAGMA_VALUE_PATTERN = re.compile(r'^(-?\d+|[A-Za-z_]+)$')
+
+    @classmethod
+    def _check_pragmas(cls, pragmas):
+        """Merge the pragmas (dict) with the defaults. Only known pragmas and 
+        plain values (int or keyword) are accepted since pragmas can't be bound 
+        as statement parameters.
+        """
+
+        merged = dict(SQLiteContentDB._PRAGMAS)
+        if pragmas is None:
+            return merged
+
+        if not isinstance(pragmas, dict):
+            raise TypeError
+
+        for name, value in pragmas.items():
+            if name not in SQLiteContentDB._PRAGMAS:
+                raise ValueError
+            if isinstance(value, bool) or not isinstance(value, (int, str)):
+                raise TypeError
+            if not SQLiteContentDB._PRAGMA_VALUE_PATTERN.match(str(value)):
+                raise ValueError
+            merged[name] = value
+
+        return merged
+
     _CREATE_TABLE_DATABASES = """CREATE TABLE IF NOT EXISTS databases
         (id INTEGER PRIMARY KEY AUTOINCREMENT,
         fingerprint TEXT UNIQUE,
@@ -135,57 +1105,156 @@ class ContentDB:
         signature TEXT,
         cookieid INTEGER NOT NULL REFERENCES time_cookies (id))"""
 
+    """Decrypted messages to the private identities. Local only, never synchronized."""
+    _CREATE_TABLE_INBOX = """CREATE TABLE IF NOT EXISTS inbox
+        (msgid TEXT PRIMARY KEY REFERENCES messages (msgid),
+        plaintext TEXT NOT NULL)"""
+
+    _CREATE_TABLE_MESSAGE_PARTITIONS = """CREATE TABLE IF NOT EXISTS message_partitions
+        (start INTEGER PRIMARY KEY,
+        end INTEGER NOT NULL)"""
+
+    """Indexes on the messages table of a data base (main or a partition)"""
+    _CREATE_MESSAGE_INDEXES = ["""CREATE INDEX IF NOT EXISTS {0}.messages_receiver ON messages (receiver)""",
+                               """CREATE INDEX IF NOT EXISTS {0}.messages_sender ON messages (sender)""",
+                               """CREATE INDEX IF NOT EXISTS {0}.messages_timestamp ON messages (timestamp)""",
+                               """CREATE INDEX IF NOT EXISTS {0}.messages_cookieid ON messages (cookieid)"""]
+
+    """Row counts of the tables (name as second format argument), kept up to date by triggers.
+    
+    The counts are initialized from the table when first created.
+    """
+    _CREATE_COUNTS = ["""CREATE TABLE IF NOT EXISTS {0}.content_counts (name TEXT PRIMARY KEY, count INTEGER NOT NULL)""",
+                      """INSERT OR IGNORE INTO {0}.content_counts (name, count) SELECT '{1}', count(*) FROM {0}.{1}""",
+                      """CREATE TRIGGER IF NOT EXISTS {0}.{1}_count_insert AFTER INSERT ON {1} 
+                         BEGIN UPDATE content_counts SET count = count + 1 WHERE name = '{1}'; END""",
+                      """CREATE TRIGGER IF NOT EXISTS {0}.{1}_count_delete AFTER DELETE ON {1} 
+                         BEGIN UPDATE content_counts SET count = count - 1 WHERE name = '{1}'; END"""]
+
+    _CREATE_INDEXES = ["""CREATE INDEX IF NOT EXISTS identities_cookieid ON identities (cookieid)""",
+                       """CREATE INDEX IF NOT EXISTS time_cookies_cookie ON time_cookies (cookie)"""]
+
     _QUERY_GET_LAST_TIME_COOKIE = """SELECT max(id), cookie FROM time_cookies"""
     _QUERY_REMOTE_GET_LAST_TIME_COOKIE = """SELECT cookie FROM remote_time_cookies WHERE dbfp=?"""
-    _QUERY_GET_MESSAGE_COUNT = """SELECT count(*) FROM messages"""
-    _QUERY_GET_IDENTITY_COUNT = """SELECT count(*) FROM identities"""
+    _QUERY_GET_COUNT = """SELECT count FROM {0}.content_counts WHERE name=?"""
     _QUERY_REMOVE_ALL_IDENTITIES = """DELETE FROM identities"""
     _QUERY_REMOVE_SPECIFIC_IDENTITIES = """DELETE FROM identities WHERE fingerprint=?"""
-    _QUERY_REMOVE_ALL_MESSAGES = """DELETE FROM messages"""
-    _QUERY_REMOVE_SPECIFIC_MESSAGES = """DELETE FROM messages WHERE msgid=?"""
+    _QUERY_REMOVE_ALL_MESSAGES = """DELETE FROM {0}.messages"""
+    _QUERY_REMOVE_SPECIFIC_MESSAGES = """DELETE FROM {0}.messages WHERE msgid=?"""
+    _QUERY_CONTAINS_MESSAGE = """SELECT count(*) FROM messages WHERE msgid=?"""
+    _QUERY_GET_MESSAGE_IDS = """SELECT msgid FROM messages"""
+    _QUERY_GET_FINGERPRINTS = """SELECT fingerprint FROM identities"""
+    _QUERY_CONTAINS_IDENTITY = """SELECT count(*) FROM identities WHERE fingerprint=?"""
+
+    _QUERY_GET_MESSAGES_FOR_RECEIVER = """SELECT msgid, msg, timestamp, receiver, sender, signature FROM messages WHERE receiver=? ORDER BY rowid LIMIT ?"""
+    _QUERY_GET_MESSAGES_BY_SENDER = """SELECT msgid, msg, timestamp, receiver, sender, signature FROM messages WHERE sender=? ORDER BY rowid LIMIT ?"""
+    _QUERY_GET_RECENT_MESSAGES = """SELECT msgid, msg, timestamp, receiver, sender, signature, rowid FROM messages WHERE timestamp IS NOT NULL 
+        ORDER BY timestamp DESC, rowid DESC LIMIT ?"""
+    _QUERY_GET_RECENT_MESSAGES_BEFORE = """SELECT msgid, msg, timestamp, receiver, sender, signature, rowid FROM messages WHERE (timestamp, rowid) < (?, ?) 
+        ORDER BY timestamp DESC, rowid DESC LIMIT ?"""
+
+    _QUERY_GET_UNDECRYPTED_INBOX = """SELECT messages.msgid, msg, receiver FROM messages 
+        JOIN private_identities ON messages.receiver = private_identities.fingerprint 
+        LEFT JOIN inbox ON messages.msgid = inbox.msgid WHERE inbox.msgid IS NULL"""
+    _QUERY_GET_INBOX = """SELECT messages.msgid, msg, timestamp, receiver, sender, signature, plaintext FROM inbox 
+        JOIN messages ON inbox.msgid = messages.msgid ORDER BY messages.rowid LIMIT ?"""
+    _QUERY_ADD_INBOX = """INSERT OR IGNORE INTO inbox (msgid, plaintext) VALUES (?,?)"""
+    _QUERY_REMOVE_ALL_INBOX = """DELETE FROM inbox"""
+    _QUERY_REMOVE_SPECIFIC_INBOX = """DELETE FROM inbox WHERE msgid=?"""
+
+    _QUERY_NOT_OWN_MESSAGE = """(sender IS NULL OR sender NOT IN (SELECT fingerprint FROM private_identities))"""
+    _QUERY_GET_EXPIRED_MESSAGE_IDS = """SELECT msgid FROM messages WHERE timestamp < ? AND {0} ORDER BY timestamp LIMIT ?"""
+    _QUERY_GET_OLDEST_MESSAGE_IDS = """SELECT msgid FROM messages WHERE {0} ORDER BY rowid LIMIT ?"""
+    """Only the unused cookies older than every stored message are removed; the content 
+    added after such a cookie is all of the messages anyway. Newer cookies may have been 
+    handed out to remote nodes that sync incrementally from them."""
+    _QUERY_COMPACT_TIME_COOKIES = """DELETE FROM time_cookies WHERE id IN 
+        (SELECT id FROM time_cookies 
+        WHERE id < coalesce((SELECT min(cookieid) FROM messages), (SELECT max(id) FROM time_cookies)) 
+        AND id NOT IN (SELECT cookieid FROM identities) LIMIT ?)"""
+
+    _MAX_QUERY_PARAMETERS = 500 # Keep well below SQLITE_MAX_VARIABLE_NUMBER
 
     _QUERY_ADD_MESSAGES = """INSERT OR IGNORE INTO messages (msgid, msg, timestamp, receiver, sender, signature, cookieid) VALUES (?,?,?,?,?,?,?)"""
     _QUERY_ADD_IDENTITIES = """INSERT OR IGNORE INTO identities (fingerprint, dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e, nick, cookieid) VALUES (?,?,?,?,?,?,?,?,?)"""
 
-    def __init__(self, db_file, id=None):
-        """Create a SQLite backed data base."""
-        super().__init__()
-
+    def __init__(self, db_file, id=None, pragmas=None, partition_sec=None):
+        """Create a SQLite backed data base.
+        
+        The pragmas (dict) override the default connection pragmas (see _PRAGMAS).
+        
+        If partition_sec (int) is specified, messages are stored in one file per 
+        time window of that length (by message timestamp), so that old messages 
+        can be dropped a window at a time (see drop_partitions).
+        """
         if db_file is None or not isinstance(db_file, str):
             raise ContentDBException
 
+        if partition_sec is not None:
+            if isinstance(partition_sec, bool) or not isinstance(partition_sec, int):
+                raise TypeError
+            if partition_sec <= 0 or db_file == ":memory:":
+                raise ValueError
+
         self._db_file = db_file
+        self._pragmas = self._check_pragmas(pragmas)
+        self._partitions = None
 
-        self._listener_functions = []
+        """Idle read only connections and the one in use by each thread"""
+        self._readers = threading.local()
+        self._idle_readers = []
+        self._reader_lock = threading.Lock()
+        self._closed = False
 
-        if id is None:
-            self._id = ContentDB._generate_random_db_id()
-            self._encoded_id = ContentDB._encode_id(self._id)
-        else:
-            self._id = id
-            self._encoded_id = ContentDB._encode_id(self._id)
+        super().__init__(id)
+
+        """Public identities read from the data base, keyed by encoded fingerprint"""
+        self._identity_cache = LRUCache(SQLiteContentDB._IDENTITY_CACHE_SIZE)
+
+        self._writer = _ContentWriter(self._connect, self._insert_new_tc, self._get_last_time_cookie,
+                                      SQLiteContentDB._MAX_PENDING_WRITES, self._prepare_write)
 
+        if id is not None:
             """Check existence of specified id"""
-            with sqlite3.connect(self._db_file) as conn:
+            with contextlib.closing(self._connect()) as conn:
                 c = conn.cursor()
                 if c.execute("""SELECT count(*) FROM databases WHERE fingerprint=?""",
                              (self._encoded_id,)).fetchone()[0] != 1:
                     raise ValueError
 
-        with sqlite3.connect(self._db_file) as conn:
+        with contextlib.closing(self._connect()) as conn, conn:
             c = conn.cursor()
+            c.execute("PRAGMA journal_mode=WAL") # Persistent, in the db file
             self._create_tables(c)
 
+            if partition_sec is not None:
+                self._partitions = _MessagePartitions(self._db_file, partition_sec, self._pragmas,
+                                                      c.execute("SELECT start, end FROM message_partitions").fetchall(),
+                                                      self._CREATE_MESSAGE_INDEXES + 
+                                                      [sql_statement.format('{0}', 'messages') for sql_statement in self._CREATE_COUNTS])
+                conn.commit()
+                self._attach_partitions(conn)
+                for schema in conn.schemas[1:]:
+                    self._create_counts(c, schema, 'messages')
+
+            """Bloom filters over the stored message ids and fingerprints.
+            
+            Note: Only writes made through this instance are seen by the filters.
+            """
+            self._message_filter = _ContentFilter(lambda: self._load_ids(self._QUERY_GET_MESSAGE_IDS),
+                                                  self._load_ids(self._QUERY_GET_MESSAGE_IDS, c))
+            self._identity_filter = _ContentFilter(lambda: self._load_ids(self._QUERY_GET_FINGERPRINTS),
+                                                   self._load_ids(self._QUERY_GET_FINGERPRINTS, c))
+
     @property
-    def id(self):
-        """The data base id (bytes)"""
-        return self._id
+    def pragmas(self):
+        """The pragmas used for the data base connections (dict)"""
+        return dict(self._pragmas)
 
     @property
     def name(self):
         """The data base name (can be None)"""
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
             return c.execute("""SELECT name FROM databases WHERE fingerprint=?""",
                              (self._decoded_id,)).fetchone()[0]
 
@@ -198,16 +1267,13 @@ class ContentDB:
         If dbfp is None, get the latest time cookie for the own database.
         """
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
             return self._get_last_time_cookie(c, dbfp)
 
     def update_last_time_cookie(self, dbfp, time_cookie):
         """Create a time cookie entry (or update an existing one) for a remote data base"""
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
-
+        def write(c):
             if self._get_last_time_cookie(c, dbfp) is None:
                 dbid = c.execute("""INSERT INTO databases (fingerprint) VALUES (?)""", (self._encode_id(dbfp),)).lastrowid
                 c.execute("""INSERT INTO remote_time_cookies (cookie, dbid) VALUES (?,?)""", (self._encode_id(time_cookie), dbid))
@@ -215,34 +1281,24 @@ class ContentDB:
                 dbid = c.execute("""SELECT id FROM databases WHERE fingerprint=?""", (self._encode_id(dbfp),)).fetchone()[0]
                 c.execute("""UPDATE remote_time_cookies SET cookie=? WHERE dbid=?""", (self._encode_id(time_cookie), dbid))
 
-    def add_event_listener(self, listener):
-        self._listener_functions.append(listener)
-
-    def add_messages(self, msgs):
-        """Add a a list of messages to the data base.
-        
-        Will add all messages, not already in the data base to the data base and return a 
-        time cookie (bytes) that represents the point in time after the messages have been added.
-        If no messages were added, it just returns the current time cookie. 
-        """
-
-        if msgs is None or not hasattr(msgs, '__iter__'):
-            raise TypeError
+        self._write(write)
+
+    def close(self):
+        """Finish all pending writes and close the read connections."""
+        self._writer.close()
+        super().close()
 
-        cookie = self._add_content(self._QUERY_GET_MESSAGE_COUNT, self._QUERY_ADD_MESSAGES,
-                          [(self._encode_id(m.id), m.text, m.timestamp,
-                            None if not m.has_receiver else self._encode_id(m.receiver),
-                            None if not m.has_sender else self._encode_id(m.sender),
-                            None if not m.has_sender else self._encode_id(m.signature)) for m in msgs])
-        for listener in self._listener_functions:
-            listener("message", msgs)
-        return cookie
+        with self._reader_lock:
+            idle, self._idle_readers = self._idle_readers, []
+            self._closed = True
+
+        for conn in idle:
+            conn.close()
 
     def search_messages(self, search_term):
         """Search the data base of messages.
         """
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
             search_term = "%" + search_term + "%"
             c.execute("""SELECT msg FROM messages WHERE msg LIKE ?""", (search_term,))
             messages = c.fetchall()
@@ -257,16 +1313,153 @@ class ContentDB:
         """
 
         if msgs is None:
-            self._remove_content(self._QUERY_REMOVE_ALL_MESSAGES)
+            def write(c):
+                c.execute(self._QUERY_REMOVE_ALL_INBOX)
+                for schema in c.connection.schemas:
+                    c.execute(self._QUERY_REMOVE_ALL_MESSAGES.format(schema))
+
+            self._write(write)
+            self._message_filter.removed()
+        else:
+            self._remove_message_ids([self._encode_id(m.id) for m in msgs])
+
+    def prune_messages(self, older_than=None, max_count=None, max_bytes=None, keep_own=True, limit=None):
+        """Remove old messages from the data base. Return the number of removed messages (int).
+        
+        Removes messages with a timestamp before older_than (int), then the 
+        earliest stored messages until there are at most max_count messages and 
+        the data base content uses at most max_bytes. If keep_own is True, 
+        messages signed by a private identity are never removed. 
+        
+        At most limit messages are removed per call; call repeatedly to prune in 
+        small batches without blocking the writer for long.
+        """
+
+        for value in [older_than, max_count, max_bytes, limit]:
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                raise TypeError
+
+        if limit is None:
+            limit = -1 # No limit
+        elif limit < 0:
+            raise ValueError
+
+        if (max_count is not None and max_count < 0) or (max_bytes is not None and max_bytes < 0):
+            raise ValueError
+
+        removable = self._QUERY_NOT_OWN_MESSAGE if keep_own else "1"
+        msgids = []
+
+        with self._reading() as c:
+            if older_than is not None:
+                msgids = [row[0] for row in c.execute(self._QUERY_GET_EXPIRED_MESSAGE_IDS.format(removable),
+                                                      (older_than, limit))]
+
+            excess = 0
+            if max_count is not None:
+                excess = self._get_message_count(c) - len(msgids) - max_count
+
+            if max_bytes is not None and self._used_bytes(c) > max_bytes:
+                excess = max(excess, self._PRUNE_BATCH_SIZE if limit < 0 else limit)
+
+            if limit >= 0:
+                excess = min(excess, limit - len(msgids))
+
+            if excess > 0:
+                expired = set(msgids)
+                oldest = [row[0] for row in c.execute(self._QUERY_GET_OLDEST_MESSAGE_IDS.format(removable),
+                                                      (excess + len(expired),))
+                          if row[0] not in expired]
+                msgids.extend(oldest[:excess])
+
+        if msgids:
+            self._remove_message_ids(msgids)
+
+        return len(msgids)
+
+    def compact_time_cookies(self, limit=None):
+        """Remove time cookies no longer referred to by any content. Return the number removed (int). 
+        
+        Only the cookies older than every message are removed and the current time 
+        cookie is always kept. Remote nodes that ask for content after a removed time 
+        cookie will be sent the full id lists, which are all newer than it anyway.
+        """
+
+        if limit is None:
+            limit = -1 # No limit
         else:
-            self._remove_content(self._QUERY_REMOVE_SPECIFIC_MESSAGES, [self._encode_id(m.id) for m in msgs])
+            self._check_limit(limit)
+
+        return self._write(lambda c: c.execute(self._QUERY_COMPACT_TIME_COOKIES, (limit,)).rowcount)
+
+    def drop_partitions(self, older_than, keep_own=True):
+        """Drop the message partitions for time windows ending before older_than (int). 
+        
+        Return the number of removed messages (int). If keep_own is True, the 
+        messages signed by a private identity are moved to the main data base 
+        first. Without partitions nothing is removed.
+        """
+
+        if isinstance(older_than, bool) or not isinstance(older_than, int):
+            raise TypeError
+
+        if self._partitions is None:
+            return 0
+
+        removed = 0
+        for start, end in self._partitions.windows:
+            if end > older_than:
+                continue
+
+            with contextlib.closing(self._connect()) as conn:
+                schema = [schema for s, _, schema in conn.windows if s == start][0]
+                with conn:
+                    c = conn.cursor()
+                    count = c.execute("SELECT count(*) FROM {0}.messages".format(schema)).fetchone()[0]
+                    if keep_own:
+                        c.execute("""INSERT OR IGNORE INTO main.messages (rowid, msgid, msg, timestamp, receiver, sender, signature, cookieid)
+                                     SELECT rowid, msgid, msg, timestamp, receiver, sender, signature, cookieid FROM {0}.messages 
+                                     WHERE sender IN (SELECT fingerprint FROM private_identities)""".format(schema))
+                        count -= c.rowcount
+                    c.execute("""DELETE FROM inbox WHERE msgid IN (SELECT msgid FROM {0}.messages) 
+                                 AND msgid NOT IN (SELECT msgid FROM main.messages)""".format(schema))
+
+            self._partitions.remove(start)
+            removed += count
+
+        if removed > 0:
+            self._message_filter.removed(removed)
+
+        return removed
+
+    @property
+    def partition_windows(self):
+        """The (start, end) time windows of the message partitions (list)"""
+        return [] if self._partitions is None else self._partitions.windows
+
+    def contains_time_cookie(self, time_cookie):
+        """Returns true if the time cookie (bytes) is known to the data base"""
+
+        if not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        with self._reading() as c:
+            return c.execute("SELECT count(*) FROM time_cookies WHERE cookie = ?",
+                             (self._encode_id(time_cookie),)).fetchone()[0] > 0
 
     @property
     def message_count(self):
         """Returns the number of messages currently in the data base (int)"""
 
-        with sqlite3.connect(self._db_file) as conn:
-            return conn.cursor().execute(self._QUERY_GET_MESSAGE_COUNT).fetchone()[0]
+        with self._reading() as c:
+            return self._get_message_count(c)
+
+    @property
+    def used_bytes(self):
+        """Returns the size of the data base content, excluding free pages (int)"""
+
+        with self._reading() as c:
+            return self._used_bytes(c)
 
     def contains_message(self, msgid):
         """Returns true if the database contains the msgid"""
@@ -274,54 +1467,146 @@ class ContentDB:
         if not isinstance(msgid, bytes):
             raise TypeError
 
-        _, msgs = self.get_messages(msgids=[msgid])
-        return msgs is not None and len(msgs) == 1
+        if not self._message_filter.might_contain(msgid):
+            return False
+
+        with self._reading() as c:
+            return c.execute(self._QUERY_CONTAINS_MESSAGE, (self._encode_id(msgid),)).fetchone()[0] > 0
+
+    def missing_messages(self, msgids):
+        """Returns the message ids (bytes) from the list that are not in the data base"""
+
+        return self._missing_ids(self._message_filter, """SELECT msgid FROM messages WHERE msgid IN ({0})""", msgids)
 
     def get_messages(self, msgids=None, time_cookie=None):
         """Get a list of all msg_rows with specified message id.
         
         If a time cookie is specified, all messages in the database from (and 
-        including) the time specified by the time cookie will be returned.
+        including) the time specified by the time cookie will be returned. 
+        The messages are in storage order.
         """
 
         if msgids is not None and not hasattr(msgids, '__iter__'):
             raise TypeError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
 
             if time_cookie is not None:
-                if not isinstance(time_cookie, bytes):
-                    raise TypeError
-                if len(time_cookie) == 0:
-                    raise ValueError
-
-                """Assert that time_cookie is a valid cookie"""
-                if c.execute("SELECT count(*) FROM time_cookies WHERE cookie = ?",
-                          (self._encode_id(time_cookie),)).fetchone()[0] == 0:
-                    raise ValueError
+                self._check_time_cookie(c, time_cookie)
 
-                c.execute("""SELECT msg, timestamp, receiver, sender, signature
-                             FROM messages JOIN time_cookies ON messages.cookieid = time_cookies.id
-                             WHERE time_cookies.id > (SELECT id FROM time_cookies WHERE cookie = ?)""",
-                             (self._encode_id(time_cookie),))
+            if msgids is None:
+                rows = self._select_messages(c, time_cookie)
             else:
-                c.execute("""SELECT msg, timestamp, receiver, sender, signature FROM messages""")
+                rows = self._select_chunks(self._select_messages, c, time_cookie, 
+                                           [self._encode_id(mid) for mid in msgids])
 
-            msgs = c.fetchall()
             current_tc = self._get_last_time_cookie(c)
-            msgs = [Message(m[0],
-                    m[1],
-                    None if m[2] is None else self._decode_id(m[2]),
-                    None if m[3] is None else self._decode_id(m[3]),
-                    None if m[4] is None else self._decode_id(m[4])) for m in msgs
-                    if m is not None]
-
-            if msgids is not None:
-                msgs = [m for m in msgs if m.id in msgids]
+            msgs = [self._row2message(m) for m in rows if m is not None]
 
             return (current_tc, msgs)
 
+    def get_messages_for_receiver(self, fingerprint, limit=None):
+        """Get the messages (list) addressed to the identity with the fingerprint (bytes), in storage order.
+        
+        If a limit is specified, at most limit messages are returned.
+        """
+
+        return self._query_messages(self._QUERY_GET_MESSAGES_FOR_RECEIVER, fingerprint, limit)
+
+    def get_messages_by_sender(self, fingerprint, limit=None):
+        """Get the messages (list) signed by the identity with the fingerprint (bytes), in storage order.
+        
+        If a limit is specified, at most limit messages are returned.
+        """
+
+        return self._query_messages(self._QUERY_GET_MESSAGES_BY_SENDER, fingerprint, limit)
+
+    def get_recent_messages(self, limit, before=None):
+        """Get the (at most) limit latest messages, newest first, as a (cursor, messages) tuple. 
+        
+        Messages without timestamp are not included. The cursor marks the position 
+        of the last message returned (the before argument if there was none). If before 
+        (a cursor) is specified, only the messages after it are returned (for paging).
+        """
+
+        self._check_limit(limit)
+        self._check_cursor(before)
+
+        with self._reading() as c:
+            if before is None:
+                rows = c.execute(self._QUERY_GET_RECENT_MESSAGES, (limit,)).fetchall()
+            else:
+                rows = c.execute(self._QUERY_GET_RECENT_MESSAGES_BEFORE, before + (limit,)).fetchall()
+
+        """The messages are ordered by (timestamp, rowid), so the ones sharing a timestamp aren't skipped"""
+        cursor = (rows[-1][2], rows[-1][6]) if rows else before
+        return (cursor, [self._row2message(row) for row in rows])
+
+    def get_inbox(self, limit=None):
+        """Get the messages to the private identities in the data base, in storage order.
+        
+        Returns a list of (message, plaintext) pairs. Messages are decrypted the 
+        first time they are read and the plaintext is kept in the data base, so 
+        only new messages are decrypted. Messages that can't be decrypted are 
+        left out. If a limit is specified, at most limit messages are returned.
+        """
+
+        if limit is None:
+            limit = -1 # No limit
+        else:
+            self._check_limit(limit)
+
+        self._decrypt_inbox()
+
+        with self._reading() as c:
+            return [(self._row2message(row), row[6]) for row in c.execute(self._QUERY_GET_INBOX, (limit,))]
+
+    def find_messages(self, limit=None, offset=None, time_cookie=None, sender=None, receiver=None, text=None):
+        """Iterate over the messages matching all the specified filters, in storage order.
+        
+        The messages are skipped up to offset (int) and at most limit (int) are returned. 
+        If a time cookie is specified, only messages added after it are included. Sender and 
+        receiver are fingerprints (bytes) and text (str) is matched case insensitively as a 
+        substring of the message text. The messages are read as the iterator is consumed.
+        """
+
+        self._check_filters(limit, offset, [sender, receiver], [text])
+
+        conditions, params = self._cookie_condition(time_cookie)
+
+        for column, fingerprint in (('sender', sender), ('receiver', receiver)):
+            if fingerprint is not None:
+                conditions.append(column + " = ?")
+                params.append(self._encode_id(fingerprint))
+
+        if text is not None:
+            conditions.append("msg LIKE ? ESCAPE '\\'")
+            params.append(self._like_pattern(text))
+
+        sql = "SELECT msgid, msg, timestamp, receiver, sender, signature, rowid FROM messages"
+        return self._iterate_rows(sql, conditions, params, limit, offset, self._row2message)
+
+    def get_message_ids(self, time_cookie=None):
+        """Get a list of the ids (bytes) of all messages in the data base.
+        
+        If a time cookie is specified, only the ids of the messages added after
+        the time specified by the time cookie will be returned. The ids are read 
+        as stored, no messages are created.
+        """
+
+        with self._reading() as c:
+
+            if time_cookie is not None:
+                self._check_time_cookie(c, time_cookie)
+                c.execute("""SELECT msgid FROM messages
+                             WHERE cookieid > (SELECT id FROM time_cookies WHERE cookie = ?)""",
+                             (self._encode_id(time_cookie),))
+            else:
+                c.execute(self._QUERY_GET_MESSAGE_IDS)
+
+            msgids = [self._decode_id(row[0]) for row in c.fetchall()]
+            return (self._get_last_time_cookie(c), msgids)
+
     def add_private_identity(self, identity):
         """Add a private identity to the data base."""
 
@@ -335,10 +1620,9 @@ class ContentDB:
         self.add_identities([identity])
 
         # ... and the private part
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO private_identities (fingerprint, dsa_x, rsa_d) VALUES (?,?,?)",
-                      (self._encode_id(identity.fingerprint), encode_b64_int(identity.dsa_key.x), encode_b64_int(identity.rsa_key.d)))
+        self._write(lambda c: c.execute("INSERT INTO private_identities (fingerprint, dsa_x, rsa_d) VALUES (?,?,?)",
+                                        (self._encode_id(identity.fingerprint), encode_b64_int(identity.dsa_key.x), 
+                                         encode_b64_int(identity.rsa_key.d))))
 
     def remove_private_identity(self, identity, keep_public_identity=False):
         """Remove a private identity to the data base."""
@@ -352,35 +1636,14 @@ class ContentDB:
         if not keep_public_identity:
             self.remove_identities([identity])
 
-        # ... and the private part
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        # ... and the private part (including the decrypted messages)
+        def write(c):
+            c.execute("DELETE FROM inbox WHERE msgid IN (SELECT msgid FROM messages WHERE receiver=?)",
+                      (self._encode_id(identity.fingerprint),))
             c.execute("DELETE FROM private_identities WHERE fingerprint=?",
                       (self._encode_id(identity.fingerprint),))
 
-    def add_identities(self, identities):
-        """Add a a list of identities to the data base.
-        
-        Will add all identities, not already in the data base to the data base and return a 
-        time cookie (bytes) that represents the point in time after the identities have been added.
-        If no identities were added, it just returns the current time cookie. 
-        """
-
-        if identities is None or not hasattr(identities, '__iter__'):
-            raise TypeError
-
-        cookie = self._add_content(self._QUERY_GET_IDENTITY_COUNT, self._QUERY_ADD_IDENTITIES,
-                          [(self._encode_id(id.fingerprint),
-                            encode_b64_int(id.dsa_key.y),
-                            encode_b64_int(id.dsa_key.g),
-                            encode_b64_int(id.dsa_key.p),
-                            encode_b64_int(id.dsa_key.q),
-                            encode_b64_int(id.rsa_key.n),
-                            encode_b64_int(id.rsa_key.e),
-                            None) for id in identities])
-        for listener in self._listener_functions:
-            listener("identity", identities)
-        return cookie
+        self._write(write)
 
     def remove_identities(self, identities=None):
         """Removes identities from the data base.
@@ -391,8 +1654,14 @@ class ContentDB:
 
         if identities is None:
             self._remove_content(self._QUERY_REMOVE_ALL_IDENTITIES)
+            self._identity_filter.removed()
+            self._identity_cache.clear()
         else:
-            self._remove_content(self._QUERY_REMOVE_SPECIFIC_IDENTITIES, [self._encode_id(id.fingerprint) for id in identities])
+            fingerprints = [self._encode_id(id.fingerprint) for id in identities]
+            self._remove_content(self._QUERY_REMOVE_SPECIFIC_IDENTITIES, fingerprints)
+            self._identity_filter.removed(len(fingerprints))
+            for fp in fingerprints:
+                self._identity_cache.pop(fp)
 
     def set_nick(self, fingerprint, nick):
         """Set the nick of a specific identity."""
@@ -406,9 +1675,8 @@ class ContentDB:
         if not nick is None and not isinstance(nick, str):
             raise TypeError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
-            c.execute("""UPDATE OR IGNORE identities SET nick = (?) WHERE fingerprint = (?)""", (nick, self._encode_id(fingerprint)))
+        self._write(lambda c: c.execute("""UPDATE OR IGNORE identities SET nick = (?) WHERE fingerprint = (?)""", 
+                                        (nick, self._encode_id(fingerprint))))
 
     def get_nick(self, fingerprint):
         """Get the nick of a specific identity"""
@@ -419,8 +1687,7 @@ class ContentDB:
         if  not len(fingerprint) > 0:
             raise ValueError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
             row = c.execute("""SELECT nick FROM identities WHERE fingerprint = (?)""", (self._encode_id(fingerprint),)).fetchone()
             return None if row is None else row[0]
 
@@ -428,8 +1695,8 @@ class ContentDB:
     def identity_count(self):
         """Returns the number of identities currently in the data base (int)"""
 
-        with sqlite3.connect(self._db_file) as conn:
-            return conn.cursor().execute(self._QUERY_GET_IDENTITY_COUNT).fetchone()[0]
+        with self._reading() as c:
+            return c.execute(self._QUERY_GET_COUNT.format('main'), ('identities',)).fetchone()[0]
 
     def contains_identity(self, fingerprint):
         """Returns true if the database contains the identity fingerprint"""
@@ -437,8 +1704,23 @@ class ContentDB:
         if not isinstance(fingerprint, bytes):
             raise TypeError
 
-        _, id = self.get_identities(fingerprints=[fingerprint])
-        return id is not None and len(id) == 1
+        if not self._identity_filter.might_contain(fingerprint):
+            return False
+
+        with self._reading() as c:
+            return c.execute(self._QUERY_CONTAINS_IDENTITY, (self._encode_id(fingerprint),)).fetchone()[0] > 0
+
+    def missing_identities(self, fingerprints):
+        """Returns the identity fingerprints (bytes) from the list that are not in the data base"""
+
+        return self._missing_ids(self._identity_filter, """SELECT fingerprint FROM identities WHERE fingerprint IN ({0})""", fingerprints)
+
+    @property
+    def filter_stats(self):
+        """Size and estimated false positive rate of the message and identity filters (dict)"""
+
+        return {'messages' : self._message_filter.stats,
+                'identities' : self._identity_filter.stats}
 
 
     def get_private_identity(self, fingerprint):
@@ -447,8 +1729,7 @@ class ContentDB:
         if not isinstance(fingerprint, bytes):
             raise TypeError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
             c.execute("""SELECT dsa_y, dsa_g, dsa_p, dsa_q, dsa_x, rsa_n, rsa_e, rsa_d FROM identities JOIN private_identities ON identities.fingerprint == private_identities.fingerprint WHERE private_identities.fingerprint == ?""", (self._encode_id(fingerprint),))
             id = c.fetchone()
             
@@ -470,48 +1751,116 @@ class ContentDB:
         If the parameter is None, all identities are returned.
         
         If a time cookie is specified, all identities in the database after
-        the time specified by the time cookie will be returned.  
+        the time specified by the time cookie will be returned. The identities 
+        are in storage order.
         """
 
         if fingerprints is not None and not hasattr(fingerprints, '__iter__'):
             raise TypeError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
+        with self._reading() as c:
 
             if time_cookie is not None:
-                if not isinstance(time_cookie, bytes):
-                    raise TypeError
-                if len(time_cookie) == 0:
-                    raise ValueError
+                self._check_time_cookie(c, time_cookie)
 
-                """Assert that time_cookie is a valid cookie"""
-                if c.execute("SELECT count(*) FROM time_cookies WHERE cookie = ?",
-                          (self._encode_id(time_cookie),)).fetchone()[0] == 0:
-                    raise ValueError
-
-                c.execute("""SELECT fingerprint, dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e, nick 
-                             FROM identities JOIN time_cookies ON identities.cookieid = time_cookies.id
-                             WHERE time_cookies.id > (SELECT id FROM time_cookies WHERE cookie=?)""",
-                             (self._encode_id(time_cookie),))
+            if fingerprints is None:
+                id_rows = self._select_identities(c, time_cookie)
             else:
-                c.execute("""SELECT fingerprint, dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e, nick FROM identities""")
+                id_rows = self._select_chunks(self._select_identities, c, time_cookie, 
+                                              [self._encode_id(fp) for fp in fingerprints])
 
-            id_rows = c.fetchall()
             current_tc = self._get_last_time_cookie(c)
 
-            ids = [Identity(DSA_key(decode_b64_int(id[1]),
-                                                  decode_b64_int(id[2]),
-                                                  decode_b64_int(id[3]),
-                                                  decode_b64_int(id[4])),
-                                          RSA_key(decode_b64_int(id[5]),
-                                                  decode_b64_int(id[6]))) for id in id_rows
-                                                  if id is not None]
+            return (current_tc, [self._row2identity(row) for row in id_rows if row is not None])
+
+    def find_identities(self, limit=None, offset=None, time_cookie=None, nick=None):
+        """Iterate over the (public) identities matching all the specified filters, in storage order.
+        
+        Limit, offset and time cookie are as for find_messages. The nick (str) is matched 
+        case insensitively as a substring of the nick of the identity.
+        """
+
+        self._check_filters(limit, offset, [], [nick])
+
+        conditions, params = self._cookie_condition(time_cookie)
+
+        if nick is not None:
+            conditions.append("nick LIKE ? ESCAPE '\\'")
+            params.append(self._like_pattern(nick))
+
+        sql = "SELECT fingerprint, dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e, rowid FROM identities"
+        return self._iterate_rows(sql, conditions, params, limit, offset, self._row2identity)
+
+    def _connect(self, **kwargs):
+        """Open a new connection (sqlite3.connect arguments) with the pragmas applied"""
+
+        conn = sqlite3.connect(self._db_file, factory=_Connection, **kwargs)
+        for name, value in self._pragmas.items():
+            conn.execute("PRAGMA {0}={1}".format(name, value))
+        self._attach_partitions(conn)
+        return conn
+
+    def _write(self, write):
+        """Run write(cursor) in a transaction in the writer thread and wait for it. Return the result."""
+        return self._writer.execute(write).result()
+
+    def _attach_partitions(self, conn):
+        """Make the current message partitions (if any) available on the connection"""
+
+        if self._partitions is not None:
+            self._partitions.attach(conn)
+
+    def _prepare_write(self, conn):
+        """Get the writer connection up to date with the message partitions"""
+
+        if self._partitions is not None:
+            self._partitions.merge_evicted(conn)
+            self._partitions.attach(conn)
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Context for read only queries, providing a cursor.
+        
+        A read connection is taken from a small pool of idle connections (or 
+        opened) for the outermost context of the calling thread and returned 
+        when it ends. All queries in the context see the same snapshot of the 
+        data base, even if content is added concurrently.
+        """
 
-            if fingerprints is not None:
-                ids = [id for id in ids if id.fingerprint in fingerprints]
+        conn = getattr(self._readers, 'conn', None)
+        if conn is not None: # Nested
+            yield conn.cursor()
+            return
 
-            return (current_tc, ids)
+        with self._reader_lock:
+            conn = self._idle_readers.pop() if self._idle_readers else None
+
+        if conn is None:
+            conn = self._connect(isolation_level=None, check_same_thread=False)
+
+        self._readers.conn = conn
+        try:
+            self._attach_partitions(conn)
+
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
+                yield c
+            finally:
+                c.execute("COMMIT")
+        finally:
+            self._readers.conn = None
+            self._release_reader(conn)
+
+    def _release_reader(self, conn):
+        """Return a read connection to the pool (or close it if the pool is full or closed)"""
+
+        with self._reader_lock:
+            if not self._closed and len(self._idle_readers) < self._MAX_IDLE_READERS:
+                self._idle_readers.append(conn)
+                return
+
+        conn.close()
 
     def _create_tables(self, cursor):
         """Create the tables if they don't exist"""
@@ -522,6 +1871,16 @@ class ContentDB:
         cursor.execute(self._CREATE_TABLE_IDENTITIES)
         cursor.execute(self._CREATE_TABLE_PRIVATE_IDENTITIES)
         cursor.execute(self._CREATE_TABLE_MESSAGES)
+        cursor.execute(self._CREATE_TABLE_INBOX)
+        cursor.execute(self._CREATE_TABLE_MESSAGE_PARTITIONS)
+
+        for sql_statement in self._CREATE_MESSAGE_INDEXES:
+            cursor.execute(sql_statement.format('main'))
+        for sql_statement in self._CREATE_INDEXES:
+            cursor.execute(sql_statement)
+
+        self._create_counts(cursor, 'main', 'messages')
+        self._create_counts(cursor, 'main', 'identities')
 
         """Initialize DB (add current db fingerprint and first time cookie)"""
         if cursor.execute("""SELECT count(*) FROM databases WHERE fingerprint=(?)""", (self._encoded_id,)).fetchone()[0] == 0:
@@ -531,6 +1890,239 @@ class ContentDB:
             cursor.execute("""INSERT INTO time_cookies (cookie) VALUES (?)""",
                            (self._encode_id(self._generate_random_tc_id()),))
 
+    def _create_counts(self, cursor, schema, table):
+        """Create the row count (and triggers) for the table if they don't exist"""
+
+        for sql_statement in self._CREATE_COUNTS:
+            cursor.execute(sql_statement.format(schema, table))
+
+    def _load_ids(self, sql_statement, c=None):
+        """Read and decode a column of ids"""
+
+        if c is None:
+            with self._reading() as c:
+                return self._load_ids(sql_statement, c)
+
+        return [self._decode_id(row[0]) for row in c.execute(sql_statement)]
+
+    def _missing_ids(self, content_filter, sql_statement, ids):
+        """Return the ids not in the data base. 
+        
+        The filter answers for the definitely missing ids, the rest are looked up 
+        with the sql statement (taking a list of encoded ids).
+        """
+
+        if ids is None or not hasattr(ids, '__iter__'):
+            raise TypeError
+
+        ids = list(ids)
+        if not all(isinstance(id, bytes) for id in ids):
+            raise TypeError
+
+        candidates = [self._encode_id(id) for id in ids if content_filter.might_contain(id)]
+
+        present = set()
+        with self._reading() as c:
+            for i in range(0, len(candidates), self._MAX_QUERY_PARAMETERS):
+                chunk = candidates[i:i + self._MAX_QUERY_PARAMETERS]
+                c.execute(sql_statement.format(','.join('?' * len(chunk))), chunk)
+                present.update(self._decode_id(row[0]) for row in c.fetchall())
+
+        return [id for id in ids if id not in present]
+
+    def _check_time_cookie(self, c, time_cookie):
+        """Raise the appropriate exception unless the time cookie (bytes) is known to the data base."""
+
+        if not isinstance(time_cookie, bytes):
+            raise TypeError
+        if len(time_cookie) == 0:
+            raise ValueError
+
+        if c.execute("SELECT count(*) FROM time_cookies WHERE cookie = ?",
+                     (self._encode_id(time_cookie),)).fetchone()[0] == 0:
+            raise ValueError
+
+    def _select_messages(self, c, time_cookie=None, encoded_msgids=None):
+        """Select the message rows (msgid first, rowid last) added after the time 
+        cookie and/or with one of the encoded message ids.
+        """
+
+        sql = ["""SELECT msgid, msg, timestamp, receiver, sender, signature, rowid FROM messages"""]
+        conditions, params = [], []
+
+        if time_cookie is not None:
+            conditions.append("""cookieid > (SELECT id FROM time_cookies WHERE cookie = ?)""")
+            params.append(self._encode_id(time_cookie))
+
+        if encoded_msgids is not None:
+            conditions.append("""msgid IN ({0})""".format(','.join('?' * len(encoded_msgids))))
+            params.extend(encoded_msgids)
+
+        if conditions:
+            sql.extend(["WHERE", " AND ".join(conditions)])
+
+        sql.append("ORDER BY rowid") # Storage order
+
+        return c.execute(" ".join(sql), params).fetchall()
+
+    def _select_identities(self, c, time_cookie=None, encoded_fingerprints=None):
+        """Select the identity rows (fingerprint first, rowid last) added after the 
+        time cookie and/or with one of the encoded fingerprints.
+        """
+
+        sql = ["""SELECT fingerprint, dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e, rowid FROM identities"""]
+        conditions, params = [], []
+
+        if time_cookie is not None:
+            conditions.append("""cookieid > (SELECT id FROM time_cookies WHERE cookie = ?)""")
+            params.append(self._encode_id(time_cookie))
+
+        if encoded_fingerprints is not None:
+            conditions.append("""fingerprint IN ({0})""".format(','.join('?' * len(encoded_fingerprints))))
+            params.extend(encoded_fingerprints)
+
+        if conditions:
+            sql.extend(["WHERE", " AND ".join(conditions)])
+
+        sql.append("ORDER BY rowid") # Storage order
+
+        return c.execute(" ".join(sql), params).fetchall()
+
+    def _select_chunks(self, select, c, time_cookie, encoded_ids):
+        """Select the rows for the encoded ids with select (see _select_messages) in 
+        chunks that fit in a query. The rows of all chunks are merged in storage order.
+        """
+
+        rows = {}
+        for i in range(0, len(encoded_ids), self._MAX_QUERY_PARAMETERS):
+            for row in select(c, time_cookie, encoded_ids[i:i + self._MAX_QUERY_PARAMETERS]):
+                rows[row[-1]] = row
+
+        return [rows[rowid] for rowid in sorted(rows)]
+
+    def _decrypt_inbox(self):
+        """Decrypt the new messages to the private identities and store the plaintexts"""
+
+        with self._reading() as c:
+            rows = c.execute(self._QUERY_GET_UNDECRYPTED_INBOX).fetchall()
+
+        if not rows:
+            return
+
+        identities = {}
+        plaintexts = []
+        for msgid, ciphertext, receiver in rows:
+            if receiver not in identities:
+                try:
+                    identities[receiver] = self.get_private_identity(self._decode_id(receiver))
+                except ValueError: # Removed since the query
+                    identities[receiver] = None
+
+            if identities[receiver] is None:
+                continue
+
+            try:
+                plaintexts.append((msgid, identities[receiver].decrypt(ciphertext)))
+            except Exception: # Corrupt or not for this key; try again next time
+                continue
+
+        self._write(lambda c: c.executemany(self._QUERY_ADD_INBOX, plaintexts))
+
+    def _query_messages(self, sql_statement, fingerprint, limit):
+        """Get the messages selected by a query taking an identity fingerprint and a limit"""
+
+        if fingerprint is None or not isinstance(fingerprint, bytes):
+            raise TypeError
+
+        if not len(fingerprint) > 0:
+            raise ValueError
+
+        if limit is None:
+            limit = -1 # No limit
+        else:
+            self._check_limit(limit)
+
+        return self._query_rows(sql_statement, (self._encode_id(fingerprint), limit))
+
+    def _cookie_condition(self, time_cookie):
+        """The find_* condition and parameters (lists) selecting content added after the time cookie (if specified)"""
+
+        if time_cookie is None:
+            return ([], [])
+
+        with self._reading() as c:
+            self._check_time_cookie(c, time_cookie)
+
+        return (["cookieid > (SELECT id FROM time_cookies WHERE cookie = ?)"], [self._encode_id(time_cookie)])
+
+    def _like_pattern(self, term):
+        """A LIKE pattern matching the term anywhere (escaped with backslash)"""
+
+        for c in '\\%_':
+            term = term.replace(c, '\\' + c)
+        return '%' + term + '%'
+
+    def _iterate_rows(self, sql, conditions, params, limit, offset, row2content):
+        """Build the find_* query (selecting the rowid last) and return an iterator over 
+        the content of the selected rows.
+        
+        Every batch is read in a read context of its own, continuing after the last 
+        rowid of the previous batch, so that an iterator being consumed neither holds 
+        on to an old snapshot of the data base nor blocks the WAL checkpoints.
+        """
+
+        def query(after):
+            where = conditions + ([] if after is None else ["rowid > ?"])
+            return " ".join([sql] + (["WHERE", " AND ".join(where)] if where else []) + 
+                            ["ORDER BY rowid LIMIT ? OFFSET ?"]) # Storage order
+
+        def rows():
+            after, skip, remaining = None, offset or 0, limit
+            while remaining is None or remaining > 0:
+                size = self._FETCH_SIZE if remaining is None else min(remaining, self._FETCH_SIZE)
+                with self._reading() as c:
+                    batch = c.execute(query(after), params + ([] if after is None else [after]) + [size, skip]).fetchall()
+
+                for row in batch:
+                    yield row2content(row)
+
+                if len(batch) < size:
+                    return
+
+                after, skip = batch[-1][-1], 0
+                if remaining is not None:
+                    remaining -= len(batch)
+
+        return rows()
+
+    def _query_rows(self, sql_statement, params):
+        """Get the messages for the message rows selected by the query"""
+
+        with self._reading() as c:
+            return [self._row2message(row) for row in c.execute(sql_statement, params)]
+
+    def _row2message(self, row):
+        """Restore a message from a message row (msgid first)"""
+
+        return restore(self._decode_id(row[0]),
+                       row[1],
+                       row[2],
+                       None if row[3] is None else self._decode_id(row[3]),
+                       None if row[4] is None else self._decode_id(row[4]),
+                       None if row[5] is None else self._decode_id(row[5]))
+
+    def _row2identity(self, row):
+        """Get the (public) identity for an identity row from the cache or decode and cache it."""
+
+        identity = self._identity_cache.get(row[0])
+
+        if identity is None:
+            dsa_y, dsa_g, dsa_p, dsa_q, rsa_n, rsa_e = decode_b64_int_list(row[1:7])
+            identity = Identity(DSA_key(dsa_y, dsa_g, dsa_p, dsa_q), RSA_key(rsa_n, rsa_e))
+            self._identity_cache.put(row[0], identity)
+
+        return identity
+
     def _insert_new_tc(self, c):
         """Create a new time cookie and insert it in the database. Return the time cookie."""
 
@@ -558,44 +2150,80 @@ class ContentDB:
             row = dbcursor.execute("SELECT cookie FROM remote_time_cookies JOIN databases ON remote_time_cookies.dbid = databases.id WHERE databases.fingerprint = ?", (self._encode_id(dbfp),)).fetchone()
             return None if row is None else self._decode_id(row[0])
 
-    def _add_content(self, sql_count_statement, sql_insert_statement, content_list):
-        """Add a a list of messages to the data base.
-        
-        Will add all messages, not already in the data base to the data base and return a 
-        time cookie (bytes) that represents the point in time after the messages have been added.
-        If no messages were added, it just returns the current time cookie. 
-        """
-
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
-
-            tcid = self._insert_new_tc(c)
-
-            pre_msgs = c.execute(sql_count_statement).fetchone()[0] # Count before insert
-
-            try:
-                for content in content_list:
-                    c.execute(sql_insert_statement, content + (tcid,))
-            except AttributeError: # Typically caused by types other than content in list
-                raise TypeError
-
-            post_msgs = c.execute(sql_count_statement).fetchone()[0] # Count after insert
-
-            """No new messages? Rollback tc insert and use old value"""
-            if (post_msgs - pre_msgs) == 0:
-                conn.rollback()
-
-            return self._get_last_time_cookie(c)
+    def _submit_messages(self, msgs):
+        """Queue messages for the writer. Return the Future."""
+
+        msgs = self._check_content(msgs, Message)
+        rows = [(self._encode_id(m.id), m.text, m.timestamp,
+                 None if not m.has_receiver else self._encode_id(m.receiver),
+                 None if not m.has_sender else self._encode_id(m.sender),
+                 None if not m.has_sender else self._encode_id(m.signature)) for m in msgs]
+
+        sql_insert_statement = self._QUERY_ADD_MESSAGES
+        if self._partitions is not None:
+            self._partitions.add([m.timestamp for m in msgs], int(time.time()))
+            sql_insert_statement = self._partitions.insert_statement
+
+        def on_commit(tc, inserted):
+            added = [msgs[i] for i in inserted]
+            self._message_filter.added([m.id for m in added])
+            self._content_added("message", added, tc)
+
+        return self._writer.submit(sql_insert_statement, rows, on_commit)
+
+    def _submit_identities(self, identities):
+        """Queue identities for the writer. Return the Future."""
+
+        identities = self._check_content(identities, Identity)
+        rows = [(self._encode_id(id.fingerprint),
+                 encode_b64_int(id.dsa_key.y),
+                 encode_b64_int(id.dsa_key.g),
+                 encode_b64_int(id.dsa_key.p),
+                 encode_b64_int(id.dsa_key.q),
+                 encode_b64_int(id.rsa_key.n),
+                 encode_b64_int(id.rsa_key.e),
+                 None) for id in identities]
+
+        def on_commit(tc, inserted):
+            added = [identities[i] for i in inserted]
+            self._identity_filter.added([id.fingerprint for id in added])
+            self._content_added("identity", added, tc)
+
+        return self._writer.submit(self._QUERY_ADD_IDENTITIES, rows, on_commit)
+
+    def _remove_message_ids(self, msgids):
+        """Remove the messages with the encoded ids"""
+
+        def write(c):
+            c.executemany(self._QUERY_REMOVE_SPECIFIC_INBOX, [(id,) for id in msgids])
+            for schema in c.connection.schemas:
+                c.executemany(self._QUERY_REMOVE_SPECIFIC_MESSAGES.format(schema), [(id,) for id in msgids])
+
+        self._write(write)
+        self._message_filter.removed(len(msgids))
+
+    def _get_message_count(self, c):
+        return sum(c.execute(self._QUERY_GET_COUNT.format(schema), ('messages',)).fetchone()[0]
+                   for schema in c.connection.schemas)
+
+    def _used_bytes(self, c):
+        used = 0
+        for schema in c.connection.schemas:
+            page_size = c.execute("PRAGMA {0}.page_size".format(schema)).fetchone()[0]
+            page_count = c.execute("PRAGMA {0}.page_count".format(schema)).fetchone()[0]
+            free_count = c.execute("PRAGMA {0}.freelist_count".format(schema)).fetchone()[0]
+            used += (page_count - free_count) * page_size
+        return used
 
     def _remove_content(self, sql_statement, ids=None):
         if ids is not None and not hasattr(ids, '__iter__'):
             raise TypeError
 
-        with sqlite3.connect(self._db_file) as conn:
-            c = conn.cursor()
-
+        def write(c):
             if ids is None:
                 c.execute(sql_statement)
             else:
                 c.executemany(sql_statement, [(id,) for id in ids])
 
+        self._write(write)
+
@@ -19,126 +19,111 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 
 import threading
 import datetime
-import time
-import pybonjour
 import select, socket
 import random
 
+import dandelion.mdns
 from dandelion.service import Service
 
+pybonjour = None # Imported when the discoverer is started (it loads the native dns_sd library)
+
+def _import_pybonjour():
+    global pybonjour
+    if pybonjour is None:
+        import pybonjour as module
+        pybonjour = module
+
 class DiscovererException(Exception):
     '''Exception from operations on the Discoverer'''
 
 class DuplicateNodeException(DiscovererException):
     '''Exception raised when trying to add already exisiting node.'''
 
-class Discoverer(Service):
-    REGTYPE = "_dandelion._tcp"
-    """The discoverer finds and keeps track of the status of known nodes."""
-
-    def __init__(self, config, server_config):
-        self._config = config
-        self._server_config = server_config
-        self._nodes = [{'ip' : ip, 'port' : port, 'pin' : True, 'last_sync' : None, 'processing' : False } for ip, port in config.extra_servers]
-        self._running = False
-        self._stop_requested = True
-        self._register_fd = None
-        self._thread = None
-        self._listen_fds = []
+class DiscoveryBackend:
+    """A way of advertising the own node and finding others (see Discoverer)."""
 
-    def add_node(self, ip, port=1337, pin=False, last_sync=None):
-        """Explicitly add a new node to the list of known nodes.
+    def open(self, regtype, port, found):
+        """Start advertising the service type regtype (str) on port (int) and browsing for other nodes.
         
-        A pin:ed node will never be automatically removed by the Discoverer.
+        The callable found(ip, port) is called (from process) for each node found.
         """
-        self._validate_node(ip, port)
-        with threading.Lock():
-            if self._contains_node(ip, port):
-                raise DuplicateNodeException()
-            self._nodes.append({ 'ip' : ip, 'port' : port, 'pin' : pin, 'last_sync' : last_sync, 'processing' : False })
 
-    def remove_node(self, ip, port=1337):
-        """Explicitly remove a new node to the list of known nodes.
-        
-        This will remove a node even if it is pinned.  
-        """
-        self._validate_node(ip, port)
-        with threading.Lock():
-            if not self._contains_node(ip, port):
-                raise DiscovererException()
-            self._remove_node(ip, port)
+    def process(self, timeout):
+        """Handle the pending discovery traffic, waiting for it at most timeout seconds (float)."""
 
-    def contains_node(self, ip, port=1337):
-        """Check if the Discoverer knows of a specific node."""
-        self._validate_node(ip, port)
-        with threading.Lock():
-            return self._contains_node(ip, port)
+    def close(self):
+        """Stop advertising and browsing."""
 
+def create_backend(name):
+    """Create the discovery backend with the name (str) 'mdns' or 'bonjour'."""
 
-    def acquire_node(self):
-        """Request an available node and raise an exception if there are none."""
+    if name == 'mdns':
+        return MulticastDNSBackend()
+    elif name == 'bonjour':
+        return BonjourBackend()
+    else:
+        raise ValueError
 
-        with threading.Lock():
-            resting_nodes = [n for n in self._nodes if not n['processing']]
+def _node_name():
+    return 'dandelionnode_' + ''.join([str(int(random.random() * 9)) for _ in range(8)])
 
-            if len(resting_nodes) == 0: # Do we have any nodes to sync with? 
-                raise DiscovererException()
+class MulticastDNSBackend(DiscoveryBackend):
+    """Discovery with the pure Python multicast DNS implementation."""
 
-            # Sync with the oldest one first
-            resting_nodes.sort(key=lambda x: x['last_sync'] if x['last_sync'] is not None else datetime.datetime.min)
-            next_node = resting_nodes[0]
-            next_node['processing'] = True
+    def __init__(self, interface='0.0.0.0', address=None, mdns_port=dandelion.mdns.MDNS_PORT):
+        self._interface = interface
+        self._address = address
+        self._mdns_port = mdns_port
+        self._agent = None
 
-            return (next_node['ip'], next_node['port'])
+    def open(self, regtype, port, found):
+        self._agent = dandelion.mdns.ServiceAgent(regtype, _node_name(), port, found, 
+                                                  interface=self._interface, 
+                                                  address=self._address, 
+                                                  mdns_port=self._mdns_port)
+        self._agent.open()
 
-    def release_node(self, ip, port, successful_sync):
-        """Return a node to the discoverer that was previously acquired."""
-        self._validate_node(ip, port)
+    def process(self, timeout):
+        self._agent.process(timeout)
 
-        if not isinstance(successful_sync, bool):
-            raise TypeError()
-
-        with threading.Lock():
-            if not self._contains_node(ip, port):
-                raise DiscovererException()
+    def close(self):
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
 
-            node = [node for node in self._nodes if node['ip'] == ip and node['port'] == port][0]
+class BonjourBackend(DiscoveryBackend):
+    """Discovery through the native dns_sd library (Bonjour or the Avahi compatibility layer)."""
 
-            if not node['processing']: # Returned node that wasn't processed!
-                raise DiscovererException()
-
-            if successful_sync:
-                node['last_sync'] = datetime.datetime.now()
-            elif not node['pin']: # No success and not pinned; drop it.
-                self._remove_node(node['ip'], node['port'])
-            else: # No success and pinned; do nothing
-                pass
+    def __init__(self):
+        _import_pybonjour()
+        self._node_name = None
+        self._register_fd = None
+        self._browse_fd = None
+        self._listen_fds = []
 
-            node['processing'] = False
+    def open(self, regtype, port, found):
+        self._regtype = regtype
+        self._port = port
+        self._found = found
 
-    def _validate_node(self, ip, port):
-        """Raise the appropriate exception if the ip or port is invalid. Otherwise do nothing."""
-        if not isinstance(ip, str) or not isinstance(port, int):
-            raise TypeError
+        self._register_service() # Start advertising self
 
-        if not 0 < port <= 65535:
-            raise ValueError
+        # Start browsing for others
+        self._browse_fd = pybonjour.DNSServiceBrowse(regtype=regtype,
+                                                     callBack=self._browse_callback)
 
-    def _remove_node(self, ip, port=1337):
-        """ 
-        Should only be executed inside a lock.
-        """
+    def process(self, timeout):
+        ready = select.select([self._browse_fd] + self._listen_fds, [], [], timeout)
+        for fd in ready[0]:
+            pybonjour.DNSServiceProcessResult(fd)
 
-        # Copy all but the one to remove
-        self._nodes = [node for node in self._nodes if not (node['ip'] == ip and node['port'] == port)]
+    def close(self):
+        self._browse_fd.close()
 
-    def _contains_node(self, ip, port):
-        """Check if the Discoverer has the ip/port in it's node list.
-        
-        Should only be executed inside a lock.
-        """
-        return len([node for node in self._nodes if node['ip'] == ip and node['port'] == port]) > 0
+        self._unregister_service() # Stop advertising self
 
+        if len(self._listen_fds) > 0:
+            raise Exception("pybonjour descriptors leaked!")
 
     def _register_callback(self, sdRef, flags, errorCode, name, regtype, domain):
         """Called when the service has been registered."""
@@ -148,11 +133,11 @@ class Discoverer(Service):
         re_tries = 2
         while True:
             try:
-                self._node_name = 'dandelionnode_' + ''.join([str(int(random.random() * 9)) for _ in range(8)])
+                self._node_name = _node_name()
                 self._register_fd = pybonjour.DNSServiceRegister(name=self._node_name,
-                                                             regtype=Discoverer.REGTYPE,
-                                                             port=self._server_config.port,
-                                                             callBack=self._register_callback)
+                                                                 regtype=self._regtype,
+                                                                 port=self._port,
+                                                                 callBack=self._register_callback)
                 return
 
             except pybonjour.BonjourError:
@@ -187,10 +172,7 @@ class Discoverer(Service):
                 return
 
             # We have an A record to a node - add it to the sync pool
-            try:
-                self.add_node(ip=socket.inet_ntoa(rdata), port=port)
-            except DuplicateNodeException:
-                pass # Node already in the sync pool
+            self._found(socket.inet_ntoa(rdata), port)
 
         query_fd = pybonjour.DNSServiceQueryRecord(interfaceIndex=interfaceIndex,
                                                    fullname=hosttarget,
@@ -213,8 +195,6 @@ class Discoverer(Service):
         if serviceName == self._node_name:
             return
 
-        self._service_registration_completed = True
-
         resolve_fd = pybonjour.DNSServiceResolve(0,
                                                  interfaceIndex,
                                                  serviceName,
@@ -224,27 +204,169 @@ class Discoverer(Service):
 
         self._listen_fds.append(resolve_fd)
 
-    def _work_loop(self):
+class Discoverer(Service):
+    REGTYPE = "_dandelion._tcp"
+    """The discoverer finds and keeps track of the status of known nodes."""
 
-        self._register_service() # Start advertising self
+    _POLL_SEC = 0.1 # How often the work loop checks for a stop request
 
-        # Start browsing for others
-        browse_fd = pybonjour.DNSServiceBrowse(regtype=Discoverer.REGTYPE,
-                                               callBack=self._browse_callback)
+    def __init__(self, config, server_config, backend=None):
+        """Create a discoverer. The backend (DiscoveryBackend) is created from the config when started, if not specified."""
+        self._config = config
+        self._server_config = server_config
+        self._backend = backend
+        self._nodes = [{'ip' : ip, 'port' : port, 'pin' : True, 'last_sync' : None, 'processing' : False,
+                        'dbid' : None, 'time_cookie' : None } for ip, port in config.extra_servers]
+        self._running = False
+        self._stop_requested = True
+        self._thread = None
+        self._lock = threading.Lock() # Guards the nodes
+
+    def add_node(self, ip, port=1337, pin=False, last_sync=None):
+        """Explicitly add a new node to the list of known nodes.
+        
+        A pin:ed node will never be automatically removed by the Discoverer.
+        """
+        self._validate_node(ip, port)
+        with self._lock:
+            if self._contains_node(ip, port):
+                raise DuplicateNodeException()
+            self._nodes.append({ 'ip' : ip, 'port' : port, 'pin' : pin, 'last_sync' : last_sync, 'processing' : False,
+                                 'dbid' : None, 'time_cookie' : None })
 
-        # Pump zeroconf messages 
-        while not self._stop_requested:
-            ready = select.select([browse_fd] + self._listen_fds, [], [], 0.1)
-            for fd in ready[0]:
-                pybonjour.DNSServiceProcessResult(fd)
-            time.sleep(0.5) # Throttle traffic slightly
+    def remove_node(self, ip, port=1337):
+        """Explicitly remove a new node to the list of known nodes.
+        
+        This will remove a node even if it is pinned.  
+        """
+        self._validate_node(ip, port)
+        with self._lock:
+            if not self._contains_node(ip, port):
+                raise DiscovererException()
+            self._remove_node(ip, port)
 
-        browse_fd.close()
+    def contains_node(self, ip, port=1337):
+        """Check if the Discoverer knows of a specific node."""
+        self._validate_node(ip, port)
+        with self._lock:
+            return self._contains_node(ip, port)
 
-        self._unregister_service() # Stop advertising self
 
-        if len(self._listen_fds) > 0:
-            raise Exception("pybonjour descriptors leaked!")
+    def announced(self, ip, port, dbid, time_cookie):
+        """Record the data base id (bytes) and current time cookie (bytes) a node announced.
+        
+        The node is added to the list of known nodes if it isn't already known.
+        """
+        self._validate_node(ip, port)
+
+        if not isinstance(dbid, bytes) or not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        with self._lock:
+            if not self._contains_node(ip, port):
+                self._nodes.append({ 'ip' : ip, 'port' : port, 'pin' : False, 'last_sync' : None, 'processing' : False })
+
+            node = [node for node in self._nodes if node['ip'] == ip and node['port'] == port][0]
+            node['dbid'] = dbid
+            node['time_cookie'] = time_cookie
+
+    def acquire_node(self, has_news=None):
+        """Request an available node and raise an exception if there are none.
+        
+        If specified, has_news(dbid, time_cookie) is called with what each node 
+        announced (None if nothing). It returns True if the node has content we 
+        haven't seen, False if it hasn't and None if it can't tell. Nodes with news 
+        are returned first and nodes without news are not returned at all.
+        """
+
+        with self._lock:
+            resting_nodes = [dict(n) for n in self._nodes if not n['processing']]
+
+        """Ask about the news without the lock, has_news may query the data base"""
+        news = {}
+        if has_news is not None:
+            for n in resting_nodes:
+                news[(n['ip'], n['port'])] = has_news(n['dbid'], n['time_cookie'])
+            resting_nodes = [n for n in resting_nodes if news[(n['ip'], n['port'])] is not False]
+
+        # Sync with the ones with news first, then the oldest one first
+        resting_nodes.sort(key=lambda x: (not news.get((x['ip'], x['port'])), 
+                                          x['last_sync'] if x['last_sync'] is not None else datetime.datetime.min))
+
+        with self._lock:
+            for n in resting_nodes:
+                """Skip the nodes removed or acquired by someone else meanwhile"""
+                nodes = [node for node in self._nodes if node['ip'] == n['ip'] and node['port'] == n['port']]
+                if nodes and not nodes[0]['processing']:
+                    nodes[0]['processing'] = True
+                    return (n['ip'], n['port'])
+
+        raise DiscovererException() # No nodes to sync with
+
+    def release_node(self, ip, port, successful_sync):
+        """Return a node to the discoverer that was previously acquired."""
+        self._validate_node(ip, port)
+
+        if not isinstance(successful_sync, bool):
+            raise TypeError()
+
+        with self._lock:
+            if not self._contains_node(ip, port):
+                raise DiscovererException()
+
+            node = [node for node in self._nodes if node['ip'] == ip and node['port'] == port][0]
+
+            if not node['processing']: # Returned node that wasn't processed!
+                raise DiscovererException()
+
+            if successful_sync:
+                node['last_sync'] = datetime.datetime.now()
+            elif not node['pin']: # No success and not pinned; drop it.
+                self._remove_node(node['ip'], node['port'])
+            else: # No success and pinned; do nothing
+                pass
+
+            node['processing'] = False
+
+    def _validate_node(self, ip, port):
+        """Raise the appropriate exception if the ip or port is invalid. Otherwise do nothing."""
+        if not isinstance(ip, str) or not isinstance(port, int):
+            raise TypeError
+
+        if not 0 < port <= 65535:
+            raise ValueError
+
+    def _remove_node(self, ip, port=1337):
+        """ 
+        Should only be executed inside a lock.
+        """
+
+        # Copy all but the one to remove
+        self._nodes = [node for node in self._nodes if not (node['ip'] == ip and node['port'] == port)]
+
+    def _contains_node(self, ip, port):
+        """Check if the Discoverer has the ip/port in it's node list.
+        
+        Should only be executed inside a lock.
+        """
+        return len([node for node in self._nodes if node['ip'] == ip and node['port'] == port]) > 0
+
+
+    def _node_found(self, ip, port):
+        """Called by the backend for each node found."""
+        try:
+            self.add_node(ip=ip, port=port)
+        except DuplicateNodeException:
+            pass # Node already in the sync pool
+
+    def _work_loop(self):
+
+        # Handle the discovery traffic as it arrives
+        try:
+            while not self._stop_requested:
+                self._backend.process(Discoverer._POLL_SEC)
+        finally:
+            self._backend.close()
 
     def start(self):
         """Start the service. Block until the service is running."""
@@ -252,6 +374,12 @@ class Discoverer(Service):
         if self._running:
             return # Starting twice is a nop
 
+        if self._backend is None:
+            self._backend = create_backend(self._config.backend)
+
+        # Opened here, so that a failure (e.g. the port in use) is raised to the caller
+        self._backend.open(Discoverer.REGTYPE, self._server_config.port, self._node_found)
+
         self._stop_requested = False
         self._thread = threading.Thread(target=self._work_loop)
         self._thread.start()
@@ -32,9 +32,14 @@ import time
 
 #import time
 from queue import Queue
+from collections import deque
 
 class GUI(tkinter.Frame):
 
+    _SCROLLBACK = 500 # Max number of messages kept in the message area
+    _HISTORY_PAGE = 100 # Number of messages loaded at a time
+    _SEARCH_CHUNK = 50 # Number of search results rendered at a time
+
     def __init__(self, config_manager, db, id, server=None, content_synchronizer=None):
 
         self._server = server
@@ -90,6 +95,7 @@ class GUI(tkinter.Frame):
 
         self.search_term_frame.grid(row=row_pos, column=1, sticky=W, padx=8, pady=8)
         self.search_term.grid(row=row_pos, column=1, sticky=W, padx=0, pady=0)
+        self.search_term.bind('<KeyRelease>', self._search_term_changed)
 
         # search message button
         self.search_messages = tkinter.Button(master,
@@ -156,7 +162,7 @@ class GUI(tkinter.Frame):
                           columnspan=3,
                           rowspan=message_area_height,
                           sticky=tkinter.N+tkinter.S+tkinter.E, padx=8, pady=8)
-        self.message_area.configure(yscrollcommand=self.yscroll.set)
+        self.message_area.configure(yscrollcommand=self._message_area_scrolled)
 
         # Id display widget
         self.id_list_frame = tkinter.Frame(master,
@@ -339,24 +345,52 @@ class GUI(tkinter.Frame):
         
     #    self._start_restart()
 
-        self._db.add_event_listener(self._message_listener)
+        self._view = None # What the message area shows (None is the welcome screen)
+        self._last_time_cookie = None
+        self._rendered_msgids = deque() # In display order
+        self._rendered_msgid_set = set() # The same, for the membership checks
+        self._oldest_cursor = None
+        self._history_exhausted = False
+        self._search_generation = 0
+        self._search_requests = Queue() # (generation, term) for the search worker
+        self._search_thread = None # Started on the first search
+        self._search_pending = deque()
+        self._search_term_shown = None
 
         self._event_queue = Queue()
 
+        self._db.add_event_listener(self._message_listener)
+
         self._check_queue()
 
         self.mainloop()
 
-    def _message_listener(self, type, msgs):
-        self._event_queue.put_nowait("newmessage")
-#        print(type, msgs)
+    def _message_listener(self, type, content, time_cookie):
+        self._event_queue.put_nowait(type)
 
     def _check_queue(self):
+        """Handle all pending content events in one go and render the next search results"""
+
+        types = set()
         while self._event_queue.qsize():
-            msg = self._event_queue.get(0)
-            self._show_messages()
+            event = self._event_queue.get(0)
+            if isinstance(event, tuple):
+                (_, generation, rows) = event
+                if generation == self._search_generation:
+                    self._search_pending.append(rows)
+            else:
+                types.add(event)
+
+        if 'message' in types and self._view in (None, 'messages'):
+            self._update_messages()
+
+        if 'identity' in types:
             self.show_identities()
-        self.master.after(100, self._check_queue)
+
+        if self._search_pending:
+            self._render_search_results(self._search_pending.popleft())
+
+        self.master.after(10 if self._search_pending else 100, self._check_queue)
 
     #def _msgloop(self):
     #    while not self._stop_requested:
@@ -428,7 +462,7 @@ class GUI(tkinter.Frame):
         if self.toLong > 140:
             self.labelToLong = ("Message too long.")
             self.processTextLen.set(self.labelToLong)
-        self._show_messages()
+        self._update_messages()
 
     def _say(self, msg, sign=None, receiver_name=None):
         print("_say %s" % (msg))
@@ -451,28 +485,117 @@ class GUI(tkinter.Frame):
             self._db.add_messages([m])
 
     def _show_messages(self):
+        """Show the latest messages, replacing the content of the message area"""
+
         message_screen = """
  Dandelion Messages
  -------------------------------------------------
 """
 
-        self.all_msgs = StringVar()
-        (current_tc, self.all_msgs) = self._db.get_messages()
+        self._view = 'messages'
+        self._cancel_search()
+        self._last_time_cookie = self._db.get_last_time_cookie()
+        self._oldest_cursor, recent = self._db.get_recent_messages(self._HISTORY_PAGE)
+
+        self._rendered_msgids.clear()
+        self._rendered_msgid_set.clear()
+        self._history_exhausted = len(recent) < self._HISTORY_PAGE
+
         self.message_area.config(state=NORMAL)
-        self.message_area.delete(1.0,END)
+        self.message_area.delete(1.0, END)
         self.message_area.insert(END, message_screen)
-        for m in self.all_msgs:
-            sender = 'anon' if not m.has_sender else encode_b64_bytes(m.sender).decode()
-            if  m.has_receiver:
-                msg = "%s to %s> %s\n" % (sender,
-                                        'N/A' if not m.has_sender else encode_b64_bytes(m.sender).decode(),
-                                        encode_b64_bytes(m.text).decode())
-            else:
-                msg = "%s> %s\n" % (sender, m.text)
-                self.message_area.insert(END, msg)
+        self.message_area.mark_set('history', END + '-1c')
+        self.message_area.mark_gravity('history', LEFT)
+        self.message_area.config(state=DISABLED)
+
+        self._append_messages(reversed(recent))
+
+    def _update_messages(self):
+        """Append the messages added since the last update to the message area"""
+
+        if self._view != 'messages':
+            self._show_messages()
+            return
+
+        self._last_time_cookie, msgs = self._db.get_messages(time_cookie=self._last_time_cookie)
+        self._append_messages(msgs)
+
+    def _append_messages(self, msgs):
+        lines = []
+        for m in msgs:
+            if m.id not in self._rendered_msgid_set:
+                self._rendered_msgids.append(m.id)
+                self._rendered_msgid_set.add(m.id)
+                lines.append(self._format_message(m))
+
+        if not lines:
+            return
+
+        follow = self.message_area.yview()[1] == 1.0
+
+        self.message_area.config(state=NORMAL)
+        self.message_area.insert(END, ''.join(lines))
+
+        # Drop the oldest messages beyond the scrollback
+        excess = len(self._rendered_msgids) - self._SCROLLBACK
+        if excess > 0:
+            for _ in range(excess):
+                self._rendered_msgid_set.discard(self._rendered_msgids.popleft())
+            self.message_area.delete('history', 'history +%d lines' % excess)
+            self._history_exhausted = False
+            self._oldest_cursor = None # Older history is reloaded from the first message shown
 
         self.message_area.config(state=DISABLED)
-        self.message_area.see(tkinter.END)
+
+        if follow:
+            self.message_area.see(END)
+
+    def _load_older_messages(self):
+        """Insert a page of older messages at the top of the message area"""
+
+        if self._view != 'messages' or self._history_exhausted:
+            return
+
+        before = self._oldest_cursor
+        if before is None and self._rendered_msgids:
+            (_, shown) = self._db.get_messages([self._rendered_msgids[0]])
+            if shown and shown[0].has_timestamp:
+                before = (shown[0].timestamp + 1, 0) # Including the ones sharing its timestamp, the shown are skipped below
+        if before is None:
+            self._history_exhausted = True
+            return
+
+        older = []
+        while not older and not self._history_exhausted: # Skip pages that are already shown
+            before, page = self._db.get_recent_messages(self._HISTORY_PAGE, before=before)
+            self._history_exhausted = len(page) < self._HISTORY_PAGE
+            older = [m for m in page if m.id not in self._rendered_msgid_set]
+
+        self._oldest_cursor = before
+        if not older:
+            return
+
+        self._rendered_msgids.extendleft(m.id for m in older)
+        self._rendered_msgid_set.update(m.id for m in older)
+
+        self.message_area.config(state=NORMAL)
+        self.message_area.insert('history', ''.join(self._format_message(m) for m in reversed(older)))
+        self.message_area.config(state=DISABLED)
+
+    def _message_area_scrolled(self, first, last):
+        self.yscroll.set(first, last)
+        if float(first) == 0.0 and float(last) < 1.0:
+            self.master.after_idle(self._load_older_messages)
+
+    def _format_message(self, m):
+        sender = 'anon' if not m.has_sender else encode_b64_bytes(m.sender).decode()
+        if m.has_receiver:
+            msg = "%s to %s> %s" % (sender,
+                                    encode_b64_bytes(m.receiver).decode(),
+                                    encode_b64_bytes(m.text).decode())
+        else:
+            msg = "%s> %s" % (sender, m.text)
+        return sub("\n", " ", msg) + "\n"
 
     def _help(self):
         help_screen = """
@@ -480,6 +603,8 @@ class GUI(tkinter.Frame):
  -------------------------------------------------
  * Help
         """
+        self._view = 'help'
+        self._cancel_search()
         self.message_area.config(state=NORMAL)
         self.message_area.delete(1.0,END)
         self.message_area.insert(END, help_screen)
@@ -562,21 +687,79 @@ class GUI(tkinter.Frame):
         self.save_nickname.config(state=DISABLED)
 
     def _search_messages(self):
+        """Start a search on a worker thread, superseding any search in progress"""
+
         search_screen = """
  Dandelion Search:  """
+
+        term = self.search_term.get(1.0, END).strip()
+
+        self._view = 'search'
+        self._cancel_search()
+        self._search_term_shown = term
+
         self.message_area.config(state=NORMAL)
         self.message_area.delete(1.0,END)
         self.message_area.insert(END, search_screen)
-        term = self.search_term.get(1.0, END)
-        self.message_area.insert(END, term)
+        self.message_area.insert(END, term + "\n")
         self.message_area.insert(END, " ------------------------------------------------- \n")
-        self.message_area.insert(END, " ")
-        result = self._db.search_messages(term) # needs FIX
-        for row in result:
-            self.message_area.insert(END, row)
-        self.message_area.insert(END, " ------------------------------------------------- \n")
-        self.message_area.insert(END, " Result for: ")
-        self.message_area.insert(END, term)
+        self.message_area.config(state=DISABLED)
+
+        if self._search_thread is None:
+            self._search_thread = threading.Thread(target=self._search_worker)
+            self._search_thread.daemon = True
+            self._search_thread.start()
+
+        self._search_requests.put_nowait((self._search_generation, term))
+
+    def _search_worker(self):
+        """Run the requested searches, one at a time, and pass the results to the Tk 
+        thread in chunks (None marks the end).
+        
+        The messages are read a batch at a time, so a superseded search is 
+        abandoned instead of scanning to the end.
+        """
+
+        while True:
+            generation, term = self._search_requests.get()
+            if generation != self._search_generation:
+                continue # Superseded before it started
+
+            chunk = []
+            try:
+                for m in self._db.find_messages(text=term):
+                    if generation != self._search_generation:
+                        break # Superseded
+                    chunk.append((m.text,))
+                    if len(chunk) == self._SEARCH_CHUNK:
+                        self._event_queue.put_nowait(('search', generation, chunk))
+                        chunk = []
+                else:
+                    if chunk:
+                        self._event_queue.put_nowait(('search', generation, chunk))
+                    self._event_queue.put_nowait(('search', generation, None))
+            except sqlite3.Error:
+                self._event_queue.put_nowait(('search', generation, None))
+
+    def _search_term_changed(self, *event):
+        """Cancel the search in progress when the term no longer matches the one shown"""
+
+        if self._search_term_shown is not None and self.search_term.get(1.0, END).strip() != self._search_term_shown:
+            self._cancel_search()
+
+    def _cancel_search(self):
+        self._search_generation += 1
+        self._search_pending.clear()
+        self._search_term_shown = None
+
+    def _render_search_results(self, rows):
+        self.message_area.config(state=NORMAL)
+        if rows is None:
+            self.message_area.insert(END, " ------------------------------------------------- \n")
+            self.message_area.insert(END, " Result for: ")
+            self.message_area.insert(END, self._search_term_shown)
+        else:
+            self.message_area.insert(END, ''.join(" %s\n" % sub("\n", " ", str(row[0])) for row in rows))
         self.message_area.config(state=DISABLED)
 
     def save_list(self):
@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from dandelion.util import encode_int, encode_b64_bytes
+from dandelion.util import encode_int_list, encode_b64_bytes
 import hashlib
 import random
 
@@ -29,6 +29,8 @@ class IdentityManager:
 class RSA_key:
     """Encryption key for the RSA crypto"""
 
+    __slots__ = ('_n', '_e', '_d')
+
     def __init__(self, n, e, d=None):
         """Create an RSA key. 
 
@@ -70,6 +72,8 @@ class RSA_key:
 class DSA_key:
     """Signing key for the DSA signature"""
 
+    __slots__ = ('_y', '_g', '_p', '_q', '_x')
+
     def __init__(self, y, g, p, q, x=None):
         """Create a DSA signature key."""
 
@@ -121,6 +125,8 @@ class DSA_key:
 class Identity:
     """A class that represents the public identity of a node in the network"""
 
+    __slots__ = ('_dsa_key', '_rsa_key', '_fp')
+
     _FINGERPRINT_LENGTH_BYTES = 12
 
     def __init__(self, dsa_key, rsa_key):
@@ -137,12 +143,11 @@ class Identity:
         A bytes string that is a hash of the public components of the keys.
         """
         if self._fp is None: # Lazy hashing
-            h = hashlib.sha256()
-            h.update(encode_int(self._rsa_key.n))
-            h.update(encode_int(self._rsa_key.e))
-            h.update(encode_int(self._dsa_key.y))
-            h.update(encode_int(self._dsa_key.g))
-            h.update(encode_int(self._dsa_key.p))
+            h = hashlib.sha256(b''.join(encode_int_list([self._rsa_key.n,
+                                                         self._rsa_key.e,
+                                                         self._dsa_key.y,
+                                                         self._dsa_key.g,
+                                                         self._dsa_key.p])))
             self._fp = h.digest()[-Identity._FINGERPRINT_LENGTH_BYTES:]
 
         return self._fp
@@ -191,6 +196,8 @@ class Identity:
 class PrivateIdentity(Identity):
     """A class that represents the private identity of a node in the network"""
 
+    __slots__ = ()
+
     def __init__(self, dsa_key, rsa_key):
         """Create a new identity instance from the private keys."""
         super().__init__(dsa_key, rsa_key)
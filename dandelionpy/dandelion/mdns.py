@@ -0,0 +1,392 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Multicast DNS service discovery (RFC 6762 and RFC 6763) in pure Python.
+
+Only what the Discoverer needs is implemented: advertising a single service 
+instance (PTR, SRV, TXT and A records) and browsing the local link for the 
+other instances of the same service type. Nothing but the standard library 
+is needed, so it works on hosts without Bonjour or Avahi.
+"""
+
+import selectors
+import socket
+import struct
+import time
+
+class MDNSError(Exception):
+    '''Exception for malformed mDNS packets'''
+
+MDNS_GROUP = '224.0.0.251'
+MDNS_PORT = 5353
+
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_SRV = 33
+TYPE_ANY = 255
+
+_CLASS_IN = 1
+_CLASS_MASK = 0x7fff # The top bit is cache flush (records) or unicast response (questions)
+_CACHE_FLUSH = 0x8000
+
+_FLAGS_QUERY = 0x0000
+_FLAGS_RESPONSE = 0x8400 # Authoritative answer
+
+_HEADER = struct.Struct('>HHHHHH') # Id, flags, question, answer, authority and additional counts
+_QUESTION = struct.Struct('>HH') # Type, class
+_RECORD = struct.Struct('>HHIH') # Type, class, ttl, data length
+_SRV = struct.Struct('>HHH') # Priority, weight, port
+
+_TTL = 120
+_MAX_POINTERS = 32 # Name compression pointers followed before giving up
+_MAX_PACKET = 9000
+
+def encode_name(name):
+    """Encode a dotted name (str) in DNS label format (bytes)"""
+
+    labels = [label.encode() for label in name.split('.') if label]
+    if any(len(label) > 63 for label in labels):
+        raise ValueError
+
+    return b''.join(bytes([len(label)]) + label for label in labels) + b'\x00'
+
+def decode_name(data, offset):
+    """Decode the (possibly compressed) name at offset in the packet. Return the name (str) and the offset after it."""
+
+    labels = []
+    end = None
+    for _ in range(_MAX_POINTERS):
+        if offset >= len(data):
+            raise MDNSError
+
+        length = data[offset]
+        if length & 0xc0 == 0xc0: # Pointer
+            if offset + 2 > len(data):
+                raise MDNSError
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+        elif length == 0:
+            return ('.'.join(labels), offset + 1 if end is None else end)
+        else:
+            label = data[offset + 1:offset + 1 + length]
+            if len(label) != length:
+                raise MDNSError
+            labels.append(label.decode(errors='replace'))
+            offset += 1 + length
+
+    raise MDNSError # Pointer loop
+
+def encode_packet(questions=(), answers=(), additionals=(), response=False):
+    """Encode an mDNS packet (bytes).
+    
+    Questions are (name, type) pairs and records are (name, type, ttl, value) 
+    tuples, where the value is an address (str) for A, a name (str) for PTR, 
+    a (port, target name) pair for SRV and the raw data (bytes) for TXT.
+    """
+
+    packet = [_HEADER.pack(0, _FLAGS_RESPONSE if response else _FLAGS_QUERY, 
+                           len(questions), len(answers), 0, len(additionals))]
+
+    for name, type in questions:
+        packet.append(encode_name(name) + _QUESTION.pack(type, _CLASS_IN))
+
+    for name, type, ttl, value in list(answers) + list(additionals):
+        rdata = _encode_rdata(type, value)
+        rclass = _CLASS_IN if type == TYPE_PTR else _CLASS_IN | _CACHE_FLUSH # Only PTR records are shared
+        packet.append(encode_name(name) + _RECORD.pack(type, rclass, ttl, len(rdata)) + rdata)
+
+    return b''.join(packet)
+
+def decode_packet(data):
+    """Decode an mDNS packet. Return (response, questions, records).
+    
+    Response is True for responses, the questions and records are as for 
+    encode_packet (answer, authority and additional records all included). 
+    Records of other types or classes are skipped.
+    """
+
+    if len(data) < _HEADER.size:
+        raise MDNSError
+
+    _, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+
+    questions = []
+    for _ in range(qdcount):
+        name, offset = decode_name(data, offset)
+        if offset + _QUESTION.size > len(data):
+            raise MDNSError
+        type, qclass = _QUESTION.unpack_from(data, offset)
+        offset += _QUESTION.size
+        if qclass & _CLASS_MASK == _CLASS_IN:
+            questions.append((name.lower(), type))
+
+    records = []
+    for _ in range(ancount + nscount + arcount):
+        name, offset = decode_name(data, offset)
+        if offset + _RECORD.size > len(data):
+            raise MDNSError
+        type, rclass, ttl, length = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        if offset + length > len(data):
+            raise MDNSError
+
+        if rclass & _CLASS_MASK == _CLASS_IN and type in (TYPE_A, TYPE_PTR, TYPE_SRV, TYPE_TXT):
+            records.append((name.lower(), type, ttl, _decode_rdata(type, data, offset, length)))
+        offset += length
+
+    return (bool(flags & 0x8000), questions, records)
+
+def _encode_rdata(type, value):
+    if type == TYPE_A:
+        return socket.inet_aton(value)
+    elif type == TYPE_PTR:
+        return encode_name(value)
+    elif type == TYPE_SRV:
+        port, target = value
+        return _SRV.pack(0, 0, port) + encode_name(target)
+    elif type == TYPE_TXT:
+        return value if value else b'\x00' # An empty TXT record holds one empty string
+    else:
+        raise ValueError
+
+def _decode_rdata(type, data, offset, length):
+    if type == TYPE_A:
+        if length != 4:
+            raise MDNSError
+        return socket.inet_ntoa(data[offset:offset + 4])
+    elif type == TYPE_PTR:
+        return decode_name(data, offset)[0].lower()
+    elif type == TYPE_SRV:
+        if length < _SRV.size:
+            raise MDNSError
+        _, _, port = _SRV.unpack_from(data, offset)
+        return (port, decode_name(data, offset + _SRV.size)[0].lower())
+    else:
+        return data[offset:offset + length]
+
+def default_address():
+    """The address of the interface used for multicast (str), the loopback address if there is none"""
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((MDNS_GROUP, MDNS_PORT)) # Selects the interface, nothing is sent
+        return s.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        s.close()
+
+class ServiceAgent:
+    """Advertises a service instance and browses for the other instances of its type.
+    
+    The agent is driven by calling process, which waits for packets (at most 
+    the timeout) and handles them as soon as they arrive. Queries for the 
+    service are repeated at doubling intervals, as recommended by RFC 6762.
+    """
+
+    FIRST_QUERY_INTERVAL = 1.0
+    MAX_QUERY_INTERVAL = 60.0
+    MAX_PENDING = 64 # Other instances being resolved at a time
+
+    def __init__(self, regtype, name, port, found, interface='0.0.0.0', address=None, mdns_port=MDNS_PORT):
+        """Create an agent for the instance name (str) of the service type regtype (e.g. '_dandelion._tcp')
+        listening on port (int). The callable found(ip, port) is called for each other instance found.
+        
+        The interface (str) is the address of the interface to use (all if '0.0.0.0') and 
+        address (str) the one advertised for the instance (the interface address by default).
+        """
+
+        self._service = (regtype + '.local').lower()
+        self._instance = (name + '.' + self._service).lower()
+        self._host = (name + '.local').lower()
+        self._port = port
+        self._found = found
+        self._interface = interface
+        self._mdns_port = mdns_port
+
+        if address is None:
+            address = interface if interface != '0.0.0.0' else default_address()
+        self._address = address
+
+        self._sock = None
+        self._selector = None
+        self._pending = {} # Names of the other instances still to be resolved -> when their PTR record expires
+        self._next_query = None
+        self._query_interval = ServiceAgent.FIRST_QUERY_INTERVAL
+        self._next_announcement = None
+
+    @property
+    def instance(self):
+        """The full name of the advertised instance (str)"""
+        return self._instance
+
+    def open(self):
+        """Start advertising and browsing."""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'): # Share the port with Bonjour/Avahi and other nodes
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self._mdns_port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(MDNS_GROUP) + socket.inet_aton(self._interface))
+            if self._interface != '0.0.0.0':
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self._interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # Other nodes on this host
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+
+        self._sock = sock
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+
+        self._announce()
+        self._query()
+        self._next_announcement = time.monotonic() + ServiceAgent.FIRST_QUERY_INTERVAL # Announce twice
+
+    def process(self, timeout):
+        """Handle the packets that arrive within timeout seconds (float) and send the queries due."""
+
+        now = time.monotonic()
+        wait = min(timeout, max(0, self._next_timer() - now))
+
+        if self._selector.select(wait):
+            while True:
+                try:
+                    data, addr = self._sock.recvfrom(_MAX_PACKET)
+                except (BlockingIOError, InterruptedError):
+                    break
+                self._handle(data, addr)
+
+        now = time.monotonic()
+        if self._next_announcement is not None and now >= self._next_announcement:
+            self._next_announcement = None
+            self._announce()
+        if now >= self._next_query:
+            self._query()
+
+    def close(self):
+        """Withdraw the advertisement (goodbye packet) and stop."""
+
+        if self._sock is None:
+            return
+
+        self._send(encode_packet(answers=self._instance_records(ttl=0), response=True))
+        self._selector.close()
+        self._sock.close()
+        self._selector = None
+        self._sock = None
+
+    def _next_timer(self):
+        if self._next_announcement is None:
+            return self._next_query
+        return min(self._next_query, self._next_announcement)
+
+    def _announce(self):
+        self._send(encode_packet(answers=self._instance_records(), response=True))
+
+    def _query(self):
+        self._send(encode_packet(questions=[(self._service, TYPE_PTR)]))
+        self._next_query = time.monotonic() + self._query_interval
+        self._query_interval = min(2 * self._query_interval, ServiceAgent.MAX_QUERY_INTERVAL)
+
+    def _instance_records(self, ttl=_TTL):
+        return [(self._service, TYPE_PTR, ttl, self._instance),
+                (self._instance, TYPE_SRV, ttl, (self._port, self._host)),
+                (self._instance, TYPE_TXT, ttl, b''),
+                (self._host, TYPE_A, ttl, self._address)]
+
+    def _send(self, packet):
+        try:
+            self._sock.sendto(packet, (MDNS_GROUP, self._mdns_port))
+        except OSError:
+            pass # No route (yet), the next query or announcement will be retried
+
+    def _handle(self, data, addr):
+        try:
+            response, questions, records = decode_packet(data)
+        except MDNSError:
+            return # Not for us to fix
+
+        if response:
+            self._handle_response(records, addr)
+        else:
+            self._handle_questions(questions)
+
+    def _handle_questions(self, questions):
+        ptr, srv, txt, a = self._instance_records()
+        answers, additionals = [], []
+
+        for name, type in questions:
+            if name == self._service and type in (TYPE_PTR, TYPE_ANY):
+                answers.append(ptr)
+                additionals.extend([srv, txt, a])
+            elif name == self._instance and type in (TYPE_SRV, TYPE_TXT, TYPE_ANY):
+                answers.extend([srv, txt])
+                additionals.append(a)
+            elif name == self._host and type in (TYPE_A, TYPE_ANY):
+                answers.append(a)
+
+        if answers:
+            answers = list(dict.fromkeys(answers))
+            additionals = [r for r in dict.fromkeys(additionals) if r not in answers]
+            self._send(encode_packet(answers=answers, additionals=additionals, response=True))
+
+    def _handle_response(self, records, addr):
+        """Resolve the instances with the SRV (and A) records of the response.
+        
+        Only the names of the instances being resolved are kept between responses 
+        (until their PTR records expire), the SRV and A records are used right away. 
+        The answer to an SRV question includes the A record.
+        """
+
+        now = time.monotonic()
+        new, srvs, addresses = [], {}, {}
+        for name, type, ttl, value in records:
+            if type == TYPE_PTR:
+                if name != self._service or value == self._instance:
+                    continue
+                if ttl == 0: # Goodbye
+                    self._pending.pop(value, None)
+                elif value in self._pending or len(self._pending) < ServiceAgent.MAX_PENDING:
+                    self._pending[value] = now + ttl
+                    new.append(value)
+            elif type == TYPE_SRV and ttl > 0:
+                srvs[name] = value
+            elif type == TYPE_A and ttl > 0:
+                addresses[name] = value
+
+        for instance, expires in list(self._pending.items()):
+            if instance in srvs:
+                del self._pending[instance]
+                port, target = srvs[instance]
+                self._found(addresses.get(target, addr[0]), port)
+            elif expires <= now:
+                del self._pending[instance]
+
+        unresolved = [instance for instance in new if instance in self._pending]
+        if unresolved: # Ask for the SRV records that were not included
+            self._send(encode_packet(questions=[(instance, TYPE_SRV) for instance in sorted(unresolved)]))
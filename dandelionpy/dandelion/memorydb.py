@@ -0,0 +1,669 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import Future
+from dandelion.database import ContentDB
+from dandelion.identity import Identity, IdentityInfo
+from dandelion.message import Message
+import threading
+
+
+class _CookieLog:
+    """The keys of the content added at each time cookie.
+    
+    Two parallel arrays sorted by cookie sequence number, so the content added 
+    after a time cookie is found with a binary search. Removed content is left 
+    in the log and skipped when read, the log is rebuilt when mostly stale.
+    """
+
+    def __init__(self):
+        self._seqs = []
+        self._keys = []
+        self._stale = 0
+
+    def append(self, seq, key):
+        self._seqs.append(seq)
+        self._keys.append(key)
+
+    def removed(self, count=1):
+        self._stale += count
+
+    def clear(self):
+        self._seqs = []
+        self._keys = []
+        self._stale = 0
+
+    def after(self, seq):
+        """The keys (list) added after the cookie sequence number, in order"""
+        return self._keys[bisect_right(self._seqs, seq):]
+
+    def compact(self, entries):
+        """Rebuild from the live (seq, key) entries if most of the log is stale"""
+
+        if self._stale > len(self._seqs) // 2:
+            self.clear()
+            for seq, key in entries:
+                self.append(seq, key)
+
+
+class MemoryContentDB(ContentDB):
+    """A content database kept in memory.
+    
+    Stores the content in dicts, with sorted arrays keyed by time cookie 
+    sequence number for the synchronization queries. Nothing is persisted, 
+    which makes it suitable for tests, benchmarks and short lived nodes.
+    """
+
+    _PRUNE_BATCH_SIZE = 100
+
+    def __init__(self, id=None):
+        """Create an empty data base. A new id is generated if None."""
+
+        super().__init__(id)
+
+        self._lock = threading.RLock()
+        self._seq = 0 # Storage order
+
+        """Time cookie -> sequence number, in order"""
+        self._cookies = {}
+        self._cookie = None
+        self._cookie_seq = 0
+        self._remote_cookies = {}
+
+        """Message id -> (storage seq, cookie seq, message), in storage order"""
+        self._messages = {}
+        self._message_log = _CookieLog()
+        self._message_bytes = 0
+        self._by_receiver = {}
+        self._by_sender = {}
+        self._by_timestamp = [] # Sorted (timestamp, storage seq, message id)
+
+        """Fingerprint -> (storage seq, cookie seq, public identity), in storage order"""
+        self._identities = {}
+        self._identity_log = _CookieLog()
+        self._nicks = {}
+        self._private_identities = {}
+        self._inbox = {}
+
+        self._new_time_cookie()
+
+    def get_last_time_cookie(self, dbfp=None):
+        """Get the latest time cookie known in the data base for the remote 
+        data base with fingerprint dbfp. 
+        
+        If there is no record of the remote data base, return None.
+        
+        If dbfp is None, get the latest time cookie for the own database.
+        """
+
+        with self._lock:
+            if dbfp is None:
+                return self._cookie
+            return self._remote_cookies.get(dbfp)
+
+    def update_last_time_cookie(self, dbfp, time_cookie):
+        """Create a time cookie entry (or update an existing one) for a remote data base"""
+
+        if not isinstance(dbfp, bytes) or not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        with self._lock:
+            self._remote_cookies[dbfp] = time_cookie
+
+    def contains_time_cookie(self, time_cookie):
+        """Returns true if the time cookie (bytes) is known to the data base"""
+
+        if not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        with self._lock:
+            return time_cookie in self._cookies
+
+    def compact_time_cookies(self, limit=None):
+        """Remove time cookies no longer referred to by any content. Return the number removed (int). 
+        
+        Only the cookies older than every message are removed and the current 
+        time cookie is always kept.
+        """
+
+        if limit is not None:
+            self._check_limit(limit)
+
+        with self._lock:
+            oldest = min((seq for _, seq, _ in self._messages.values()), default=self._cookies[self._cookie])
+            used = set(seq for _, seq, _ in self._identities.values())
+
+            unused = [tc for tc, seq in self._cookies.items() if seq < oldest and seq not in used]
+            for tc in unused[:limit]:
+                del self._cookies[tc]
+
+            return len(unused[:limit])
+
+    def search_messages(self, search_term):
+        """Search the data base of messages (case insensitive)."""
+
+        search_term = search_term.lower()
+        with self._lock:
+            return [(msg.text,) for _, _, msg in self._messages.values()
+                    if isinstance(msg.text, str) and search_term in msg.text.lower()]
+
+    def remove_messages(self, msgs=None):
+        """Removes messages from the data base.
+        
+        The specified list of messages will be removed from the data base. 
+        If the message parameter is omitted, all messages in the data base will be removed.
+        """
+
+        with self._lock:
+            if msgs is None:
+                self._messages.clear()
+                self._message_log.clear()
+                self._message_bytes = 0
+                self._by_receiver.clear()
+                self._by_sender.clear()
+                self._by_timestamp = []
+                self._inbox.clear()
+            else:
+                self._remove_message_ids([m.id for m in msgs])
+
+    def prune_messages(self, older_than=None, max_count=None, max_bytes=None, keep_own=True, limit=None):
+        """Remove old messages from the data base. Return the number of removed messages (int).
+        
+        Removes messages with a timestamp before older_than (int), then the 
+        earliest stored messages until there are at most max_count messages and 
+        the data base content uses at most max_bytes. If keep_own is True, 
+        messages signed by a private identity are never removed. At most limit 
+        messages are removed per call.
+        """
+
+        for value in [older_than, max_count, max_bytes, limit]:
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                raise TypeError
+
+        if (limit is not None and limit < 0) or (max_count is not None and max_count < 0) or \
+                (max_bytes is not None and max_bytes < 0):
+            raise ValueError
+
+        with self._lock:
+            def removable(msgid):
+                sender = self._messages[msgid][2].sender if self._messages[msgid][2].has_sender else None
+                return not keep_own or sender not in self._private_identities
+
+            msgids = []
+            if older_than is not None:
+                end = bisect_left(self._by_timestamp, (older_than,))
+                msgids = [msgid for _, _, msgid in self._by_timestamp[:end] if removable(msgid)][:limit]
+
+            excess = 0
+            if max_count is not None:
+                excess = len(self._messages) - len(msgids) - max_count
+
+            if max_bytes is not None and self._message_bytes > max_bytes:
+                excess = max(excess, self._PRUNE_BATCH_SIZE if limit is None else limit)
+
+            if limit is not None:
+                excess = min(excess, limit - len(msgids))
+
+            if excess > 0:
+                expired = set(msgids)
+                for msgid in self._messages:
+                    if excess == 0:
+                        break
+                    if msgid not in expired and removable(msgid):
+                        msgids.append(msgid)
+                        excess -= 1
+
+            self._remove_message_ids(msgids)
+            return len(msgids)
+
+    @property
+    def message_count(self):
+        """Returns the number of messages currently in the data base (int)"""
+        return len(self._messages)
+
+    @property
+    def used_bytes(self):
+        """Returns the size of the stored message content (int)"""
+        return self._message_bytes
+
+    def contains_message(self, msgid):
+        """Returns true if the database contains the msgid"""
+
+        if not isinstance(msgid, bytes):
+            raise TypeError
+
+        return msgid in self._messages
+
+    def missing_messages(self, msgids):
+        """Returns the message ids (bytes) from the list that are not in the data base"""
+        return self._missing(self._messages, msgids)
+
+    def get_messages(self, msgids=None, time_cookie=None):
+        """Get a list of all msg_rows with specified message id.
+        
+        If a time cookie is specified, all messages in the database from (and 
+        including) the time specified by the time cookie will be returned. 
+        The messages are in storage order.
+        """
+
+        if msgids is not None and not hasattr(msgids, '__iter__'):
+            raise TypeError
+
+        with self._lock:
+            entries = self._select(self._messages, self._message_log, msgids, time_cookie)
+            return (self._cookie, [msg for _, _, msg in entries])
+
+    def get_messages_for_receiver(self, fingerprint, limit=None):
+        """Get the messages (list) addressed to the identity with the fingerprint (bytes), in storage order.
+        
+        If a limit is specified, at most limit messages are returned.
+        """
+        return self._indexed_messages(self._by_receiver, fingerprint, limit)
+
+    def get_messages_by_sender(self, fingerprint, limit=None):
+        """Get the messages (list) signed by the identity with the fingerprint (bytes), in storage order.
+        
+        If a limit is specified, at most limit messages are returned.
+        """
+        return self._indexed_messages(self._by_sender, fingerprint, limit)
+
+    def get_recent_messages(self, limit, before=None):
+        """Get the (at most) limit latest messages, newest first, as a (cursor, messages) tuple. 
+        
+        Messages without timestamp are not included. The cursor marks the position 
+        of the last message returned (the before argument if there was none). If before 
+        (a cursor) is specified, only the messages after it are returned (for paging).
+        """
+
+        self._check_limit(limit)
+        self._check_cursor(before)
+
+        with self._lock:
+            end = len(self._by_timestamp) if before is None else bisect_left(self._by_timestamp, before)
+            entries = self._by_timestamp[max(0, end - limit):end]
+            cursor = entries[0][:2] if entries else before
+            return (cursor, [self._messages[msgid][2] for _, _, msgid in reversed(entries)])
+
+    def find_messages(self, limit=None, offset=None, time_cookie=None, sender=None, receiver=None, text=None):
+        """Iterate over the messages matching all the specified filters, in storage order.
+        
+        The messages are skipped up to offset (int) and at most limit (int) are returned. 
+        If a time cookie is specified, only messages added after it are included. Sender and 
+        receiver are fingerprints (bytes) and text (str) is matched case insensitively as a 
+        substring of the message text.
+        """
+
+        self._check_filters(limit, offset, [sender, receiver], [text])
+
+        def matches(m):
+            return ((sender is None or m.sender == sender) and 
+                    (receiver is None or m.receiver == receiver) and 
+                    (text is None or (isinstance(m.text, str) and text.lower() in m.text.lower())))
+
+        with self._lock:
+            entries = self._select(self._messages, self._message_log, None, time_cookie)
+            return self._page([msg for _, _, msg in entries if matches(msg)], limit, offset)
+
+    def get_inbox(self, limit=None):
+        """Get the messages to the private identities in the data base, in storage order.
+        
+        Returns a list of (message, plaintext) pairs. Messages are decrypted the 
+        first time they are read. Messages that can't be decrypted are left out. 
+        If a limit is specified, at most limit messages are returned.
+        """
+
+        if limit is not None:
+            self._check_limit(limit)
+
+        with self._lock:
+            for fp, identity in self._private_identities.items():
+                for msgid in self._by_receiver.get(fp, ()):
+                    if msgid in self._inbox:
+                        continue
+                    try:
+                        self._inbox[msgid] = identity.decrypt(self._messages[msgid][2].text)
+                    except Exception: # Corrupt or not for this key
+                        continue
+
+            entries = sorted(self._messages[msgid] + (plaintext,) for msgid, plaintext in self._inbox.items())
+            return [(msg, plaintext) for _, _, msg, plaintext in entries[:limit]]
+
+    def get_message_ids(self, time_cookie=None):
+        """Get a list of the ids (bytes) of all messages in the data base.
+        
+        If a time cookie is specified, only the ids of the messages added after
+        the time specified by the time cookie will be returned.
+        """
+
+        with self._lock:
+            if time_cookie is None:
+                return (self._cookie, list(self._messages))
+
+            return (self._cookie, self._added_after(self._messages, self._message_log, time_cookie))
+
+    def add_private_identity(self, identity):
+        """Add a private identity to the data base."""
+
+        if identity is None:
+            raise TypeError
+
+        if not IdentityInfo(self, identity).is_private():
+            raise ValueError
+
+        with self._lock:
+            self.add_identities([identity])
+            self._private_identities[identity.fingerprint] = identity
+
+    def remove_private_identity(self, identity, keep_public_identity=False):
+        """Remove a private identity to the data base."""
+
+        if identity is None:
+            raise TypeError
+
+        if not IdentityInfo(self, identity).is_private():
+            raise ValueError
+
+        with self._lock:
+            if not keep_public_identity:
+                self.remove_identities([identity])
+
+            for msgid in self._by_receiver.get(identity.fingerprint, ()):
+                self._inbox.pop(msgid, None)
+            self._private_identities.pop(identity.fingerprint, None)
+
+    def get_private_identity(self, fingerprint):
+        """Get a private identity from the data base"""
+
+        if not isinstance(fingerprint, bytes):
+            raise TypeError
+
+        with self._lock:
+            if fingerprint not in self._private_identities or fingerprint not in self._identities:
+                raise ValueError
+
+            return self._private_identities[fingerprint]
+
+    def remove_identities(self, identities=None):
+        """Removes identities from the data base.
+        
+        The specified list of identities will be removed from the data base. 
+        If the identities parameter is omitted, all identities in the data base will be removed.
+        """
+
+        if identities is not None and not hasattr(identities, '__iter__'):
+            raise TypeError
+
+        with self._lock:
+            if identities is None:
+                self._identities.clear()
+                self._identity_log.clear()
+                self._nicks.clear()
+                return
+
+            for fp in [id.fingerprint for id in identities]:
+                if self._identities.pop(fp, None) is not None:
+                    self._nicks.pop(fp, None)
+                    self._identity_log.removed()
+
+            self._identity_log.compact((seq, fp) for fp, (_, seq, _) in self._identities.items())
+
+    def set_nick(self, fingerprint, nick):
+        """Set the nick of a specific identity."""
+
+        self._check_fingerprint(fingerprint)
+
+        if not nick is None and not isinstance(nick, str):
+            raise TypeError
+
+        with self._lock:
+            if fingerprint not in self._identities:
+                return
+
+            if nick is None:
+                self._nicks.pop(fingerprint, None)
+            else:
+                self._nicks[fingerprint] = nick
+
+    def get_nick(self, fingerprint):
+        """Get the nick of a specific identity"""
+
+        self._check_fingerprint(fingerprint)
+
+        with self._lock:
+            return self._nicks.get(fingerprint)
+
+    @property
+    def identity_count(self):
+        """Returns the number of identities currently in the data base (int)"""
+        return len(self._identities)
+
+    def contains_identity(self, fingerprint):
+        """Returns true if the database contains the identity fingerprint"""
+
+        if not isinstance(fingerprint, bytes):
+            raise TypeError
+
+        return fingerprint in self._identities
+
+    def missing_identities(self, fingerprints):
+        """Returns the identity fingerprints (bytes) from the list that are not in the data base"""
+        return self._missing(self._identities, fingerprints)
+
+    def get_identities(self, fingerprints=None, time_cookie=None):
+        """Get a list of all identities with specified fingerprints.
+        
+        If the parameter is None, all identities are returned.
+        
+        If a time cookie is specified, all identities in the database after
+        the time specified by the time cookie will be returned. The identities 
+        are in storage order.
+        """
+
+        if fingerprints is not None and not hasattr(fingerprints, '__iter__'):
+            raise TypeError
+
+        with self._lock:
+            entries = self._select(self._identities, self._identity_log, fingerprints, time_cookie)
+            return (self._cookie, [identity for _, _, identity in entries])
+
+    def find_identities(self, limit=None, offset=None, time_cookie=None, nick=None):
+        """Iterate over the (public) identities matching all the specified filters, in storage order.
+        
+        Limit, offset and time cookie are as for find_messages. The nick (str) is matched 
+        case insensitively as a substring of the nick of the identity.
+        """
+
+        self._check_filters(limit, offset, [], [nick])
+
+        def matches(identity):
+            return nick is None or nick.lower() in self._nicks.get(identity.fingerprint, '').lower()
+
+        with self._lock:
+            entries = self._select(self._identities, self._identity_log, None, time_cookie)
+            return self._page([identity for _, _, identity in entries if matches(identity)], limit, offset)
+
+    def _submit_messages(self, msgs):
+        """Add the messages. Return a completed Future."""
+
+        new = dict((m.id, m) for m in self._check_content(msgs, Message))
+
+        with self._lock:
+            new = [(msgid, m) for msgid, m in new.items() if msgid not in self._messages]
+            if new:
+                self._new_time_cookie()
+
+            for msgid, m in new:
+                self._seq += 1
+                self._messages[msgid] = (self._seq, self._cookie_seq, m)
+                self._message_log.append(self._cookie_seq, msgid)
+                self._message_bytes += self._message_size(m)
+
+                if m.has_receiver:
+                    self._by_receiver.setdefault(m.receiver, {})[msgid] = None
+                if m.has_sender:
+                    self._by_sender.setdefault(m.sender, {})[msgid] = None
+                if m.timestamp is not None:
+                    insort(self._by_timestamp, (m.timestamp, self._seq, msgid))
+
+            self._content_added("message", [m for _, m in new], self._cookie) # In order
+            return self._completed(self._cookie)
+
+    def _submit_identities(self, identities):
+        """Add the identities. Return a completed Future."""
+
+        new = dict((id.fingerprint, id) for id in self._check_content(identities, Identity))
+
+        with self._lock:
+            new = [id for fp, id in new.items() if fp not in self._identities]
+            if new:
+                self._new_time_cookie()
+
+            for id in new:
+                self._seq += 1
+                self._identities[id.fingerprint] = (self._seq, self._cookie_seq,
+                                                    Identity(id.dsa_key.public_key(), id.rsa_key.public_key()))
+                self._identity_log.append(self._cookie_seq, id.fingerprint)
+
+            self._content_added("identity", new, self._cookie) # In order
+            return self._completed(self._cookie)
+
+    def _new_time_cookie(self):
+        """Create a new, unused time cookie and make it the current one"""
+
+        tc = self._generate_random_tc_id()
+        while tc in self._cookies:
+            tc = self._generate_random_tc_id()
+
+        self._cookie_seq += 1
+        self._cookies[tc] = self._cookie_seq
+        self._cookie = tc
+
+    def _cookie_seq_of(self, time_cookie):
+        """The sequence number of a time cookie. Raise the appropriate exception if it isn't known."""
+
+        if not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        if time_cookie not in self._cookies:
+            raise ValueError
+
+        return self._cookies[time_cookie]
+
+    def _added_after(self, content, log, time_cookie):
+        """The keys of the content (dict) added after the time cookie, in storage order"""
+
+        seq = self._cookie_seq_of(time_cookie)
+        return [key for key in log.after(seq) if key in content and content[key][1] > seq]
+
+    def _select(self, content, log, keys, time_cookie):
+        """The content (dict) entries with one of the keys (all if None) added 
+        after the time cookie (if specified), in storage order.
+        """
+
+        if time_cookie is not None:
+            selected = self._added_after(content, log, time_cookie)
+            if keys is not None:
+                keys = set(keys)
+                selected = [key for key in selected if key in keys]
+            return [content[key] for key in selected]
+
+        if keys is None:
+            return list(content.values())
+
+        return sorted(content[key] for key in set(keys) if key in content)
+
+    def _page(self, content, limit, offset):
+        """An iterator over the content (list) from offset, at most limit items"""
+
+        start = offset or 0
+        return iter(content[start:None if limit is None else start + limit])
+
+    def _missing(self, content, ids):
+        if ids is None or not hasattr(ids, '__iter__'):
+            raise TypeError
+
+        ids = list(ids)
+        if not all(isinstance(id, bytes) for id in ids):
+            raise TypeError
+
+        return [id for id in ids if id not in content]
+
+    def _indexed_messages(self, index, fingerprint, limit):
+        """Get the messages (list) in the index (fingerprint -> message ids) for the fingerprint"""
+
+        self._check_fingerprint(fingerprint)
+
+        if limit is not None:
+            self._check_limit(limit)
+
+        with self._lock:
+            msgids = list(index.get(fingerprint, ()))[:limit]
+            return [self._messages[msgid][2] for msgid in msgids]
+
+    def _remove_message_ids(self, msgids):
+        """Remove the messages with the ids. Call with the lock held."""
+
+        for msgid in msgids:
+            entry = self._messages.pop(msgid, None)
+            if entry is None:
+                continue
+
+            seq, _, m = entry
+            self._message_log.removed()
+            self._message_bytes -= self._message_size(m)
+            self._inbox.pop(msgid, None)
+
+            if m.has_receiver:
+                self._unindex(self._by_receiver, m.receiver, msgid)
+            if m.has_sender:
+                self._unindex(self._by_sender, m.sender, msgid)
+            if m.timestamp is not None:
+                i = bisect_left(self._by_timestamp, (m.timestamp, seq, msgid))
+                del self._by_timestamp[i]
+
+        self._message_log.compact((cookie_seq, msgid) for msgid, (_, cookie_seq, _) in self._messages.items())
+
+    def _unindex(self, index, fingerprint, msgid):
+        msgids = index[fingerprint]
+        del msgids[msgid]
+        if not msgids:
+            del index[fingerprint]
+
+    def _check_fingerprint(self, fingerprint):
+        if fingerprint is None or not isinstance(fingerprint, bytes):
+            raise TypeError
+
+        if not len(fingerprint) > 0:
+            raise ValueError
+
+    def _message_size(self, m):
+        """Approximate storage size of a message (bytes)"""
+
+        size = len(m.id) + len(m.text if isinstance(m.text, bytes) else m.text.encode())
+        if m.has_receiver:
+            size += len(m.receiver)
+        if m.has_sender:
+            size += len(m.sender) + len(m.signature)
+        return size
+
+    def _completed(self, result):
+        future = Future()
+        future.set_result(result)
+        return future
@@ -23,6 +23,8 @@ import dandelion.util
 class Message:
     """A DMS Message"""
 
+    __slots__ = ('_id', '_text', '_timestamp', '_receiver_fp', '_sender_fp', '_signature')
+
     _ID_LENGTH_BYTES = 12
     MAX_TEXT_LENGTH = 140
 
@@ -158,3 +160,19 @@ def create(text, timestamp=None, sender=None, receiver=None):
         sig = sender.sign(text)
         return Message(text, timestamp, receiver_fp=receiver.fingerprint, sender_fp=sender.fingerprint, signature=sig)
 
+def restore(msgid, text, timestamp=None, receiver_fp=None, sender_fp=None, signature=None):
+    """Factory method for Messages read back from storage.
+
+    The message id (bytes) is trusted and used as is, so no hashing or input 
+    validation is performed. Only use this for data that was validated when 
+    it was stored.
+    """
+
+    msg = Message.__new__(Message)
+    msg._id = msgid
+    msg._text = text
+    msg._timestamp = timestamp
+    msg._receiver_fp = receiver_fp
+    msg._sender_fp = sender_fp
+    msg._signature = signature
+    return msg
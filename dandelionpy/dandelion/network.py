@@ -21,10 +21,14 @@ import threading
 import socket
 import socketserver
 import random
+import select
+import time
 
 import dandelion.protocol
 from dandelion.protocol import ProtocolParseError
 from dandelion.service import Service
+from dandelion.snapshot import SnapshotError
+from dandelion.verifier import MessageVerifier
 
 
 class Transaction:
@@ -126,9 +130,20 @@ class ServerTransaction(SocketTransaction):
     class TurnRequest(Exception):
         """Raised when client has requested a turn-around"""
 
-    def __init__(self, sock, db, buff_size=1024):
+        def __init__(self, keep_alive=False):
+            super().__init__(keep_alive)
+            self.keep_alive = keep_alive
+
+    def __init__(self, sock, db, buff_size=1024, greet=True, version=dandelion.protocol.PROTOCOL_VERSION):
+        """Setup the server transaction.
+        
+        The greeting is skipped on a kept alive connection (greet is False). 
+        The version (str) to greet with is the one of the peer after a turn around.
+        """
         super().__init__(sock, dandelion.protocol.TERMINATOR.encode(), buff_size)
         self._db = db
+        self._greet = greet
+        self._version = version
 
     def process(self):
         """The DMS server transaction logic.
@@ -138,8 +153,10 @@ class ServerTransaction(SocketTransaction):
 
         #print("SERVER TRANSACTION: Starting server transaction")
 
-        """Write greeting"""
-        self._write(dandelion.protocol.create_greeting_message(self._db.id).encode())
+        if self._greet:
+            """Write greeting (with the current time cookie to let synchronized clients skip the lists)"""
+            time_cookie = self._db.get_last_time_cookie() if self._version != '1.0' else None
+            self._write(dandelion.protocol.create_greeting_message(self._db.id, time_cookie, self._version).encode())
 
         while True: # Serve client as long as it is active 
             try:
@@ -156,6 +173,13 @@ class ServerTransaction(SocketTransaction):
         #print("SERVER TRANSACTION: Ending server transaction")
 
 
+    def _known_time_cookie(self, tc):
+        """The requested time cookie, or None (everything) if it has been compacted away."""
+
+        if tc is not None and not self._db.contains_time_cookie(tc):
+            return None
+        return tc
+
     def _process_data(self, bdata):
         """Internal helper function that processes what should be a server request."""
 
@@ -165,10 +189,20 @@ class ServerTransaction(SocketTransaction):
             #print("SERVER Read data: ", data)
 
             if dandelion.protocol.is_message_id_list_request(data):
-                tc = dandelion.protocol.parse_message_id_list_request(data)
-                tc, msgs = self._db.get_messages(time_cookie=tc)
-                random.shuffle(msgs) # To avoid last piece problem
-                response_str = dandelion.protocol.create_message_id_list(tc, msgs)
+                tc = self._known_time_cookie(dandelion.protocol.parse_message_id_list_request(data))
+                tc, msgids = self._db.get_message_ids(time_cookie=tc)
+                random.shuffle(msgids) # To avoid last piece problem
+                response_str = dandelion.protocol.create_message_id_list_from_ids(tc, msgids)
+                self._write(response_str.encode())
+            elif dandelion.protocol.is_delta_request(data):
+                since = self._known_time_cookie(dandelion.protocol.parse_delta_request(data))
+                """Listing the messages first makes tc the earlier cookie; identities added 
+                in between are listed again next time rather than missed"""
+                tc, msgids = self._db.get_message_ids(time_cookie=since)
+                _, ids = self._db.get_identities(time_cookie=since)
+                random.shuffle(msgids) # To avoid last piece problem
+                random.shuffle(ids)
+                response_str = dandelion.protocol.create_delta(tc, msgids, [id.fingerprint for id in ids])
                 self._write(response_str.encode())
             elif dandelion.protocol.is_message_list_request(data):
                 msgids = dandelion.protocol.parse_message_list_request(data)
@@ -176,7 +210,7 @@ class ServerTransaction(SocketTransaction):
                 response_str = dandelion.protocol.create_message_list(msgs)
                 self._write(response_str.encode())
             elif dandelion.protocol.is_identity_id_list_request(data):
-                tc = dandelion.protocol.parse_identity_id_list_request(data)
+                tc = self._known_time_cookie(dandelion.protocol.parse_identity_id_list_request(data))
                 tc, ids = self._db.get_identities(time_cookie=tc)
                 random.shuffle(ids) # To avoid last piece problem
                 response_str = dandelion.protocol.create_identity_id_list(tc, ids)
@@ -186,10 +220,21 @@ class ServerTransaction(SocketTransaction):
                 _, ids = self._db.get_identities(fingerprints=identities)
                 response_str = dandelion.protocol.create_identity_list(ids)
                 self._write(response_str.encode())
+            elif dandelion.protocol.is_snapshot_request(data):
+                out = self._sock.makefile('wb')
+                try:
+                    self._db.export_snapshot(out)
+                    out.flush()
+                finally:
+                    out.close()
             elif dandelion.protocol.is_turn_request(data):
+                keep_alive = dandelion.protocol.parse_turn_request(data)
                 response_str = dandelion.protocol.create_turn_reply()
                 self._write(response_str.encode())
-                raise ServerTransaction.TurnRequest
+                raise ServerTransaction.TurnRequest(keep_alive)
+            elif dandelion.protocol.is_heartbeat_request(data):
+                response_str = dandelion.protocol.create_heartbeat_reply()
+                self._write(response_str.encode())
             else:
                 raise ProtocolParseError
 
@@ -199,7 +244,7 @@ class ServerTransaction(SocketTransaction):
 
 class Server(Service):
 
-    def __init__(self, config, db, id):
+    def __init__(self, config, db, id=None):
         self._ip = config.ip
         self._port = config.port
         self._db = db
@@ -267,6 +312,10 @@ class Server(Service):
 
 
 class _ServerImpl(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    allow_reuse_address = True # Restart without waiting for the old connections to time out
+    daemon_threads = True # Don't wait for kept alive connections on exit
+
     def __init__(self, host, port, db):
         super(socketserver.TCPServer, self).__init__((host, port), _ServerHandler)
         super(socketserver.ThreadingMixIn, self).__init__((host, port), _ServerHandler)
@@ -295,12 +344,26 @@ class _ServerHandler(socketserver.BaseRequestHandler):
 
 #        print("SERVER: In handler")
 
-        comm_transaction = ServerTransaction(self.request, self.server.db)
-        try:
-            comm_transaction.process()
-        except ServerTransaction.TurnRequest:
-            comm_transaction = ClientTransaction(self.request, self.server.db)
-            comm_transaction.process()
+        remote_id = None # Known once the client has greeted us on a kept alive connection
+
+        while True:
+            comm_transaction = ServerTransaction(self.request, self.server.db, greet=remote_id is None)
+            try:
+                comm_transaction.process()
+                return
+            except ServerTransaction.TurnRequest as turn:
+                comm_transaction = ClientTransaction(self.request, self.server.db, remote_id=remote_id)
+                comm_transaction.process()
+
+                if not turn.keep_alive or not comm_transaction.completed:
+                    return
+
+                """Turn back and wait for the next synchronization on this connection"""
+                remote_id = comm_transaction.remote_id
+                try:
+                    comm_transaction.turn()
+                except (socket.error, ProtocolParseError):
+                    return
 
 #        print("SERVER: Out handler")
 
@@ -308,89 +371,315 @@ class _ServerHandler(socketserver.BaseRequestHandler):
 class ClientTransaction(SocketTransaction):
     """The client communication transaction logic for the dandelion communication protocol."""
 
-    def __init__(self, sock, db, buff_size=1024):
+    def __init__(self, sock, db, buff_size=1024, verifier=None, bootstrap=False, remote_id=None):
+        """Setup the client transaction. 
+        
+        If bootstrap is True, a data base without messages that has never 
+        synchronized with the server starts by importing a snapshot of the 
+        server data base.
+        
+        On a kept alive connection the server doesn't greet again. The 
+        remote_id (bytes) is then the server data base id from the first 
+        greeting on the connection.
+        """
         super().__init__(sock, dandelion.protocol.TERMINATOR.encode(), buff_size)
         self._db = db
+        self._verifier = verifier if verifier is not None else MessageVerifier.shared(db)
+        self._bootstrap = bootstrap
+        self._remote_id = remote_id
+        self._version = dandelion.protocol.PROTOCOL_VERSION if remote_id is not None else None
+        self._completed = False
 
-    def process(self):
-#        print("CLIENT TRANSACTION: starting")
+    @property
+    def remote_id(self):
+        """The data base id (bytes) of the server, None until it has greeted"""
+        return self._remote_id
 
-        try:
-            """Read greeting from server"""
-            dbid = dandelion.protocol.parse_greeting_message(self._read().decode())
+    @property
+    def version(self):
+        """The protocol version (str) the server greeted with, None until it has greeted"""
+        return self._version
 
-            time_cookie = self._db.get_last_time_cookie(dbid)
+    @property
+    def keep_alive(self):
+        """True if the server can keep the connection alive (it isn't a 1.0 server)"""
+        return self._version not in (None, '1.0')
 
-            """Request and read message id's"""
-            self._write(dandelion.protocol.create_message_id_list_request(time_cookie).encode())
-            tc, msgids = dandelion.protocol.parse_message_id_list(self._read().decode())
+    @property
+    def completed(self):
+        """True if the transaction was processed without errors"""
+        return self._completed
 
-            req_msgids = [mid for mid in msgids if not self._db.contains_message(mid)]
+    def process(self):
+#        print("CLIENT TRANSACTION: starting")
 
-            if len(req_msgids) > 0: # Anything to fetch?
-                random.shuffle(req_msgids) # To avoid last piece problem
+        try:
+            if self._remote_id is None:
+                """Read greeting from server"""
+                self._version, dbid, remote_time_cookie = dandelion.protocol.parse_greeting(self._read().decode())
+                self._remote_id = dbid
+            else:
+                dbid, remote_time_cookie = self._remote_id, None
 
-                """Request and read messages"""
-                self._write(dandelion.protocol.create_message_list_request(req_msgids).encode())
-                msgs = dandelion.protocol.parse_message_list(self._read().decode())
+            time_cookie = self._db.get_last_time_cookie(dbid)
 
-                """Store the new messages"""
-                self._db.add_messages(msgs)
+            if time_cookie is not None and time_cookie == remote_time_cookie:
+                """Nothing has changed on the server since the last synchronization"""
+                self._completed = True
+                return
 
-            """Request and read user id's"""
-            self._write(dandelion.protocol.create_identity_id_list_request(time_cookie).encode())
-            _, identityids = dandelion.protocol.parse_identity_id_list(self._read().decode())
+            if time_cookie is None and self._bootstrap and self._version != '1.0' and self._db.message_count == 0:
+                """Import a snapshot and continue from its time cookie"""
+                self._write(dandelion.protocol.create_snapshot_request().encode())
+                _, time_cookie = self._db.import_snapshot(self._sock.makefile('rb', buffering=0),
+                                                          self._verifier.verify)
 
-            req_ids = [id for id in identityids if not self._db.contains_identity(id)]
+            if self._version != '1.0':
+                """The server knows the delta request"""
+                self._write(dandelion.protocol.create_delta_request(time_cookie).encode())
+                tc, msgids, identityids = dandelion.protocol.parse_delta(self._read().decode())
 
-            if len(req_ids) > 0: # Anything to fetch?
-                random.shuffle(req_ids) # To avoid last piece problem
+                """Identities first so that the signatures of their messages can be checked"""
+                self._fetch_identities(identityids)
+                self._fetch_messages(msgids)
+            else:
+                """Request and read message id's"""
+                self._write(dandelion.protocol.create_message_id_list_request(time_cookie).encode())
+                tc, msgids = dandelion.protocol.parse_message_id_list(self._read().decode())
 
-                """Request and read identities"""
-                self._write(dandelion.protocol.create_identity_list_request(req_ids).encode())
-                ids = dandelion.protocol.parse_identity_list(self._read().decode())
+                """Request and read user id's"""
+                self._write(dandelion.protocol.create_identity_id_list_request(time_cookie).encode())
+                _, identityids = dandelion.protocol.parse_identity_id_list(self._read().decode())
 
-                """Store the new identities"""
-                self._db.add_identities(ids)
+                """Identities first so that the signatures of their messages can be checked"""
+                self._fetch_identities(identityids)
+                self._fetch_messages(msgids)
 
             """Record the synchronization time for the remote db"""
             self._db.update_last_time_cookie(dbid, tc)
+            self._completed = True
 
-        except (socket.timeout, ProtocolParseError, ValueError, TypeError):
+        except (socket.timeout, ProtocolParseError, SnapshotError, ValueError, TypeError):
             """Do nothing on error, just hang up"""
             #print("CLIENT TRANSACTION: Error processing data from server")
 
         #print("CLIENT TRANSACTION: hanging up")
 
-    def turn(self):
-        self._write(dandelion.protocol.create_turn_request().encode())
+    def _fetch_messages(self, msgids):
+        """Request, verify and store the listed messages that are missing in the data base"""
+
+        req_msgids = self._db.missing_messages(msgids)
+
+        if len(req_msgids) > 0: # Anything to fetch?
+            random.shuffle(req_msgids) # To avoid last piece problem
+
+            """Request and read messages"""
+            self._write(dandelion.protocol.create_message_list_request(req_msgids).encode())
+            msgs = dandelion.protocol.parse_message_list(self._read().decode())
+
+            """Drop messages with bad signatures"""
+            msgs = self._verifier.verify(msgs)
+
+            """Store the new messages"""
+            self._db.add_messages(msgs)
+
+    def _fetch_identities(self, identityids):
+        """Request and store the listed identities that are missing in the data base"""
+
+        req_ids = self._db.missing_identities(identityids)
+
+        if len(req_ids) > 0: # Anything to fetch?
+            random.shuffle(req_ids) # To avoid last piece problem
+
+            """Request and read identities"""
+            self._write(dandelion.protocol.create_identity_list_request(req_ids).encode())
+            ids = dandelion.protocol.parse_identity_list(self._read().decode())
+
+            """Store the new identities"""
+            self._db.add_identities(ids)
+
+    def turn(self, keep_alive=False):
+        self._write(dandelion.protocol.create_turn_request(keep_alive).encode())
         ok = dandelion.protocol.parse_turn_reply(self._read().decode())
         return ok
 
 class Client:
-    def __init__(self, host, port, db):
+    def __init__(self, host, port, db, bootstrap=False, pool=None):
+        """Setup a client for a synchronization with the server at host:port.
+        
+        If a ConnectionPool is given, an idle connection to the server is 
+        reused if there is one and the connection is returned to the pool 
+        afterwards if the server could keep it alive.
+        """
         self._ip = host
         self._port = port
         self._db = db
+        self._bootstrap = bootstrap
+        self._pool = pool
+        self._conn = None
+        self._reusable = False
 
     def __enter__(self):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.settimeout(10.0)
-        #print("CLIENT: connecting")
-        self._sock.connect((self._ip, self._port))
+        if self._pool is not None:
+            self._conn = self._pool.acquire(self._ip, self._port)
+
+        if self._conn is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(10.0)
+            #print("CLIENT: connecting")
+            sock.connect((self._ip, self._port))
+            self._conn = _PooledConnection(self._ip, self._port, sock)
+
+        self._sock = self._conn.sock
         return self
 
     def __exit__(self, type, value, traceback):
+        if self._reusable and type is None:
+            self._pool.release(self._conn)
+            return
+
         #print("CLIENT: disconnecting")
+        self._conn.close()
+
+    def execute_transaction(self):
+        self._reusable = False
+        greet = self._conn.remote_id is None
+
+        comm_transaction = ClientTransaction(self._sock, self._db, bootstrap=self._bootstrap, 
+                                             remote_id=self._conn.remote_id)
+        comm_transaction.process()
+
+        keep_alive = self._pool is not None and comm_transaction.completed and comm_transaction.keep_alive
+        if comm_transaction.turn(keep_alive):
+            """Greet the server with its own version, so that a 1.0 server understands"""
+            comm_transaction_rev = ServerTransaction(self._sock, self._db, greet=greet, 
+                                                     version=comm_transaction.version or dandelion.protocol.PROTOCOL_VERSION)
+            try:
+                comm_transaction_rev.process()
+            except ServerTransaction.TurnRequest:
+                """The server turned back, so the connection can be used again"""
+                self._conn.remote_id = comm_transaction.remote_id
+                self._reusable = keep_alive
+
+
+class _PooledConnection:
+    """A connection to a server that is kept alive between synchronizations"""
+
+    def __init__(self, host, port, sock):
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.remote_id = None # Set once the connection can be reused
+        self.last_used = time.time() # Last synchronization
+        self.last_active = self.last_used # Last synchronization or heartbeat
+
+    def close(self):
         try:
-            self._sock.shutdown(socket.SHUT_RDWR)
+            self.sock.shutdown(socket.SHUT_RDWR)
         except socket.error:
             pass
-        self._sock.close()
+        self.sock.close()
 
-    def execute_transaction(self):
-        comm_transaction = ClientTransaction(self._sock, self._db)
-        comm_transaction.process()
-        if comm_transaction.turn():
-            comm_transaction = ServerTransaction(self._sock, self._db)
-            comm_transaction.process()
+    def alive(self):
+        """An idle connection that is readable has been closed by the server (or is out of sync)"""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (ValueError, socket.error):
+            return False
+        return not readable
+
+    def heartbeat(self):
+        """Send a heartbeat to keep the server from timing out. Return True if it replied."""
+        try:
+            self.sock.sendall(dandelion.protocol.create_heartbeat_request().encode())
+            reply = SocketTransaction(self.sock, dandelion.protocol.TERMINATOR.encode())._read()
+            dandelion.protocol.parse_heartbeat_reply(reply.decode())
+        except (socket.error, ProtocolParseError, ValueError):
+            return False
+
+        self.last_active = time.time()
+        return True
+
+
+class ConnectionPool:
+    """Keeps idle connections to servers open for reuse, keyed by (host, port).
+    
+    Connections that have been idle longer than idle_timeout seconds are 
+    closed. Idle connections get a heartbeat every heartbeat seconds (which 
+    must be shorter than the server read timeout) when maintain is called.
+    """
+
+    def __init__(self, idle_timeout=60, heartbeat=5):
+
+        if not isinstance(idle_timeout, (int, float)) or not isinstance(heartbeat, (int, float)):
+            raise TypeError
+
+        if idle_timeout <= 0 or heartbeat <= 0:
+            raise ValueError
+
+        self._idle_timeout = idle_timeout
+        self._heartbeat = heartbeat
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """The number of idle connections in the pool"""
+        with self._lock:
+            return len(self._connections)
+
+    def acquire(self, host, port):
+        """Take the idle connection to host:port out of the pool. Returns None if there is none."""
+
+        with self._lock:
+            conn = self._connections.pop((host, port), None)
+
+        if conn is None:
+            return None
+
+        if time.time() - conn.last_used > self._idle_timeout or not conn.alive():
+            conn.close()
+            return None
+
+        return conn
+
+    def release(self, conn):
+        """Put a connection back in the pool after a synchronization"""
+
+        conn.last_used = conn.last_active = time.time()
+        self._put(conn)
+
+    def maintain(self):
+        """Close expired and dead connections and send heartbeats to the others"""
+
+        now = time.time()
+        with self._lock:
+            idle = [conn for conn in self._connections.values() if now - conn.last_active >= self._heartbeat]
+            for conn in idle:
+                del self._connections[(conn.host, conn.port)]
+
+        for conn in idle:
+            if now - conn.last_used > self._idle_timeout or not conn.alive() or not conn.heartbeat():
+                conn.close()
+            else:
+                self._put(conn)
+
+    def _put(self, conn):
+        """Add the connection to the pool, replacing (and closing) any other to the same server"""
+
+        with self._lock:
+            old = self._connections.get((conn.host, conn.port))
+            self._connections[(conn.host, conn.port)] = conn
+
+        if old is not None and old is not conn:
+            old.close()
+
+    def close(self):
+        """Close all idle connections"""
+
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for conn in connections:
+            conn.close()
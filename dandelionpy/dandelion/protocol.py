@@ -39,7 +39,12 @@ class ProtocolParseError(Exception):
 class ProtocolVersionError(Exception):
     pass
 
-PROTOCOL_VERSION = '1.0'
+PROTOCOL_VERSION = '1.1'
+
+"""The versions a peer can greet with. Version 1.0 has no time cookie in the greeting 
+and no GETDELTA, GETSNAPSHOT, TURN KEEPALIVE or HEARTBEAT requests, so a 1.0 peer 
+is only sent the 1.0 requests (and greeted as 1.0 after a turn around)."""
+SUPPORTED_VERSIONS = ('1.0', '1.1')
 TERMINATOR = '\n'
 
 _PROTOCOL_COOKIE = 'DMS'
@@ -52,18 +57,34 @@ _GETMESSAGES = 'GETMESSAGES'
 _GETIDENTITYLIST = 'GETIDENTITYLIST'
 _GETIDENTITIES = 'GETIDENTITIES'
 
+_GETSNAPSHOT = 'GETSNAPSHOT'
+
+_GETDELTA = 'GETDELTA'
+
 _TURN = 'TURN'
 _TURN_REPLY = 'TURN OK'
+_KEEP_ALIVE = 'KEEPALIVE'
+
+_HEARTBEAT = 'HEARTBEAT'
+_HEARTBEAT_REPLY = 'HEARTBEAT OK'
 
-def create_greeting_message(dbid):
+_ANNOUNCE = 'ANNOUNCE'
+
+def create_greeting_message(dbid, time_cookie=None, version=PROTOCOL_VERSION):
     """Create the server greeting message string.
     
     This message is sent from the server to the client upon connection. 
-    The dbid (bytes) represents a data base id. 
+    The dbid (bytes) represents a data base id. The optional time_cookie 
+    (bytes) is the current time cookie of the server data base. It lets 
+    a client that is already up to date skip the list requests. 
+    
+    The version (str) is one of SUPPORTED_VERSIONS, 1.0 greetings have no 
+    time cookie.
     
     [C]                                                    [S]
      |                                                      | 
      |     <protocol cookie>;<protocol version>;<db id>     | 
+     |                   [;<time cookie>]                   | 
      |<-----------------------------------------------------| 
      |                                                      | 
     """
@@ -74,11 +95,19 @@ def create_greeting_message(dbid):
     if not isinstance(dbid, bytes):
         raise TypeError
 
-    return '{0}{3}{1}{3}{2}{4}'.format(_PROTOCOL_COOKIE,
-                                       PROTOCOL_VERSION,
-                                       encode_b64_bytes(dbid).decode(),
-                                       _FIELD_SEPARATOR,
-                                       TERMINATOR)
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError
+
+    if time_cookie is not None:
+        _assert_type(time_cookie, bytes)
+        if not time_cookie or version == '1.0':
+            raise ValueError
+
+    fields = [_PROTOCOL_COOKIE, version, encode_b64_bytes(dbid).decode()]
+    if time_cookie is not None:
+        fields.append(encode_b64_bytes(time_cookie).decode())
+
+    return ''.join([_FIELD_SEPARATOR.join(fields), TERMINATOR])
 
 
 def parse_greeting_message(msgstr):
@@ -90,6 +119,19 @@ def parse_greeting_message(msgstr):
     version, a ProtocolVersionError is raised.         
     """
 
+    _, dbid, _ = parse_greeting(msgstr)
+    return dbid
+
+
+def parse_greeting(msgstr):
+    """Parse the greeting message string.
+    
+    Returns a tuple (protocol version, data base id, time cookie) where the 
+    time cookie is None if the server didn't send one. Any of the 
+    SUPPORTED_VERSIONS is accepted. Raises the same exceptions as 
+    parse_greeting_message.
+    """
+
     _assert_type(msgstr, str)
 
     match = re.search(
@@ -99,24 +141,30 @@ def parse_greeting_message(msgstr):
                r'([0-9]+\.[0-9]+)',
                _FIELD_SEPARATOR,
                r'([a-zA-Z0-9+/=]+)',
+               r'(?:',
+               _FIELD_SEPARATOR,
+               r'([a-zA-Z0-9+/=]+))?',
                TERMINATOR,
                r'$']), msgstr)
 
     if not match:
         raise ProtocolParseError
 
-    ver, dbid_str = match.groups()
+    ver, dbid_str, tc_str = match.groups()
 
-    """Only exact match for now (should preferably support older versions)"""
-    if PROTOCOL_VERSION != ver:
+    if ver not in SUPPORTED_VERSIONS:
         raise ProtocolVersionError('Incompatible Protocol versions')
 
+    if ver == '1.0' and tc_str is not None:
+        raise ProtocolParseError
+
     try:
         dbid = decode_b64_bytes(dbid_str.encode())
+        time_cookie = decode_b64_bytes(tc_str.encode()) if tc_str is not None else None
     except ValueError:
         raise ProtocolParseError
 
-    return dbid
+    return (ver, dbid, time_cookie)
 
 
 def is_message_id_list_request(msgstr):
@@ -263,10 +311,28 @@ def create_message_id_list(time_cookie, messages=None):
     if not hasattr(messages, '__iter__'):
         raise TypeError
 
+    return create_message_id_list_from_ids(time_cookie, [msg.id for msg in messages])
+
+
+def create_message_id_list_from_ids(time_cookie, msgids=None):
+    """Create the response string for sending message IDs from the server.
+    
+    Same as create_message_id_list, but takes a list of message ids (bytes)
+    instead of a list of Message's.
+    """
+
+    _assert_type(time_cookie, bytes)
+
+    if msgids is None: # Don't use mutable default (e.g. [])
+        msgids = []
+
+    if not hasattr(msgids, '__iter__'):
+        raise TypeError
+
     tc_str = encode_b64_bytes(time_cookie).decode()
 
     msgparts = [tc_str]
-    msgparts.extend([encode_b64_bytes(msg.id).decode() for msg in messages])
+    msgparts.extend([encode_b64_bytes(msgid).decode() for msgid in msgids])
     return ''.join([_FIELD_SEPARATOR.join(msgparts),
                     TERMINATOR])
 
@@ -357,6 +423,132 @@ def parse_identity_id_list(identitystr):
 
 
 
+def is_delta_request(msgstr):
+    """Check if the string is a delta request."""
+
+    _assert_type(msgstr, str)
+
+    return msgstr.startswith(_GETDELTA)
+
+
+def create_delta_request(time_cookie=None):
+    """Create the delta request string.
+    
+    Requests the ids of both the messages and the identities that were 
+    added after the optional time cookie (bytes) in a single response. 
+    Since version 1.1.
+    
+    [C]                                                    [S]
+     |                                                      | 
+     |                GETDELTA [<time cookie>]              | 
+     |----------------------------------------------------->| 
+     |                                                      | 
+    """
+
+    if time_cookie is None:
+        return ''.join([_GETDELTA, TERMINATOR])
+
+    if not isinstance(time_cookie, bytes):
+        raise TypeError
+
+    return '{0} {1}{2}'.format(_GETDELTA,
+                               encode_b64_bytes(time_cookie).decode(),
+                               TERMINATOR)
+
+
+def parse_delta_request(msgstr):
+    """Parse the delta request string.
+    
+    If  a time cookie is present in the string it will be returned 
+    as a bytes type. If not, None will be returned.
+    
+    Raises a ProtocolParseError if the string can't be parsed.
+    """
+
+    _assert_type(msgstr, str)
+
+    if not is_delta_request(msgstr):
+        raise ProtocolParseError
+
+    match = re.search(''.join([r'^',
+                               _GETDELTA,
+                               r'( ([a-zA-Z0-9+/=]+))?',
+                               TERMINATOR,
+                               r'$']), msgstr)
+
+    if not match:
+        raise ProtocolParseError
+
+    if match.groups()[0] is None:
+        return None
+
+    return decode_b64_bytes(match.groups()[1].encode())
+
+
+def create_delta(time_cookie, msgids=None, identityids=None):
+    """Create the response string for sending a delta from the server.
+    
+    The time_cookie (bytes) is required, the lists of message ids (bytes)
+    and identity fingerprints (bytes) are optional. Both lists are 
+    relative to the same time cookie.
+    
+    [C]                                                    [S]
+     |                                                      | 
+     |  <time cookie>;<msgid>|...|<msgid>;<uid>|...|<uid>   | 
+     |<-----------------------------------------------------| 
+     |                                                      | 
+    """
+
+    _assert_type(time_cookie, bytes)
+
+    if msgids is None: # Don't use mutable default (e.g. [])
+        msgids = []
+
+    if identityids is None:
+        identityids = []
+
+    if not hasattr(msgids, '__iter__') or not hasattr(identityids, '__iter__'):
+        raise TypeError
+
+    return ''.join([_FIELD_SEPARATOR.join([
+                        encode_b64_bytes(time_cookie).decode(),
+                        _SUB_FIELD_SEPARATOR.join([encode_b64_bytes(msgid).decode() for msgid in msgids]),
+                        _SUB_FIELD_SEPARATOR.join([encode_b64_bytes(uid).decode() for uid in identityids])]),
+                    TERMINATOR])
+
+
+def parse_delta(msgstr):
+    """Parse the delta response string from the server.
+    
+    Returns a (tc, [msgid], [identityid]) tuple.
+    
+    Raises a ProtocolParseError if the string can't be parsed.
+    """
+
+    _assert_type(msgstr, str)
+
+    match = re.search(''.join([r'^',
+                               r'([a-zA-Z0-9+/=]+)',
+                               _FIELD_SEPARATOR,
+                               r'([a-zA-Z0-9+/=|]*)',
+                               _FIELD_SEPARATOR,
+                               r'([a-zA-Z0-9+/=|]*)',
+                               TERMINATOR,
+                               r'$']), msgstr)
+
+    if not match:
+        raise ProtocolParseError
+
+    tc, msgids_str, identityids_str = match.groups()
+
+    try:
+        return (decode_b64_bytes(tc.encode()),
+                _decode_id_sub_fields(msgids_str),
+                _decode_id_sub_fields(identityids_str))
+    except ValueError:
+        raise ProtocolParseError
+
+
 def is_message_list_request(msgstr):
     """Check if the string is a message list request"""
     _assert_type(msgstr, str)
@@ -572,12 +764,65 @@ def parse_identity_list(identitystr):
 
     return [_string2identity(identity) for identity in parts]
 
-def create_turn_request():
+def create_snapshot_request():
+    """Create the request string used by the client to request a snapshot.
+    
+    The server responds with a binary snapshot of its data base (see 
+    dandelion.snapshot). The snapshot is self delimiting and ends with 
+    an end block, after which the client can continue with requests for 
+    the content added after the time cookie of the snapshot. Since version 1.1.
+    
+    [C]                                                    [S]
+     |                                                      | 
+     |                     GETSNAPSHOT                      | 
+     |----------------------------------------------------->| 
+     |                                                      | 
+     |                 <binary snapshot>                    | 
+     |<-----------------------------------------------------| 
+     |                                                      | 
+    """
+
+    return '{0}{1}'.format(_GETSNAPSHOT, TERMINATOR)
+
+def is_snapshot_request(msgstr):
+    """Check if the string is a snapshot request."""
+
+    _assert_type(msgstr, str)
+
+    return msgstr == (_GETSNAPSHOT + TERMINATOR)
+
+def create_turn_request(keep_alive=False):
     """Create turn request
+    
+    With keep_alive, the client asks the server to turn back again when it 
+    is done so that the connection can be reused for later synchronizations. 
+    On a kept alive connection neither side greets again. KEEPALIVE is 
+    since version 1.1.
+    
+    [C]                                                    [S]
+     |                                                      | 
+     |                  TURN [KEEPALIVE]                    | 
+     |----------------------------------------------------->| 
+     |                                                      | 
     """
 
+    if keep_alive:
+        return '{0} {1}{2}'.format(_TURN, _KEEP_ALIVE, TERMINATOR)
+
     return '{0}{1}'.format(_TURN, TERMINATOR)
 
+def parse_turn_request(msgstr):
+    """Parse the turn request string.
+    
+    Returns True if the client asked to keep the connection alive. Raises a 
+    ProtocolParseError if the string isn't a turn request.
+    """
+
+    if not is_turn_request(msgstr):
+        raise ProtocolParseError
+
+    return msgstr == create_turn_request(True)
+
 def parse_turn_reply(msgstr):
     _assert_type(msgstr, str)
     if not msgstr == (_TURN_REPLY + TERMINATOR):
@@ -589,11 +834,117 @@ def is_turn_request(msgstr):
 
     _assert_type(msgstr, str)
 
-    return msgstr == (_TURN + TERMINATOR)
+    return msgstr in (create_turn_request(False), create_turn_request(True))
 
 def create_turn_reply():
     return _TURN_REPLY + TERMINATOR
 
+def create_heartbeat_request():
+    """Create the request string used to keep an idle connection alive. Since version 1.1.
+    
+    [C]                                                    [S]
+     |                                                      | 
+     |                      HEARTBEAT                       | 
+     |----------------------------------------------------->| 
+     |                                                      | 
+     |                     HEARTBEAT OK                     | 
+     |<-----------------------------------------------------| 
+     |                                                      | 
+    """
+
+    return '{0}{1}'.format(_HEARTBEAT, TERMINATOR)
+
+def is_heartbeat_request(msgstr):
+    """Check if the string is a heartbeat request."""
+
+    _assert_type(msgstr, str)
+
+    return msgstr == (_HEARTBEAT + TERMINATOR)
+
+def create_heartbeat_reply():
+    return _HEARTBEAT_REPLY + TERMINATOR
+
+def parse_heartbeat_reply(msgstr):
+    _assert_type(msgstr, str)
+    if not msgstr == (_HEARTBEAT_REPLY + TERMINATOR):
+        raise ProtocolParseError
+    return True
+
+def create_announcement(dbid, time_cookie, port):
+    """Create the announcement datagram string.
+    
+    A node periodically broadcasts (UDP) its data base id (bytes), the current 
+    time cookie (bytes) of the data base and the port (int) its server listens 
+    to, so that other nodes can tell if it has content they haven't seen.
+    
+    [N]                                                    [*]
+     |                                                      | 
+     |  <protocol cookie>;<protocol version>;ANNOUNCE;      | 
+     |  <port>;<db id>;<time cookie>                        | 
+     |- - - - - - - - - - - - - - - - - - - - - - - - - - ->| 
+     |                                                      | 
+    """
+
+    if not dbid or not time_cookie:
+        raise ValueError
+
+    if not isinstance(dbid, bytes) or not isinstance(time_cookie, bytes) or \
+       isinstance(port, bool) or not isinstance(port, int):
+        raise TypeError
+
+    if not 0 < port < 65536:
+        raise ValueError
+
+    return _FIELD_SEPARATOR.join([_PROTOCOL_COOKIE,
+                                  PROTOCOL_VERSION,
+                                  _ANNOUNCE,
+                                  str(port),
+                                  encode_b64_bytes(dbid).decode(),
+                                  encode_b64_bytes(time_cookie).decode()]) + TERMINATOR
+
+def parse_announcement(msgstr):
+    """Parse the announcement datagram string.
+    
+    Returns a tuple (db id, time cookie, port) or raises a ProtocolParseError 
+    if the string can't be parsed. Announcements from incompatible protocol 
+    versions raise a ProtocolVersionError.
+    """
+
+    _assert_type(msgstr, str)
+
+    match = re.search(
+      ''.join([r'^',
+               _PROTOCOL_COOKIE,
+               _FIELD_SEPARATOR,
+               r'([0-9]+\.[0-9]+)',
+               _FIELD_SEPARATOR,
+               _ANNOUNCE,
+               _FIELD_SEPARATOR,
+               r'([0-9]{1,5})',
+               _FIELD_SEPARATOR,
+               r'([a-zA-Z0-9+/=]+)',
+               _FIELD_SEPARATOR,
+               r'([a-zA-Z0-9+/=]+)',
+               TERMINATOR,
+               r'$']), msgstr)
+
+    if not match:
+        raise ProtocolParseError
+
+    ver, port_str, dbid_str, tc_str = match.groups()
+
+    if PROTOCOL_VERSION != ver:
+        raise ProtocolVersionError('Incompatible Protocol versions')
+
+    port = int(port_str)
+    if not 0 < port < 65536:
+        raise ProtocolParseError
+
+    try:
+        return (decode_b64_bytes(dbid_str.encode()), decode_b64_bytes(tc_str.encode()), port)
+    except ValueError:
+        raise ProtocolParseError
+
 def _assert_type(x, type):
     """If x is a string this function does nothing. If it is None it raises a 
     ValueError and if it's not a string it raises a TypeError.
@@ -606,6 +957,19 @@ def _assert_type(x, type):
 
 
 
+def _decode_id_sub_fields(idsstr):
+    """Decode a (possibly empty) list of ids separated by the sub field separator"""
+
+    if not idsstr:
+        return []
+
+    parts = idsstr.split(_SUB_FIELD_SEPARATOR)
+    if not all(parts):
+        raise ProtocolParseError
+
+    return [decode_b64_bytes(part.encode()) for part in parts]
+
+
 def _message2string(msg):
     """Serialize a message to a DMS string"""
 
@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from dandelion.service import RepetitiveWorker
+import time
+
+class RetentionPolicy:
+    """Limits on the content kept in a data base.
+    
+    All limits are optional (None means unlimited):
+     max_age_sec - remove messages with a timestamp older than this
+     max_messages - remove the earliest stored messages above this count
+     max_db_bytes - remove the earliest stored messages while the content is bigger than this
+    Messages signed by a private identity are kept if keep_own_messages is True.
+    """
+
+    def __init__(self, max_age_sec=None, max_messages=None, max_db_bytes=None, keep_own_messages=True):
+
+        for value in [max_age_sec, max_messages, max_db_bytes]:
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                raise TypeError
+            if value is not None and value < 0:
+                raise ValueError
+
+        if not isinstance(keep_own_messages, bool):
+            raise TypeError
+
+        self._max_age_sec = max_age_sec
+        self._max_messages = max_messages
+        self._max_db_bytes = max_db_bytes
+        self._keep_own_messages = keep_own_messages
+
+    @property
+    def max_age_sec(self):
+        return self._max_age_sec
+
+    @property
+    def max_messages(self):
+        return self._max_messages
+
+    @property
+    def max_db_bytes(self):
+        return self._max_db_bytes
+
+    @property
+    def keep_own_messages(self):
+        return self._keep_own_messages
+
+    @property
+    def unlimited(self):
+        """True if the policy never removes anything"""
+        return self._max_age_sec is None and self._max_messages is None and self._max_db_bytes is None
+
+    def apply(self, db, limit=None, now=None):
+        """Remove (at most limit) messages violating the policy from the data base. 
+        
+        Return the number of removed messages. The current time (sec) defaults to time.time().
+        """
+
+        if self.unlimited:
+            return 0
+
+        older_than = None
+        removed = 0
+        if self._max_age_sec is not None:
+            older_than = int(time.time() if now is None else now) - self._max_age_sec
+            removed = db.drop_partitions(older_than, keep_own=self._keep_own_messages) # Whole windows at once
+
+        return removed + db.prune_messages(older_than=older_than,
+                                           max_count=self._max_messages,
+                                           max_bytes=self._max_db_bytes,
+                                           keep_own=self._keep_own_messages,
+                                           limit=limit)
+
+class Pruner(RepetitiveWorker):
+    """A service that periodically applies a retention policy to a data base.
+    
+    Messages are removed in small batches so that the data base writer is 
+    never blocked for long. Time cookies no longer in use are compacted after 
+    the messages have been removed.
+    """
+
+    _BATCH_SIZE = 200
+
+    def __init__(self, db, policy, interval_sec=60, batch_size=_BATCH_SIZE):
+        super().__init__(self.prune, interval_sec)
+
+        if not isinstance(policy, RetentionPolicy):
+            raise TypeError
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError
+
+        self._db = db
+        self._policy = policy
+        self._batch_size = batch_size
+
+    @property
+    def policy(self):
+        return self._policy
+
+    def prune(self):
+        """Apply the policy, batch by batch. Return the number of removed messages."""
+
+        removed = 0
+        while not self._stopping():
+            count = self._policy.apply(self._db, self._batch_size)
+            removed += count
+            if count < self._batch_size:
+                break
+
+        while not self._stopping():
+            if self._db.compact_time_cookies(self._batch_size) < self._batch_size:
+                break
+
+        return removed
+
+    def _stopping(self):
+        """True if the service is running and has been asked to stop"""
+        return self._running and self._stop_requested
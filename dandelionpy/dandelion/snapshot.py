@@ -0,0 +1,253 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Data base snapshots.
+
+A snapshot is a compact binary dump of the messages and identities of a data 
+base, together with the id of the source data base and the time cookie the 
+snapshot was taken at. A new node can import a snapshot in bulk and then 
+continue synchronizing incrementally from the time cookie.
+
+The format is a header followed by blocks, each checksummed so that a block 
+is only imported if it arrived intact:
+
+  <magic><version><db id length><db id><time cookie length><time cookie>
+  <kind><payload length><crc32><payload>  (repeated, kinds M and I)
+  <kind E><payload length><crc32><message count><identity count>
+
+All lengths and counts are big endian, the payload is a sequence of records 
+of length prefixed fields. A payload is at most SnapshotWriter.MAX_BLOCK_LENGTH 
+bytes, longer blocks are rejected by the reader.
+"""
+
+from dandelion.identity import Identity, RSA_key, DSA_key
+from dandelion.message import Message
+from dandelion.util import encode_int, decode_int
+import struct
+import zlib
+
+class SnapshotError(Exception):
+    '''Exception for malformed, corrupt or truncated snapshots'''
+
+_MAGIC = b'DMSSNAP'
+_VERSION = 1
+
+_MESSAGES = b'M'
+_IDENTITIES = b'I'
+_END = b'E'
+
+_MESSAGE_FIELDS = 5
+_IDENTITY_FIELDS = 6
+
+_BLOCK_HEADER = struct.Struct('>cII') # Kind, payload length, crc32
+_FIELD_LENGTH = struct.Struct('>H')
+_COUNTS = struct.Struct('>II')
+
+class SnapshotWriter:
+    """Writes a snapshot to a binary stream (any object with a write method)."""
+
+    BLOCK_SIZE = 500 # Records per block
+    MAX_BLOCK_LENGTH = 4 * 1024 * 1024 # Payload bytes per block (a record is at most 6 * 64 KiB)
+
+    def __init__(self, out, dbid, time_cookie):
+        """Write the snapshot header"""
+
+        if not isinstance(dbid, bytes) or not isinstance(time_cookie, bytes):
+            raise TypeError
+
+        self._out = out
+        self._message_count = 0
+        self._identity_count = 0
+        self._out.write(b''.join([_MAGIC, bytes([_VERSION]), _field(dbid), _field(time_cookie)]))
+
+    def write_messages(self, msgs):
+        """Write the messages (list), one block per BLOCK_SIZE messages"""
+
+        self._message_count += self._write_records(_MESSAGES, [_message2record(m) for m in msgs])
+
+    def write_identities(self, identities):
+        """Write the (public parts of the) identities (list), one block per BLOCK_SIZE identities"""
+
+        self._identity_count += self._write_records(_IDENTITIES, [_identity2record(id) for id in identities])
+
+    def close(self):
+        """Write the end block. The stream is left open."""
+        self._write_block(_END, _COUNTS.pack(self._message_count, self._identity_count))
+
+    def _write_records(self, kind, records):
+        """Write the records in blocks of at most BLOCK_SIZE records and MAX_BLOCK_LENGTH bytes. Return the count."""
+
+        block, length = [], 0
+        for record in records:
+            if len(block) == SnapshotWriter.BLOCK_SIZE or length + len(record) > SnapshotWriter.MAX_BLOCK_LENGTH:
+                self._write_block(kind, b''.join(block))
+                block, length = [], 0
+            block.append(record)
+            length += len(record)
+
+        if block:
+            self._write_block(kind, b''.join(block))
+
+        return len(records)
+
+    def _write_block(self, kind, payload):
+        self._out.write(_BLOCK_HEADER.pack(kind, len(payload), zlib.crc32(payload)))
+        self._out.write(payload)
+
+
+class SnapshotReader:
+    """Reads a snapshot from a binary stream (any object with a read method).
+    
+    Iterating the reader gives the content a block at a time, as ('message', [Message]) 
+    and ('identity', [Identity]) pairs. A SnapshotError is raised for a corrupt 
+    block, before it is returned, and if the stream ends before the end block.
+    """
+
+    def __init__(self, inp):
+        """Read the snapshot header"""
+
+        self._inp = inp
+
+        if self._read(len(_MAGIC)) != _MAGIC:
+            raise SnapshotError('Not a snapshot')
+
+        if self._read(1)[0] != _VERSION:
+            raise SnapshotError('Unsupported snapshot version')
+
+        self._dbid = self._read_field()
+        self._time_cookie = self._read_field()
+
+    @property
+    def dbid(self):
+        """The id (bytes) of the data base the snapshot was taken from"""
+        return self._dbid
+
+    @property
+    def time_cookie(self):
+        """The time cookie (bytes) of the source data base when the snapshot was taken"""
+        return self._time_cookie
+
+    def __iter__(self):
+        message_count, identity_count = 0, 0
+
+        while True:
+            kind, length, crc = _BLOCK_HEADER.unpack(self._read(_BLOCK_HEADER.size))
+            if length > SnapshotWriter.MAX_BLOCK_LENGTH: # Don't allocate whatever the header claims
+                raise SnapshotError('Block too long')
+            payload = self._read(length)
+
+            if zlib.crc32(payload) != crc:
+                raise SnapshotError('Checksum mismatch')
+
+            if kind == _MESSAGES:
+                msgs = [_record2message(fields) for fields in _records(payload, _MESSAGE_FIELDS)]
+                message_count += len(msgs)
+                yield ('message', msgs)
+            elif kind == _IDENTITIES:
+                identities = [_record2identity(fields) for fields in _records(payload, _IDENTITY_FIELDS)]
+                identity_count += len(identities)
+                yield ('identity', identities)
+            elif kind == _END:
+                if len(payload) != _COUNTS.size or _COUNTS.unpack(payload) != (message_count, identity_count):
+                    raise SnapshotError('Content missing')
+                return
+            else:
+                raise SnapshotError('Unknown block')
+
+    def _read(self, n):
+        """Read exactly n bytes"""
+
+        data = bytearray()
+        while len(data) < n:
+            chunk = self._inp.read(n - len(data))
+            if not chunk:
+                raise SnapshotError('Truncated snapshot')
+            data.extend(chunk)
+
+        return bytes(data)
+
+    def _read_field(self):
+        """Read a length prefixed field"""
+        length = _FIELD_LENGTH.unpack(self._read(_FIELD_LENGTH.size))[0]
+        return self._read(length)
+
+
+def _field(value):
+    """A length prefixed field (bytes)"""
+
+    if len(value) > 0xffff:
+        raise ValueError
+
+    return _FIELD_LENGTH.pack(len(value)) + value
+
+def _records(payload, field_count):
+    """Split a block payload into records (lists of field_count fields)"""
+
+    fields = []
+    i = 0
+    while i < len(payload):
+        if i + _FIELD_LENGTH.size > len(payload):
+            raise SnapshotError('Malformed record')
+        length = _FIELD_LENGTH.unpack_from(payload, i)[0]
+        i += _FIELD_LENGTH.size + length
+        if i > len(payload):
+            raise SnapshotError('Malformed record')
+        fields.append(payload[i - length:i])
+
+    if len(fields) % field_count != 0:
+        raise SnapshotError('Malformed record')
+
+    return [fields[i:i + field_count] for i in range(0, len(fields), field_count)]
+
+def _message2record(msg):
+    text = msg.text.encode() if isinstance(msg.text, str) else msg.text
+
+    return b''.join([_field(text),
+                     _field(b'' if msg.timestamp is None else encode_int(msg.timestamp)),
+                     _field(b'' if msg.receiver is None else msg.receiver),
+                     _field(b'' if msg.sender is None else msg.sender),
+                     _field(b'' if msg.sender is None else msg.signature)])
+
+def _record2message(fields):
+    text, timestamp, receiver, sender, signature = fields
+
+    try:
+        return Message(text if receiver else text.decode(), # Decode unless encrypted
+                       decode_int(timestamp) if timestamp else None,
+                       receiver or None,
+                       sender or None,
+                       signature or None)
+    except (ValueError, TypeError):
+        raise SnapshotError('Malformed message')
+
+def _identity2record(identity):
+    return b''.join([_field(encode_int(x)) for x in [identity.rsa_key.n,
+                                                     identity.rsa_key.e,
+                                                     identity.dsa_key.y,
+                                                     identity.dsa_key.g,
+                                                     identity.dsa_key.p,
+                                                     identity.dsa_key.q]])
+
+def _record2identity(fields):
+    try:
+        rsa_n, rsa_e, dsa_y, dsa_g, dsa_p, dsa_q = [decode_int(f) for f in fields]
+    except ValueError:
+        raise SnapshotError('Malformed identity')
+
+    return Identity(DSA_key(dsa_y, dsa_g, dsa_p, dsa_q), RSA_key(rsa_n, rsa_e))
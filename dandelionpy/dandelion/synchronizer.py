@@ -18,7 +18,7 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from dandelion.service import RepetitiveWorker
-from dandelion.network import Client
+from dandelion.network import Client, ConnectionPool
 from dandelion.discoverer import DiscovererException
 
 class Synchronizer(RepetitiveWorker):
@@ -29,11 +29,20 @@ class Synchronizer(RepetitiveWorker):
         self._config = config
         self._db = db
         self._discoverer = discoverer
+        self._pool = ConnectionPool(config.idle_timeout_sec, config.heartbeat_sec) if config.keep_alive else None
+
+    def stop(self):
+        """Stop the service and close the idle connections. Block until the service is stopped."""
+
+        super().stop()
+
+        if self._pool is not None:
+            self._pool.close()
 
     def sync(self, host, port):
         """Perform a synchronization with a specific node"""
 
-        with Client(host, port, self._db) as client:
+        with Client(host, port, self._db, self._config.bootstrap_snapshot, self._pool) as client:
             client.execute_transaction()
 
     def _do_sync(self):
@@ -41,8 +50,11 @@ class Synchronizer(RepetitiveWorker):
         and then perform the synchronization.
         """
 
+        if self._pool is not None:
+            self._pool.maintain()
+
         try:
-            host, port = self._discoverer.acquire_node()
+            host, port = self._discoverer.acquire_node(self._has_news)
         except DiscovererException:
             return
 
@@ -53,3 +65,13 @@ class Synchronizer(RepetitiveWorker):
         else:
             self._discoverer.release_node(host, port, True) # Ack success 
 
+    def _has_news(self, dbid, time_cookie):
+        """Check the time cookie a node announced against the one recorded at the last sync with it.
+        
+        Returns None if the node hasn't announced anything (see Discoverer.acquire_node).
+        """
+
+        if dbid is None or time_cookie is None:
+            return None
+
+        return time_cookie != self._db.get_last_time_cookie(dbid)
@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+from dandelion.bloomfilter import BloomFilter
+
+class BloomFilterTest(unittest.TestCase):
+    """Unit test suite for the BloomFilter class"""
+
+    def test_construction(self):
+        bf = BloomFilter(100)
+        self.assertEqual(bf.capacity, 100)
+        self.assertEqual(bf.count, 0)
+        self.assertTrue(bf.memory_bytes > 0)
+        self.assertEqual(bf.false_positive_rate, 0.0)
+
+        self.assertRaises(TypeError, BloomFilter, None)
+        self.assertRaises(TypeError, BloomFilter, 100, 1)
+        self.assertRaises(ValueError, BloomFilter, 0)
+        self.assertRaises(ValueError, BloomFilter, 100, 0.0)
+        self.assertRaises(ValueError, BloomFilter, 100, 1.0)
+
+    def test_add_contains(self):
+        bf = BloomFilter(1000)
+        keys = [str(i).encode() for i in range(1000)]
+
+        self.assertFalse(b'1337' in bf)
+
+        for key in keys:
+            bf.add(key)
+
+        # No false negatives
+        self.assertTrue(all(key in bf for key in keys))
+
+        # Keys that look like they are in the filter already don't count
+        count = bf.count
+        self.assertTrue(990 <= count <= 1000)
+        self.assertFalse(bf.add(keys[0]))
+        self.assertEqual(bf.count, count)
+
+        # False positive rate in the right ballpark
+        false_positives = sum(1 for i in range(10000) if ('x' + str(i)).encode() in bf)
+        self.assertTrue(false_positives < 300)
+        self.assertTrue(0.005 < bf.false_positive_rate < 0.02)
+
+        bf.clear()
+        self.assertEqual(bf.count, 0)
+        self.assertFalse(any(key in bf for key in keys))
+
+        self.assertRaises(TypeError, bf.add, None)
+        self.assertRaises(TypeError, bf.add, 'str')
+        self.assertRaises(TypeError, bf.__contains__, 1337)
+
+    def test_stats(self):
+        bf = BloomFilter(10)
+        bf.add(b'a')
+        stats = bf.stats
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['capacity'], 10)
+        self.assertEqual(stats['memory_bytes'], bf.memory_bytes)
+        self.assertTrue(stats['bits'] > 0)
+        self.assertTrue(stats['hashes'] > 0)
+        self.assertEqual(stats['false_positive_rate'], bf.false_positive_rate)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,7 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
 import os
+import tempfile
 
 from dandelion.config import *
 from dandelion.database import ContentDB
@@ -29,6 +30,16 @@ class ConfigTest(unittest.TestCase):
     TEST_FILE = os.path.join(os.path.split(os.path.abspath(__file__))[0],
                              'config_test_data.conf')
 
+    def setUp(self):
+        """Run in a temp dir, the data base file of the config is relative to it"""
+        self._cwd = os.getcwd()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp_dir.cleanup()
+
     def test_construction(self):
         cm = ConfigManager(ConfigTest.TEST_FILE)
         self.assertEqual(ConfigTest.TEST_FILE, cm.config_file)
@@ -37,6 +48,7 @@ class ConfigTest(unittest.TestCase):
         self.assertTrue(isinstance(cm.identity_manager_config, IdentityConfig))
         self.assertTrue(isinstance(cm.ui_config, UiConfig))
         self.assertTrue(isinstance(cm.content_db, ContentDB))
+        cm.content_db.close()
 
     def test_default_file(self):
         cm = ConfigManager()
@@ -47,5 +59,120 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual(sc.ip, '169.255.1.2')
         self.assertEqual(sc.port, 1234)
 
+    def test_server_config_db_pragmas(self):
+        sc = ServerConfig()
+        self.assertEqual(sc.db_pragmas, {'synchronous' : 'NORMAL', 'cache_size' : -8192,
+                                         'mmap_size' : 0, 'temp_store' : 'MEMORY'})
+
+        cm = ConfigManager(ConfigTest.TEST_FILE)
+        sc = cm.server_config
+        self.assertEqual(sc.db_synchronous, 'FULL')
+        self.assertEqual(sc.db_mmap_size, 1048576)
+        self.assertEqual(sc.db_cache_size, -8192)
+        self.assertEqual(sc.db_temp_store, 'MEMORY')
+        self.assertEqual(cm.content_db.pragmas, sc.db_pragmas)
+        cm.content_db.close()
+        self.assertEqual(sc.db_partition_sec, None)
+
+    def test_retention_config(self):
+        rc = ConfigManager(ConfigTest.TEST_FILE).retention_config
+        self.assertTrue(rc.policy.unlimited)
+        self.assertEqual(rc.interval_sec, 60)
+
+        confparser = configparser.ConfigParser()
+        confparser.read_string("[retention]\nmax_age_sec=3600\nmax_messages=1000\nkeep_own_messages=False\n")
+        rc = RetentionConfig()
+        rc.load(confparser)
+        self.assertEqual(rc.policy.max_age_sec, 3600)
+        self.assertEqual(rc.policy.max_messages, 1000)
+        self.assertEqual(rc.policy.max_db_bytes, None)
+        self.assertFalse(rc.policy.keep_own_messages)
+
+        stored = configparser.ConfigParser()
+        rc.store(stored)
+        rc2 = RetentionConfig()
+        rc2.load(stored)
+        self.assertEqual(rc2.policy.max_messages, 1000)
+        self.assertFalse(rc2.policy.keep_own_messages)
+
+    def test_synchronizer_config(self):
+        sc = ConfigManager(ConfigTest.TEST_FILE).synchronizer_config
+        self.assertFalse(sc.bootstrap_snapshot)
+        self.assertTrue(sc.keep_alive)
+        self.assertEqual(sc.idle_timeout_sec, 60)
+        self.assertEqual(sc.heartbeat_sec, 5)
+
+        confparser = configparser.ConfigParser()
+        confparser.read_string("[synchronizer]\nbootstrap_snapshot=True\nkeep_alive=False\nidle_timeout_sec=120\nheartbeat_sec=2\n")
+        sc = SynchronizerConfig()
+        sc.load(confparser)
+        self.assertTrue(sc.bootstrap_snapshot)
+        self.assertFalse(sc.keep_alive)
+        self.assertEqual(sc.idle_timeout_sec, 120)
+        self.assertEqual(sc.heartbeat_sec, 2)
+
+        stored = configparser.ConfigParser()
+        sc.store(stored)
+        sc2 = SynchronizerConfig()
+        sc2.load(stored)
+        self.assertTrue(sc2.bootstrap_snapshot)
+        self.assertFalse(sc2.keep_alive)
+        self.assertEqual(sc2.idle_timeout_sec, 120)
+        self.assertEqual(sc2.heartbeat_sec, 2)
+
+    def test_discoverer_config(self):
+        dc = DiscovererConfig()
+        self.assertEqual(dc.backend, 'mdns')
+
+        confparser = configparser.ConfigParser()
+        confparser.read_string("[discoverer]\nbackend=bonjour\n")
+        dc.load(confparser)
+        self.assertEqual(dc.backend, 'bonjour')
+
+        stored = configparser.ConfigParser()
+        dc.store(stored)
+        dc2 = DiscovererConfig()
+        dc2.load(stored)
+        self.assertEqual(dc2.backend, 'bonjour')
+
+        confparser = configparser.ConfigParser()
+        confparser.read_string("[discoverer]\nbackend=carrier_pigeon\n")
+        self.assertRaises(ConfigException, DiscovererConfig().load, confparser)
+
+    def test_announcer_config(self):
+        ac = ConfigManager(ConfigTest.TEST_FILE).announcer_config
+        self.assertTrue(ac.enabled)
+        self.assertEqual(ac.port, 1338)
+        self.assertEqual(ac.address, '255.255.255.255')
+        self.assertEqual(ac.interval_sec, 30)
+
+        confparser = configparser.ConfigParser()
+        confparser.read_string("[announcer]\nenabled=False\nport=4000\naddress=10.0.0.255\ninterval_sec=5\n")
+        ac = AnnouncerConfig()
+        ac.load(confparser)
+
+        stored = configparser.ConfigParser()
+        ac.store(stored)
+        ac2 = AnnouncerConfig()
+        ac2.load(stored)
+        self.assertFalse(ac2.enabled)
+        self.assertEqual(ac2.port, 4000)
+        self.assertEqual(ac2.address, '10.0.0.255')
+        self.assertEqual(ac2.interval_sec, 5)
+
+    def test_identity_config(self):
+        cm = ConfigManager(ConfigTest.TEST_FILE)
+        ic = cm.identity_manager_config
+        self.assertEqual(ic.my_id, None) # Not generated until used
+
+        stored = configparser.ConfigParser()
+        ic.store(stored)
+        self.assertFalse(stored.has_option('identity', 'myid'))
+
+        identity = cm.identity
+        self.assertTrue(identity is cm.identity)
+        self.assertEqual(decode_b64_bytes(ic.my_id.encode()), identity.fingerprint)
+        cm.content_db.close()
+
 if __name__ == '__main__':
     unittest.main()
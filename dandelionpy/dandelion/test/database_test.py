@@ -18,20 +18,30 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
+import unittest.mock
+import os
 import tempfile
+import sqlite3
+import threading
+import time
 import dandelion.message
 import dandelion.identity
 from dandelion.message import Message
-from dandelion.database import ContentDB, ContentDBException
+from dandelion.database import ContentDB, SQLiteContentDB, ContentDBException
+from dandelion.memorydb import MemoryContentDB
 from dandelion.identity import IdentityInfo
 
 class DatabaseTest(unittest.TestCase):
-    """Unit test suite for the InMemoryContentDB class"""
+    """Unit test suite for the ContentDB class (SQLite backend)"""
+
+    def _create_db(self):
+        """Create an empty data base of the backend under test"""
+        return SQLiteContentDB(tempfile.NamedTemporaryFile().name)
 
     def test_sqlite(self):
         """Perform some SQLite specific tests."""
         tmp = tempfile.NamedTemporaryFile()
-        sqlitedb = ContentDB(tmp.name)
+        sqlitedb = SQLiteContentDB(tmp.name)
 
         self.assertTrue(len(sqlitedb.id), ContentDB._DBID_LENGTH_BYTES)
         self.assertTrue(ContentDB._TCID_LENGTH_BYTES > 1)
@@ -42,7 +52,7 @@ class DatabaseTest(unittest.TestCase):
         tc1 = sqlitedb.add_messages([m1, Message('b')])
         self.assertEqual(sqlitedb.message_count, 2)
 
-        sqlitedb2 = ContentDB(tmp.name, sqlitedb.id) # New db is the same as old
+        sqlitedb2 = SQLiteContentDB(tmp.name, sqlitedb.id) # New db is the same as old
         self.assertEqual(sqlitedb.id, sqlitedb2.id)
         self.assertEqual(sqlitedb.message_count, 2)
 
@@ -58,10 +68,10 @@ class DatabaseTest(unittest.TestCase):
         self.assertRaises(ContentDBException, ContentDB.register, 23)
         self.assertRaises(ContentDBException, ContentDB.unregister)
 
-        db = ContentDB(":memory:")
+        db = SQLiteContentDB(":memory:")
         ContentDB.register(db)
         self.assertRaises(ContentDBException, ContentDB.register, db)
-        self.assertRaises(ContentDBException, ContentDB.register, ContentDB(":memory:"))
+        self.assertRaises(ContentDBException, ContentDB.register, SQLiteContentDB(":memory:"))
 
         db_back = ContentDB.db
         self.assertNotEqual(db_back, None)
@@ -72,7 +82,7 @@ class DatabaseTest(unittest.TestCase):
 
     def test_id(self):
         """Test data base id format"""
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         id = db.id
         self.assertNotEqual(id, None)
@@ -80,11 +90,11 @@ class DatabaseTest(unittest.TestCase):
         self.assertTrue(isinstance(db.id, bytes))
 
         # Another data base gets another id
-        self.assertNotEqual(id, ContentDB(":memory:").id)
+        self.assertNotEqual(id, SQLiteContentDB(":memory:").id)
 
     def test_remote_cookies(self):
         """Test the remote time cookie interface"""
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         remotefp_1 = b"1337"
         remotefp_2 = b"2342"
@@ -115,7 +125,7 @@ class DatabaseTest(unittest.TestCase):
     def test_time_cookies(self):
         """Test the data base time cookies (revision) functionality."""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         # Adding a message        
         first_msg = Message('A Single Message')
@@ -167,10 +177,184 @@ class DatabaseTest(unittest.TestCase):
         self.assertRaises(ValueError, db.get_messages, [], b'')
         self.assertRaises(ValueError, db.get_messages, [], b'1337')
 
+    def test_async_writes(self):
+        """Test asynchronous, group committed writes."""
+
+        db = self._create_db()
+        events = []
+        db.add_event_listener(lambda type, content, tc: events.append((type, content, tc)))
+
+        m1 = Message('M1')
+        future = db.add_messages_async([m1])
+        tc = future.result(5)
+        self.assertEqual(tc, db.get_last_time_cookie())
+        self.assertTrue(db.contains_message(m1.id))
+
+        id1 = dandelion.identity.generate()
+        tc2 = db.add_identities_async([id1]).result(5)
+        self.assertNotEqual(tc2, tc)
+        self.assertTrue(db.contains_identity(id1.fingerprint))
+
+        self.assertTrue(db.wait_for_listeners(5))
+        self.assertEqual(events, [("message", [m1], tc), ("identity", [id1], tc2)])
+
+        # Nothing new, same time cookie
+        self.assertEqual(db.add_messages_async([m1]).result(5), db.get_last_time_cookie())
+
+        self.assertRaises(TypeError, db.add_messages_async, None)
+        self.assertRaises(TypeError, db.add_identities_async, [None])
+
+    def test_write_from_writer_thread(self):
+        """Test that adding content from the writer thread doesn't deadlock."""
+
+        db = self._create_db()
+        m1 = Message('M1')
+        tcs = []
+
+        def on_commit(tc, inserted):
+            tcs.append(db.add_messages([m1]))
+
+        future = db._writer.submit(db._QUERY_ADD_MESSAGES, [], on_commit)
+        future.result(5)
+        self.assertTrue(db.contains_message(m1.id))
+        self.assertEqual(tcs, [db.get_last_time_cookie()])
+        db.close()
+
+    def test_writes_in_writer_thread(self):
+        """Test that updates and removals are written by the writer thread."""
+
+        db = self._create_db()
+        id1 = dandelion.identity.generate()
+        m1 = Message('M1')
+        db.add_messages([m1])
+        db.message_count # Pool a read connection
+
+        with unittest.mock.patch.object(db, '_connect', wraps=db._connect) as connect:
+            db.add_private_identity(id1)
+            db.set_nick(id1.fingerprint, 'me')
+            db.update_last_time_cookie(b'\x01', b'\x02')
+            db.compact_time_cookies()
+            db.remove_messages([m1])
+            db.remove_private_identity(id1)
+            connect.assert_not_called()
+
+        self.assertFalse(db.contains_message(m1.id))
+        self.assertFalse(db.contains_identity(id1.fingerprint))
+        self.assertEqual(db.get_last_time_cookie(b'\x01'), b'\x02')
+
+        """A failing write is rolled back"""
+        def write(c):
+            c.execute("DELETE FROM remote_time_cookies")
+            raise ValueError
+
+        self.assertRaises(ValueError, db._write, write)
+        self.assertEqual(db.get_last_time_cookie(b'\x01'), b'\x02')
+        db.close()
+
+    def test_event_listeners(self):
+        """Test the delivery of content events to the listeners."""
+
+        db = self._create_db()
+        fast_events, slow_events = [], []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def slow_listener(type, content, tc):
+            blocked.set()
+            release.wait(5)
+            slow_events.append((type, content, tc))
+
+        db.add_event_listener(slow_listener)
+        db.add_event_listener(lambda type, content, tc: fast_events.append((type, content, tc)))
+        db.add_event_listener(lambda type, content, tc: 1 / 0) # Failing listeners are reported and skipped
+
+        m1, m2, m3 = Message('M1'), Message('M2'), Message('M3')
+        with unittest.mock.patch('traceback.print_exc') as print_exc:
+            tc1 = db.add_messages([m1])
+            self.assertTrue(blocked.wait(5))
+            for _ in range(100):
+                if print_exc.called:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(print_exc.called)
+
+        # The slow listener doesn't hold up the writes or the other listeners
+        tc2 = db.add_messages([m1, m2]) # Only m2 is new
+        self.assertEqual(db.add_messages([m1]), tc2) # Nothing new, no event
+        tc3 = db.add_messages([m3])
+        id1 = dandelion.identity.generate()
+        tc4 = db.add_identities([id1])
+        for _ in range(100):
+            if len(fast_events) == 4:
+                break
+            time.sleep(0.01)
+        self.assertEqual(fast_events, [("message", [m1], tc1), ("message", [m2], tc2),
+                                       ("message", [m3], tc3), ("identity", [id1], tc4)])
+        self.assertEqual(slow_events, [])
+
+        # ... and gets the queued events coalesced
+        release.set()
+        self.assertTrue(db.wait_for_listeners(5))
+        self.assertEqual(slow_events, [("message", [m1], tc1), ("message", [m2, m3], tc3),
+                                       ("identity", [id1], tc4)])
+
+        db.close()
+
+    def test_close_with_stuck_listener(self):
+        """Test that closing doesn't wait forever for a listener."""
+
+        db = self._create_db()
+        release = threading.Event()
+        db.add_event_listener(lambda type, content, tc: release.wait(5))
+        db.add_messages([Message('M1')])
+
+        with unittest.mock.patch.object(ContentDB, '_CLOSE_TIMEOUT_SEC', 0.1):
+            t1 = time.time()
+            db.close()
+            self.assertTrue(time.time() - t1 < 2)
+
+        release.set()
+        self.assertTrue(db.wait_for_listeners(5))
+
+    def test_group_commit(self):
+        """Test that queued writes are committed together."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name)
+
+        # Block the writer so that the requests queue up and get committed together
+        blocker = sqlite3.connect(tmp.name)
+        blocker.execute("BEGIN EXCLUSIVE")
+        msgs = [Message(str(i)) for i in range(10)]
+        futures = [db.add_messages_async([m]) for m in msgs]
+        bad_future = db.add_messages_async([dandelion.message.restore(b'bad', object())])
+        time.sleep(0.1)
+        blocker.rollback()
+        blocker.close()
+
+        cookies = set(f.result(5) for f in futures)
+        self.assertTrue(len(cookies) <= 2)
+        self.assertTrue(db.get_last_time_cookie() in cookies)
+        self.assertEqual(db.message_count, 10)
+        self.assertTrue(all(db.contains_message(m.id) for m in msgs))
+
+        # A failing request doesn't affect the others
+        self.assertIsNotNone(bad_future.exception(5))
+
+        # Nothing new, same time cookie
+        self.assertEqual(db.add_messages_async(msgs).result(5), db.get_last_time_cookie())
+
+        db.close()
+        self.assertIsNone(db._writer._thread)
+        m2 = Message('M2')
+        db.add_messages([m2])
+        self.assertTrue(db.contains_message(m2.id))
+        db.close()
+
     def test_message_interface(self):
         """Test functions relating to storing and recovering messages."""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         id1 = dandelion.identity.generate()
         id2 = dandelion.identity.generate()
@@ -182,7 +366,8 @@ class DatabaseTest(unittest.TestCase):
         # Try to add junk
         self.assertRaises(TypeError, db.add_messages, None)
         self.assertRaises(TypeError, db.add_messages, 23)
-        self.assertRaises(AttributeError, db.add_messages, [None])
+        self.assertRaises(TypeError, db.add_messages, [None])
+        self.assertRaises(TypeError, db.add_messages_async, [Message("A"), "B"])
 
         # Add a message list        
         self.assertEqual(db.message_count, 0)
@@ -219,10 +404,71 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual([db.contains_message(m.id) for m in first_msg_list], [False, False, False, False, False, False])
         self.assertEqual([db.contains_message(m.id) for m in second_msg_list], [False, False])
 
+    def test_missing_content(self):
+        """Test the missing message and identity lookups."""
+
+        db = self._create_db()
+
+        id_a = dandelion.identity.generate()
+        id_b = dandelion.identity.generate()
+        m1, m2, m3 = Message('M1'), Message('M2'), Message('M3')
+        db.add_identities([id_a])
+        db.add_messages([m1, m2])
+
+        self.assertEqual(db.missing_messages([m1.id, m2.id, m3.id]), [m3.id])
+        self.assertEqual(db.missing_messages([]), [])
+        self.assertEqual(db.missing_identities([id_a.fingerprint, id_b.fingerprint]), [id_b.fingerprint])
+
+        db.remove_messages([m1])
+        self.assertEqual(db.missing_messages([m1.id, m2.id, m3.id]), [m1.id, m3.id])
+        self.assertFalse(db.contains_message(m1.id))
+
+        db.remove_identities()
+        self.assertEqual(db.missing_identities([id_a.fingerprint]), [id_a.fingerprint])
+
+        self.assertRaises(TypeError, db.missing_messages, None)
+        self.assertRaises(TypeError, db.missing_messages, [None])
+        self.assertRaises(TypeError, db.missing_identities, 23)
+
+    def test_filter_stats(self):
+        """Test the stats for the message and identity filters."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name)
+
+        stats = db.filter_stats
+        self.assertEqual(stats['messages']['count'], 0)
+        self.assertEqual(stats['identities']['count'], 0)
+
+        msgs = [Message(str(i)) for i in range(10)]
+        db.add_messages(msgs)
+        db.add_identities([dandelion.identity.generate()])
+
+        stats = db.filter_stats
+        self.assertEqual(stats['messages']['count'], 10)
+        self.assertEqual(stats['identities']['count'], 1)
+        self.assertTrue(stats['messages']['memory_bytes'] > 0)
+        self.assertTrue(0.0 < stats['messages']['false_positive_rate'] < 0.01)
+
+        db.remove_messages(msgs[:2])
+        self.assertEqual(db.filter_stats['messages']['removed'], 2)
+
+        # Reopening the data base loads the filters from the stored content
+        db = SQLiteContentDB(tmp.name, db.id)
+        self.assertEqual(db.filter_stats['messages']['count'], 8)
+        self.assertEqual(db.filter_stats['messages']['removed'], 0)
+        self.assertTrue(all(db.contains_message(m.id) for m in msgs[2:]))
+
+        # Filters are rebuilt when full
+        more_msgs = [Message('x' + str(i)) for i in range(3000)]
+        db.add_messages(more_msgs)
+        self.assertTrue(db.filter_stats['messages']['capacity'] >= 3008)
+        self.assertTrue(all(db.contains_message(m.id) for m in more_msgs))
+
     def test_get_messages(self):
         """Test message retrieval."""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         _, mlist = db.get_messages()
         self.assertEqual(mlist, [])
@@ -246,10 +492,71 @@ class DatabaseTest(unittest.TestCase):
         self.assertFalse(m2 in mlist)
         self.assertTrue(m3 in mlist)
 
+    def test_get_messages_many_ids(self):
+        """Test message retrieval for more ids than fit in one query."""
+
+        db = self._create_db()
+
+        msgs = [Message(str(i)) for i in range(2 * SQLiteContentDB._MAX_QUERY_PARAMETERS + 1)]
+        db.add_messages(msgs)
+
+        _, mlist = db.get_messages([m.id for m in msgs[1:]])
+        self.assertEqual(mlist, msgs[1:])
+
+        # In storage order across the queries, without duplicates
+        _, mlist = db.get_messages([m.id for m in reversed(msgs)] + [msgs[0].id])
+        self.assertEqual(mlist, msgs)
+
+        ids = [dandelion.identity.generate() for _ in range(3)]
+        db.add_identities(ids)
+        with unittest.mock.patch.object(SQLiteContentDB, '_MAX_QUERY_PARAMETERS', 2):
+            _, idlist = db.get_identities([id.fingerprint for id in reversed(ids)] + [ids[0].fingerprint])
+        self.assertEqual(idlist, ids)
+
+        _, mlist = db.get_messages([])
+        self.assertEqual(mlist, [])
+
+    def test_get_message_ids(self):
+        """Test message id retrieval."""
+
+        db = self._create_db()
+
+        tc, msgids = db.get_message_ids()
+        self.assertEqual(msgids, [])
+        self.assertEqual(tc, db.get_last_time_cookie())
+
+        id1 = dandelion.identity.generate()
+        m1 = Message('M1')
+        m2 = dandelion.message.create('M2', 1337, id1, id1)
+        m3 = Message('M3')
+
+        first_tc = db.add_messages([m1, m2])
+        second_tc = db.add_messages([m3])
+
+        tc, msgids = db.get_message_ids()
+        self.assertEqual(tc, second_tc)
+        self.assertEqual(sorted(msgids), sorted([m1.id, m2.id, m3.id]))
+
+        tc, msgids = db.get_message_ids(time_cookie=first_tc)
+        self.assertEqual(tc, second_tc)
+        self.assertEqual(msgids, [m3.id])
+
+        tc, msgids = db.get_message_ids(time_cookie=second_tc)
+        self.assertEqual(msgids, [])
+
+        # The ids read back are the stored ids
+        _, mlist = db.get_messages()
+        self.assertEqual(sorted([m.id for m in mlist]), sorted([m1.id, m2.id, m3.id]))
+
+        # Trying some bad input
+        self.assertRaises(TypeError, db.get_message_ids, 'fubar')
+        self.assertRaises(ValueError, db.get_message_ids, b'')
+        self.assertRaises(ValueError, db.get_message_ids, b'1337')
+
     def test_identity_interface(self):
         """Test functions relating to storing and recovering identities."""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         _, idlist = db.get_identities()
         self.assertEqual(idlist, [])
@@ -262,7 +569,8 @@ class DatabaseTest(unittest.TestCase):
         # Try to add junk
         self.assertRaises(TypeError, db.add_identities, None)
         self.assertRaises(TypeError, db.add_identities, 23)
-        self.assertRaises(AttributeError, db.add_identities, [None])
+        self.assertRaises(TypeError, db.add_identities, [None])
+        self.assertRaises(TypeError, db.add_identities_async, [Message("A")])
 
         # Add a message list
         self.assertEqual(db.identity_count, 0)
@@ -302,7 +610,7 @@ class DatabaseTest(unittest.TestCase):
     def test_get_identities(self):
         """Test identity retrieval."""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         id1 = dandelion.identity.generate()
         id2 = dandelion.identity.generate().public_identity()
@@ -327,10 +635,485 @@ class DatabaseTest(unittest.TestCase):
             self.assertFalse(id.rsa_key.is_private)
             self.assertFalse(id.dsa_key.is_private)
 
+    def test_find_identities(self):
+        """Test the filtered and paged identity iteration."""
+
+        db = self._create_db()
+
+        id1 = dandelion.identity.generate().public_identity()
+        id2 = dandelion.identity.generate().public_identity()
+        tc = db.add_identities([id1])
+        db.add_identities([id2])
+        db.set_nick(id2.fingerprint, 'Bob')
+
+        self.assertEqual(list(db.find_identities()), [id1, id2])
+        self.assertEqual(list(db.find_identities(limit=1, offset=1)), [id2])
+        self.assertEqual(list(db.find_identities(time_cookie=tc)), [id2])
+        self.assertEqual(list(db.find_identities(nick='bo')), [id2])
+        self.assertEqual(list(db.find_identities(nick='alice')), [])
+
+        self.assertRaises(TypeError, db.find_identities, nick=1)
+        self.assertRaises(ValueError, db.find_identities, limit=-1)
+
+    def test_connections(self):
+        """Test WAL mode, connection pragmas and reads during writes."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name, pragmas={'synchronous' : 'FULL', 'cache_size' : -1024})
+        self.assertEqual(db.pragmas, {'synchronous' : 'FULL', 'cache_size' : -1024,
+                                      'mmap_size' : 0, 'temp_store' : 'MEMORY'})
+
+        with sqlite3.connect(tmp.name) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+        with db._reading() as c:
+            self.assertEqual(c.execute("PRAGMA synchronous").fetchone()[0], 2) # FULL
+            self.assertEqual(c.execute("PRAGMA cache_size").fetchone()[0], -1024)
+            self.assertEqual(c.execute("PRAGMA temp_store").fetchone()[0], 2) # MEMORY
+
+        self.assertRaises(TypeError, SQLiteContentDB, tmp.name, None, [])
+        self.assertRaises(TypeError, SQLiteContentDB, tmp.name, None, {'cache_size' : 1.5})
+        self.assertRaises(ValueError, SQLiteContentDB, tmp.name, None, {'journal_mode' : 'DELETE'})
+        self.assertRaises(ValueError, SQLiteContentDB, tmp.name, None, {'synchronous' : 'OFF; DROP TABLE messages'})
+
+        # Readers are not blocked by a writer
+        db.add_messages([Message('M1')])
+        blocker = sqlite3.connect(tmp.name)
+        blocker.execute("BEGIN EXCLUSIVE")
+        blocker.execute("DELETE FROM messages")
+        self.assertEqual(db.message_count, 1)
+        self.assertEqual(len(db.get_messages()[1]), 1)
+        blocker.commit()
+        blocker.close()
+        self.assertEqual(db.message_count, 0)
+
+        # Short lived threads share a bounded pool of read connections
+        threads = [threading.Thread(target=lambda: db.message_count) for _ in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(0 < len(db._idle_readers) <= SQLiteContentDB._MAX_IDLE_READERS)
+
+        db.close()
+        self.assertEqual(db._idle_readers, [])
+        self.assertEqual(db.message_count, 0) # Reconnects
+
+    def test_counts(self):
+        """Test that the message and identity counts are kept up to date."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name)
+        msgs = [Message(str(i)) for i in range(10)]
+        db.add_messages(msgs)
+        db.add_messages(msgs[:5]) # Already there
+        db.add_identities([dandelion.identity.generate()])
+        self.assertEqual((db.message_count, db.identity_count), (10, 1))
+
+        db.remove_messages(msgs[:3] + [Message('Not there')])
+        self.assertEqual(db.message_count, 7)
+        self.assertEqual(db.prune_messages(max_count=5), 2)
+        self.assertEqual(db.message_count, 5)
+
+        # Changes by other connections are counted too
+        with sqlite3.connect(tmp.name) as conn:
+            conn.execute("DELETE FROM messages WHERE msg = ?", ('9',))
+        self.assertEqual(db.message_count, 4)
+
+        # Existing data bases get their counts when opened
+        with sqlite3.connect(tmp.name) as conn:
+            conn.execute("DROP TABLE content_counts")
+            conn.execute("DROP TRIGGER messages_count_insert")
+        db = SQLiteContentDB(tmp.name, db.id)
+        self.assertEqual((db.message_count, db.identity_count), (4, 1))
+        db.remove_messages()
+        db.remove_identities()
+        self.assertEqual((db.message_count, db.identity_count), (0, 0))
+
+        with db._reading() as c:
+            plan = " ".join(row[-1] for row in c.execute("EXPLAIN QUERY PLAN " + db._QUERY_GET_COUNT.format('main'), ('messages',)))
+            self.assertFalse("SCAN" in plan, plan)
+
+    def test_indexed_queries(self):
+        """Test the receiver, sender and recent message queries."""
+
+        db = self._create_db()
+        id1 = dandelion.identity.generate()
+        id2 = dandelion.identity.generate()
+
+        m1 = Message('M1', timestamp=100)
+        m2 = dandelion.message.create('M2', timestamp=300, sender=id1, receiver=id2)
+        m3 = dandelion.message.create('M3', timestamp=200, sender=id2, receiver=id1)
+        m4 = dandelion.message.create('M4', sender=id1)
+        db.add_messages([m1, m2, m3, m4])
+
+        self.assertEqual(db.get_messages_for_receiver(id1.fingerprint), [m3])
+        self.assertEqual(db.get_messages_for_receiver(id2.fingerprint), [m2])
+        self.assertEqual(db.get_messages_by_sender(id1.fingerprint), [m2, m4])
+        self.assertEqual(db.get_messages_by_sender(id1.fingerprint, 1), [m2])
+        self.assertEqual(db.get_messages_by_sender(b'unknown'), [])
+
+        self.assertEqual(db.get_recent_messages(10)[1], [m2, m3, m1])
+        cursor, msgs = db.get_recent_messages(2)
+        self.assertEqual(msgs, [m2, m3])
+        self.assertEqual(db.get_recent_messages(2, before=cursor), (db.get_recent_messages(3)[0], [m1]))
+        self.assertEqual(db.get_recent_messages(2, before=db.get_recent_messages(3)[0]), (db.get_recent_messages(3)[0], []))
+        self.assertEqual(db.get_recent_messages(0), (None, []))
+
+        # Paging doesn't skip messages sharing a timestamp
+        same = [Message('Same %d' % i, timestamp=150) for i in range(5)]
+        db.add_messages(same)
+        cursor, page = db.get_recent_messages(2, before=cursor)
+        paged = page
+        while page:
+            cursor, page = db.get_recent_messages(2, before=cursor)
+            paged += page
+        self.assertEqual(paged, list(reversed(same)) + [m1])
+
+        self.assertRaises(TypeError, db.get_messages_for_receiver, None)
+        self.assertRaises(ValueError, db.get_messages_by_sender, b'')
+        self.assertRaises(TypeError, db.get_messages_by_sender, id1.fingerprint, 'a')
+        self.assertRaises(ValueError, db.get_recent_messages, -1)
+        self.assertRaises(TypeError, db.get_recent_messages, 1, 300)
+        self.assertRaises(TypeError, db.get_recent_messages, 1, (300, '1'))
+
+    def test_find_messages(self):
+        """Test the filtered and paged message iteration."""
+
+        db = self._create_db()
+        id1 = dandelion.identity.generate()
+        id2 = dandelion.identity.generate()
+
+        m1 = Message('Hello 100%')
+        m2 = dandelion.message.create('hello world', sender=id1)
+        m3 = dandelion.message.create('M3', sender=id2, receiver=id1)
+        tc = db.add_messages([m1])
+        db.add_messages([m2])
+        db.add_messages([m3])
+
+        self.assertEqual(list(db.find_messages()), [m1, m2, m3])
+        self.assertEqual(list(db.find_messages(limit=2)), [m1, m2])
+        self.assertEqual(list(db.find_messages(limit=2, offset=2)), [m3])
+        self.assertEqual(list(db.find_messages(offset=3)), [])
+        self.assertEqual(list(db.find_messages(time_cookie=tc)), [m2, m3])
+        self.assertEqual(list(db.find_messages(sender=id1.fingerprint)), [m2])
+        self.assertEqual(list(db.find_messages(receiver=id1.fingerprint)), [m3])
+        self.assertEqual(list(db.find_messages(sender=id2.fingerprint, receiver=id2.fingerprint)), [])
+        self.assertEqual(list(db.find_messages(text='HELLO')), [m1, m2])
+        self.assertEqual(list(db.find_messages(text='0%')), [m1])
+        self.assertEqual(list(db.find_messages(text='_')), [])
+
+        self.assertRaises(TypeError, db.find_messages, limit='1')
+        self.assertRaises(ValueError, db.find_messages, offset=-1)
+        self.assertRaises(TypeError, db.find_messages, sender='fp')
+        self.assertRaises(ValueError, db.find_messages, receiver=b'')
+        self.assertRaises(TypeError, db.find_messages, text=b'hello')
+        self.assertRaises(ValueError, db.find_messages, time_cookie=b'unknown')
+
+    def test_find_messages_batches(self):
+        """Test that the message iteration reads a batch at a time, without holding a read snapshot."""
+
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        msgs = [Message(str(i)) for i in range(2 * db._FETCH_SIZE + 1)]
+        db.add_messages(msgs)
+
+        self.assertEqual(list(db.find_messages()), msgs)
+        self.assertEqual(list(db.find_messages(limit=db._FETCH_SIZE + 1, offset=1)), msgs[1:db._FETCH_SIZE + 2])
+        self.assertEqual(list(db.find_messages(offset=db._FETCH_SIZE)), msgs[db._FETCH_SIZE:])
+
+        it = db.find_messages()
+        self.assertEqual(next(it), msgs[0])
+        new = Message('New')
+        db.add_messages([new])
+        self.assertEqual(db.message_count, len(msgs) + 1) # Reads on the same thread see the new message
+        self.assertEqual(list(it), msgs[1:] + [new])
+
+        db.close()
+
+    def test_query_plans(self):
+        """Test that the message queries are index lookups, not table scans or sorts."""
+
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        plans = [(db._QUERY_GET_MESSAGES_FOR_RECEIVER, (b'', 1), 'messages_receiver'),
+                 (db._QUERY_GET_MESSAGES_BY_SENDER, (b'', 1), 'messages_sender'),
+                 (db._QUERY_GET_RECENT_MESSAGES, (1,), 'messages_timestamp'),
+                 (db._QUERY_GET_RECENT_MESSAGES_BEFORE, (1, 1, 1), 'messages_timestamp'),
+                 ("""SELECT msgid FROM messages WHERE cookieid > (SELECT id FROM time_cookies WHERE cookie = ?)""", 
+                  ('',), 'messages_cookieid')]
+
+        with db._reading() as c:
+            for sql, params, index in plans:
+                plan = " ".join(row[-1] for row in c.execute("EXPLAIN QUERY PLAN " + sql, params))
+                self.assertTrue("USING INDEX " + index in plan, plan)
+                self.assertFalse("TEMP B-TREE" in plan, plan)
+                self.assertFalse("SCAN messages" in plan, plan)
+
+    def test_inbox(self):
+        """Test reading and decrypting the messages to the private identities."""
+
+        db = self._create_db()
+        me = dandelion.identity.generate()
+        other = dandelion.identity.generate()
+        db.add_private_identity(me)
+
+        m1 = dandelion.message.create('To me', receiver=me)
+        m2 = dandelion.message.create('To other', receiver=other)
+        m3 = dandelion.message.create('Signed to me', sender=other, receiver=me)
+        m4 = Message('Public')
+        db.add_messages([m1, m2, m3, m4])
+
+        self.assertEqual(db.get_inbox(), [(m1, 'To me'), (m3, 'Signed to me')])
+        self.assertEqual(db.get_inbox(1), [(m1, 'To me')])
+
+        # Decrypted once
+        decrypted = []
+        decrypt = dandelion.identity.PrivateIdentity.decrypt
+        def counting_decrypt(identity, ciphertext):
+            decrypted.append(ciphertext)
+            return decrypt(identity, ciphertext)
+
+        dandelion.identity.PrivateIdentity.decrypt = counting_decrypt
+        try:
+            m5 = dandelion.message.create('Later', receiver=me)
+            db.add_messages([m5])
+            self.assertEqual(db.get_inbox(), [(m1, 'To me'), (m3, 'Signed to me'), (m5, 'Later')])
+            self.assertEqual(db.get_inbox()[-1], (m5, 'Later'))
+            self.assertEqual(decrypted, [m5.text])
+        finally:
+            dandelion.identity.PrivateIdentity.decrypt = decrypt
+
+        # The plaintexts are local only
+        self.assertEqual(db.get_messages()[1], [m1, m2, m3, m4, m5])
+        self.assertEqual(set(db.get_message_ids()[1]), set(m.id for m in [m1, m2, m3, m4, m5]))
+
+        db.remove_messages([m1])
+        self.assertEqual(db.get_inbox(), [(m3, 'Signed to me'), (m5, 'Later')])
+
+        db.remove_private_identity(me, keep_public_identity=True)
+        self.assertEqual(db.get_inbox(), [])
+        if isinstance(db, SQLiteContentDB):
+            with db._reading() as c:
+                self.assertEqual(c.execute("SELECT count(*) FROM inbox").fetchone()[0], 0)
+
+        self.assertRaises(TypeError, db.get_inbox, '1')
+
+    def test_prune_messages(self):
+        """Test removing old messages and unused time cookies."""
+
+        db = self._create_db()
+        me = dandelion.identity.generate()
+        db.add_private_identity(me)
+
+        old = [Message('Old {0}'.format(i), timestamp=100 + i) for i in range(5)]
+        own = dandelion.message.create('Mine', timestamp=50, sender=me)
+        new = [Message('New {0}'.format(i), timestamp=1000 + i) for i in range(5)]
+        untimed = Message('No time')
+        for m in old + [own] + new + [untimed]:
+            db.add_messages([m])
+
+        self.assertEqual(db.prune_messages(), 0)
+        self.assertEqual(db.prune_messages(older_than=200, limit=2), 2)
+        self.assertEqual(db.prune_messages(older_than=200), 3)
+        self.assertFalse(any(db.contains_message(m.id) for m in old))
+        self.assertTrue(db.contains_message(own.id))
+        self.assertEqual(db.message_count, 7)
+
+        # Earliest stored first
+        self.assertEqual(db.prune_messages(max_count=5), 2)
+        self.assertEqual(db.get_messages()[1], [own] + new[2:] + [untimed])
+
+        self.assertEqual(db.prune_messages(max_count=0, keep_own=True, limit=1), 1)
+        self.assertEqual(db.prune_messages(max_count=0, keep_own=False), 4)
+        self.assertEqual(db.message_count, 0)
+
+        # Size limit
+        max_bytes = db.used_bytes + 40000
+        db.add_messages([Message('x' * 100 + str(i)) for i in range(500)])
+        self.assertTrue(db.used_bytes > max_bytes)
+        while db.prune_messages(max_bytes=max_bytes, limit=10) > 0:
+            pass
+        self.assertTrue(db.used_bytes <= max_bytes)
+        self.assertTrue(db.message_count > 0)
+
+        self.assertRaises(TypeError, db.prune_messages, older_than='1')
+        self.assertRaises(ValueError, db.prune_messages, max_count=-1)
+        self.assertRaises(ValueError, db.prune_messages, limit=-1)
+
+    def test_compact_time_cookies(self):
+        """Test removing unused time cookies."""
+
+        db = self._create_db()
+        msgs = [Message(str(i)) for i in range(5)]
+        cookies = [db.add_messages([m]) for m in msgs]
+
+        db.remove_messages(msgs[:3])
+        self.assertEqual(db.compact_time_cookies(limit=1), 1)
+        self.assertEqual(db.compact_time_cookies(), 3) # Including the initial cookie
+        self.assertEqual(db.compact_time_cookies(), 0)
+
+        self.assertFalse(any(db.contains_time_cookie(tc) for tc in cookies[:3]))
+        self.assertTrue(all(db.contains_time_cookie(tc) for tc in cookies[3:]))
+        self.assertEqual(db.get_message_ids(cookies[3])[1], [msgs[4].id])
+
+        # The current time cookie is kept
+        db.remove_messages()
+        self.assertEqual(db.compact_time_cookies(), 1)
+        self.assertEqual(db.get_last_time_cookie(), cookies[4])
+        self.assertTrue(db.contains_time_cookie(cookies[4]))
+
+        self.assertRaises(TypeError, db.contains_time_cookie, None)
+
+        # Cookies newer than the oldest message are kept for incremental syncs
+        db = self._create_db()
+        msgs = [Message(str(i)) for i in range(4)]
+        cookies = [db.add_messages([m]) for m in msgs]
+
+        db.remove_messages([msgs[0], msgs[2]])
+        self.assertEqual(db.compact_time_cookies(), 2) # The initial cookie and cookies[0]
+        self.assertFalse(db.contains_time_cookie(cookies[0]))
+        self.assertTrue(all(db.contains_time_cookie(tc) for tc in cookies[1:]))
+        self.assertEqual(db.get_message_ids(cookies[2])[1], [msgs[3].id])
+
+    def test_partitions(self):
+        """Test storing messages in one file per time window."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name, partition_sec=1000)
+        me = dandelion.identity.generate()
+        other = dandelion.identity.generate()
+        db.add_private_identity(me)
+
+        now = int(time.time())
+        w = now - now % 1000 # Current window
+        m1 = Message('Untimed')
+        m2 = Message('Previous window', timestamp=w - 500)
+        m3 = dandelion.message.create('Mine', timestamp=w - 300, sender=me)
+        m4 = dandelion.message.create('To me', timestamp=w + 100, sender=other, receiver=me)
+        m5 = Message('Current window', timestamp=w)
+        msgs = [m1, m2, m3, m4, m5]
+        tc = db.add_messages(msgs)
+        self.assertEqual(db.add_messages(msgs), tc)
+
+        self.assertEqual(db.partition_windows, [(w - 1000, w), (w, w + 1000)])
+        self.assertTrue(os.path.exists(tmp.name + '.%d.part' % (w - 1000)))
+        self.assertTrue(os.path.exists(tmp.name + '.%d.part' % w))
+        with sqlite3.connect(tmp.name + '.%d.part' % w) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM messages").fetchone()[0], 2)
+
+        # Reads see all partitions, in storage order
+        self.assertEqual(db.message_count, 5)
+        self.assertEqual(db.get_messages()[1], msgs)
+        self.assertEqual(db.get_messages([m5.id, m1.id])[1], [m1, m5])
+        self.assertTrue(all(db.contains_message(m.id) for m in msgs))
+        self.assertEqual(db.missing_messages([m2.id, b'missing']), [b'missing'])
+        self.assertEqual(db.get_messages_by_sender(me.fingerprint), [m3])
+        self.assertEqual(db.get_recent_messages(2)[1], [m4, m5])
+        self.assertEqual(db.get_inbox(), [(m4, 'To me')])
+
+        m6 = Message('Next window', timestamp=w + 1500)
+        tc2 = db.add_messages([m6])
+        self.assertEqual(db.get_messages(time_cookie=tc)[1], [m6])
+        self.assertEqual(len(db.partition_windows), 3)
+
+        # Reopen
+        db2 = SQLiteContentDB(tmp.name, db.id, partition_sec=1000)
+        self.assertEqual(db2.get_messages()[1], msgs + [m6])
+        self.assertEqual(db2.get_last_time_cookie(), tc2)
+
+        # Timestamps far from now stay in the main data base
+        m7 = Message('Far future', timestamp=w + 100000)
+        m8 = Message('Far past', timestamp=w - 100000)
+        db.add_messages([m7, m8])
+        self.assertEqual(len(db.partition_windows), 3)
+        db.remove_messages([m7, m8])
+
+        # Drop old windows, keeping own messages
+        self.assertEqual(db.drop_partitions(w - 1), 0)
+        self.assertEqual(db.drop_partitions(w + 1000), 3)
+        self.assertEqual(db.partition_windows, [(w + 1000, w + 2000)])
+        self.assertFalse(os.path.exists(tmp.name + '.%d.part' % (w - 1000)))
+        self.assertEqual(db.get_messages()[1], [m1, m3, m6])
+        self.assertFalse(db.contains_message(m2.id))
+        self.assertEqual(db.get_inbox(), [])
+
+        db.remove_messages([m6])
+        self.assertEqual(db.get_messages()[1], [m1, m3])
+        db.remove_messages()
+        self.assertEqual(db.message_count, 0)
+
+        self.assertEqual(SQLiteContentDB(tempfile.NamedTemporaryFile().name).drop_partitions(3000), 0)
+        self.assertRaises(TypeError, SQLiteContentDB, tmp.name, None, None, '1000')
+        self.assertRaises(ValueError, SQLiteContentDB, tmp.name, None, None, 0)
+        self.assertRaises(ValueError, SQLiteContentDB, ":memory:", None, None, 1000)
+        self.assertRaises(TypeError, db.drop_partitions, None)
+
+        db.close()
+        db2.close()
+        db.drop_partitions(10000)
+
+    def test_partition_eviction(self):
+        """Test that old partitions are merged into the main data base to make room for new windows."""
+
+        tmp = tempfile.NamedTemporaryFile()
+        db = SQLiteContentDB(tmp.name, partition_sec=1000)
+        max_partitions = dandelion.database._MessagePartitions._MAX_PARTITIONS
+
+        msgs = [Message('Window %d' % i, timestamp=i * 1000) for i in range(max_partitions)]
+        with unittest.mock.patch('dandelion.database.time') as clock:
+            clock.time.return_value = (max_partitions - 2) * 1000
+            db.add_messages(msgs)
+            self.assertEqual(len(db.partition_windows), max_partitions)
+
+            # Time goes on, the oldest window rolls over
+            clock.time.return_value = (max_partitions - 1) * 1000
+            new = Message('New window', timestamp=max_partitions * 1000)
+            db.add_messages([new])
+
+        self.assertEqual(db.partition_windows, [(i * 1000, (i + 1) * 1000) for i in range(1, max_partitions + 1)])
+        self.assertFalse(os.path.exists(tmp.name + '.0.part'))
+        self.assertEqual(db.get_messages()[1], msgs + [new])
+        self.assertEqual(db.message_count, max_partitions + 1)
+        self.assertEqual(db.get_recent_messages(1, before=db.get_recent_messages(max_partitions)[0])[1], [msgs[0]])
+
+        db.close()
+        db.drop_partitions(100000)
+
+    def test_identity_cache(self):
+        """Test that identities read from the data base are cached."""
+
+        db = self._create_db()
+
+        id1 = dandelion.identity.generate()
+        id2 = dandelion.identity.generate()
+        db.add_identities([id1, id2])
+
+        _, first = db.get_identities()
+        _, second = db.get_identities()
+        self.assertEqual(first, [id1, id2])
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertIs(db.get_identities([id2.fingerprint])[1][0], first[1])
+
+        # Removing an identity drops it from the cache
+        db.remove_identities([id1])
+        _, idlist = db.get_identities()
+        self.assertEqual(idlist, [id2])
+        self.assertIs(idlist[0], first[1])
+
+        db.add_identities([id1])
+        _, idlist = db.get_identities([id1.fingerprint])
+        self.assertEqual(idlist, [id1])
+        self.assertIsNot(idlist[0], first[0])
+
+        # ... and removing all of them empties it
+        db.remove_identities()
+        self.assertEqual(len(db._identity_cache), 0)
+        self.assertEqual(db.get_identities()[1], [])
+
     def test_private_identities(self):
         """Test private id interface"""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
         id_priv = dandelion.identity.generate()
         id_pub = dandelion.identity.generate().public_identity()
 
@@ -360,7 +1143,7 @@ class DatabaseTest(unittest.TestCase):
     def test_identity_info_nick(self):
         """"Test getting and setting nickname"""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
         id_a = dandelion.identity.generate()
         db.add_identities([id_a])
 
@@ -389,6 +1172,58 @@ class DatabaseTest(unittest.TestCase):
         self.assertRaises(TypeError, db.set_nick, '', "qwerty")
         self.assertRaises(ValueError, db.set_nick, b'', "qwerty")
 
+class MemoryDatabaseTest(DatabaseTest):
+    """Unit test suite for the MemoryContentDB class"""
+
+    def _create_db(self):
+        return MemoryContentDB()
+
+    def test_sqlite(self):
+        self.skipTest("SQLite backend only")
+
+    def test_group_commit(self):
+        self.skipTest("SQLite backend only")
+
+    def test_write_from_writer_thread(self):
+        self.skipTest("SQLite backend only")
+
+    def test_writes_in_writer_thread(self):
+        self.skipTest("SQLite backend only")
+
+    def test_filter_stats(self):
+        self.skipTest("SQLite backend only")
+
+    def test_connections(self):
+        self.skipTest("SQLite backend only")
+
+    def test_counts(self):
+        self.skipTest("SQLite backend only")
+
+    def test_query_plans(self):
+        self.skipTest("SQLite backend only")
+
+    def test_partitions(self):
+        self.skipTest("SQLite backend only")
+
+    def test_identity_cache(self):
+        self.skipTest("SQLite backend only")
+
+    def test_backend(self):
+        """Test that the backend is pure in-memory."""
+
+        db = MemoryContentDB()
+        self.assertTrue(isinstance(db, ContentDB))
+        self.assertEqual(db.partition_windows, [])
+        self.assertEqual(db.drop_partitions(3000), 0)
+
+        db.add_messages([Message('M1'), Message('Hello')])
+        self.assertEqual(db.search_messages('hel'), [('Hello',)])
+        db.close()
+
+        id = db.id
+        self.assertEqual(MemoryContentDB(id).id, id)
+        self.assertNotEqual(MemoryContentDB().id, id)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -21,7 +21,7 @@ import tempfile
 import dandelion.identity
 
 from dandelion.identity import IdentityInfo
-from dandelion.database import ContentDB
+from dandelion.database import SQLiteContentDB
 
 class IdentityTest(unittest.TestCase):
 
@@ -32,7 +32,7 @@ class IdentityTest(unittest.TestCase):
     def test_identity_info(self):
         """Test the IdentityInfo class"""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
         id_a = dandelion.identity.generate()
         db.add_identities([id_a])
 
@@ -0,0 +1,144 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import random
+import socket
+import struct
+import time
+import unittest
+import unittest.mock
+from dandelion.mdns import *
+
+class MulticastDNSTest(unittest.TestCase):
+    """Unit test suite for the multicast DNS service discovery"""
+
+    def _create_agent(self, name, port, mdns_port, found):
+        agent = ServiceAgent('_test._tcp', name, port, found, interface='127.0.0.1', mdns_port=mdns_port)
+        try:
+            agent.open()
+        except OSError:
+            self.skipTest("No multicast on the loopback interface")
+        return agent
+
+    def test_names(self):
+        self.assertEqual(encode_name('a.bc.local'), b'\x01a\x02bc\x05local\x00')
+        self.assertEqual(encode_name('a.bc.local.'), encode_name('a.bc.local'))
+        self.assertEqual(decode_name(b'xx\x01a\x02bc\x00', 2), ('a.bc', 8))
+        self.assertRaises(ValueError, encode_name, 'a' * 64)
+
+        # Compression pointer to the name at offset 2
+        data = b'xx\x02bc\x05local\x00\x01a\xc0\x02'
+        self.assertEqual(decode_name(data, 12), ('a.bc.local', 16))
+
+        self.assertRaises(MDNSError, decode_name, b'\xc0\x00', 0) # Pointer loop
+        self.assertRaises(MDNSError, decode_name, b'\x05ab', 0) # Truncated
+
+    def test_packets(self):
+        records = [('_test._tcp.local', TYPE_PTR, 120, 'n._test._tcp.local'),
+                   ('n._test._tcp.local', TYPE_SRV, 120, (1337, 'n.local')),
+                   ('n._test._tcp.local', TYPE_TXT, 120, b'\x00'),
+                   ('n.local', TYPE_A, 0, '10.0.0.1')]
+
+        packet = encode_packet(answers=records[:1], additionals=records[1:], response=True)
+        self.assertEqual(decode_packet(packet), (True, [], records))
+
+        packet = encode_packet(questions=[('_Test._tcp.local', TYPE_PTR)])
+        self.assertEqual(decode_packet(packet), (False, [('_test._tcp.local', TYPE_PTR)], []))
+
+        self.assertRaises(MDNSError, decode_packet, b'\x00' * 5)
+        self.assertRaises(MDNSError, decode_packet, packet[:-1])
+
+        # Unknown record types are skipped
+        packet = struct.pack('>HHHHHH', 0, 0x8400, 0, 1, 0, 0) + encode_name('x') + struct.pack('>HHIH', 99, 1, 0, 2) + b'ab'
+        self.assertEqual(decode_packet(packet), (True, [], []))
+
+    def test_resolve(self):
+        """Test that only the instances being resolved are kept, until their PTR records expire"""
+
+        found, sent = [], []
+        agent = ServiceAgent('_test._tcp', 'me', 1000, lambda ip, port: found.append((ip, port)), interface='127.0.0.1')
+        agent._send = sent.append
+        service = '_test._tcp.local'
+        addr = ('10.0.0.9', MDNS_PORT)
+
+        # Records of other services and hosts aren't kept
+        agent._handle_response([('x._other._tcp.local', TYPE_SRV, 120, (1, 'x.local')),
+                                ('x.local', TYPE_A, 120, '10.0.0.1')], addr)
+        self.assertEqual(agent._pending, {})
+        self.assertEqual(found, [])
+
+        # An instance without SRV record is asked for it and resolved by the answer
+        agent._handle_response([(service, TYPE_PTR, 120, 'n.' + service)], addr)
+        self.assertEqual(list(agent._pending), ['n.' + service])
+        self.assertEqual(decode_packet(sent[-1]), (False, [('n.' + service, TYPE_SRV)], []))
+        agent._handle_response([('n.' + service, TYPE_SRV, 120, (1337, 'n.local')),
+                                ('n.local', TYPE_A, 120, '10.0.0.2')], addr)
+        self.assertEqual(found, [('10.0.0.2', 1337)])
+        self.assertEqual(agent._pending, {})
+
+        # Unresolved instances are forgotten when their PTR record expires, or says goodbye
+        agent._handle_response([(service, TYPE_PTR, 1, 'old.' + service), (service, TYPE_PTR, 120, 'bye.' + service)], addr)
+        agent._handle_response([(service, TYPE_PTR, 0, 'bye.' + service)], addr)
+        self.assertEqual(list(agent._pending), ['old.' + service])
+        with unittest.mock.patch('time.monotonic', return_value=time.monotonic() + 2):
+            agent._handle_response([], addr)
+        self.assertEqual(agent._pending, {})
+
+        # ... and there is a limit on how many are resolved at a time
+        agent._handle_response([(service, TYPE_PTR, 120, '%d.%s' % (i, service)) for i in range(2 * ServiceAgent.MAX_PENDING)], addr)
+        self.assertEqual(len(agent._pending), ServiceAgent.MAX_PENDING)
+
+    def test_loopback_discovery(self):
+        """Test that two agents on the same host find each other, without waiting for any timers."""
+
+        mdns_port = random.randint(20000, 60000)
+        found_a, found_b = [], []
+        a = self._create_agent('a', 1001, mdns_port, lambda ip, port: found_a.append((ip, port)))
+        b = self._create_agent('b', 1002, mdns_port, lambda ip, port: found_b.append((ip, port)))
+
+        try:
+            start = time.monotonic()
+            while not (found_a and found_b) and time.monotonic() - start < 5:
+                a.process(0.05)
+                b.process(0.05)
+
+            self.assertIn(('127.0.0.1', 1002), found_a)
+            self.assertIn(('127.0.0.1', 1001), found_b)
+            self.assertFalse(('127.0.0.1', 1001) in found_a) # Not itself
+            self.assertTrue(time.monotonic() - start < ServiceAgent.FIRST_QUERY_INTERVAL)
+
+            # A late agent is answered right away
+            found_c = []
+            c = self._create_agent('c', 1003, mdns_port, lambda ip, port: found_c.append((ip, port)))
+            start = time.monotonic()
+            while len(found_c) < 2 and time.monotonic() - start < 5:
+                a.process(0.05)
+                b.process(0.05)
+                c.process(0.05)
+            c.close()
+
+            self.assertEqual(set(found_c), set([('127.0.0.1', 1001), ('127.0.0.1', 1002)]))
+        finally:
+            a.close()
+            b.close()
+
+        a.close() # Closing twice is a nop
+
+if __name__ == '__main__':
+    unittest.main()
@@ -170,6 +170,37 @@ class MessageTest(unittest.TestCase):
         msg = Message(self._sample_message)
         self.assertEqual(str(msg), dandelion.util.encode_b64_bytes(binascii.a2b_hex(self._sample_message_sha256)[-Message._ID_LENGTH_BYTES:]).decode())
 
+    def test_slots(self):
+        """Testing that messages don't carry a per instance dict"""
+
+        msg = Message(self._sample_message)
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertRaises(AttributeError, setattr, msg, 'fubar', 1)
+
+    def test_restore(self):
+        """Testing the factory for messages read back from storage"""
+
+        id = dandelion.identity.generate()
+        m = dandelion.message.create("text", timestamp=1337, sender=id, receiver=id)
+        r = dandelion.message.restore(m.id, m.text, m.timestamp, m.receiver, m.sender, m.signature)
+        self.assertEqual(r, m)
+        self.assertEqual(r.id, m.id)
+        self.assertEqual(r.text, m.text)
+        self.assertEqual(r.timestamp, 1337)
+        self.assertEqual(r.receiver, id.fingerprint)
+        self.assertEqual(r.sender, id.fingerprint)
+        self.assertEqual(r.signature, m.signature)
+        self.assertEqual(str(r), str(m))
+
+        r = dandelion.message.restore(b'A stored id', "A")
+        self.assertFalse(r.has_timestamp)
+        self.assertFalse(r.has_receiver)
+        self.assertFalse(r.has_sender)
+
+        # The stored id is trusted, not recomputed
+        self.assertEqual(r.id, b'A stored id')
+        self.assertNotEqual(r, Message("A"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -91,6 +91,53 @@ class ProtocolTest(unittest.TestCase):
 
         self.assertEqual(dandelion.protocol.parse_greeting_message(dandelion.protocol.create_greeting_message(ex_database_id_bin)), ex_database_id_bin)
 
+    def test_greeting_time_cookie(self):
+        """Test the greeting message with the server time cookie"""
+
+        ex_database_id_bin = b'\x01\x03\x03\x07'
+        ex_time_cookie_bin = b'\x00\x01\x02'
+
+        greeting = dandelion.protocol.create_greeting_message(ex_database_id_bin, ex_time_cookie_bin)
+        pc, pv, dbid, tc = greeting[:-1].split(';')
+        self.assertEqual(pc, "DMS")
+        self.assertEqual(dbid, encode_b64_bytes(ex_database_id_bin).decode())
+        self.assertEqual(tc, encode_b64_bytes(ex_time_cookie_bin).decode())
+
+        self.assertEqual(pv, dandelion.protocol.PROTOCOL_VERSION)
+        self.assertEqual(dandelion.protocol.parse_greeting(greeting), 
+                         (dandelion.protocol.PROTOCOL_VERSION, ex_database_id_bin, ex_time_cookie_bin))
+        self.assertEqual(dandelion.protocol.parse_greeting_message(greeting), ex_database_id_bin)
+        self.assertEqual(dandelion.protocol.parse_greeting(dandelion.protocol.create_greeting_message(ex_database_id_bin)),
+                         (dandelion.protocol.PROTOCOL_VERSION, ex_database_id_bin, None))
+
+        self.assertRaises(TypeError, dandelion.protocol.create_greeting_message, ex_database_id_bin, 'AAEC')
+        self.assertRaises(ValueError, dandelion.protocol.create_greeting_message, ex_database_id_bin, b'')
+
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_greeting,
+                          'DMS;{0};AQMDBw==;\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_greeting,
+                          'DMS;{0};AQMDBw==;???\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_greeting,
+                          'DMS;{0};AQMDBw==;AAEC;AAEC\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertRaises(ProtocolVersionError, dandelion.protocol.parse_greeting, 'DMS;2.0;AQMDBw==;AAEC\n')
+
+    def test_greeting_version_1_0(self):
+        """Test the greeting message of a version 1.0 peer"""
+
+        ex_database_id_bin = b'\x01\x03\x03\x07'
+
+        self.assertTrue('1.0' in dandelion.protocol.SUPPORTED_VERSIONS)
+        self.assertTrue(dandelion.protocol.PROTOCOL_VERSION in dandelion.protocol.SUPPORTED_VERSIONS)
+
+        greeting = dandelion.protocol.create_greeting_message(ex_database_id_bin, version='1.0')
+        self.assertEqual(greeting, 'DMS;1.0;AQMDBw==\n')
+        self.assertEqual(dandelion.protocol.parse_greeting(greeting), ('1.0', ex_database_id_bin, None))
+        self.assertEqual(dandelion.protocol.parse_greeting_message(greeting), ex_database_id_bin)
+
+        self.assertRaises(ValueError, dandelion.protocol.create_greeting_message, ex_database_id_bin, b'\x00', '1.0')
+        self.assertRaises(ValueError, dandelion.protocol.create_greeting_message, ex_database_id_bin, None, '2.0')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_greeting, 'DMS;1.0;AQMDBw==;AAEC\n')
+
     def test_create_message_id_list_request(self):
         """Test message ID list request creation"""
 
@@ -198,6 +245,23 @@ class ProtocolTest(unittest.TestCase):
         self.assertRaises(TypeError, dandelion.protocol.create_message_id_list, 0, None)
         self.assertRaises(AttributeError, dandelion.protocol.create_message_id_list, tc, ['fo'])
 
+    def test_create_message_id_list_from_ids(self):
+        """Test message ID list creation from message ids"""
+
+        msgs = [Message('M1'), Message('M2')]
+        tc = b'\x01\x03\x03\x07'
+
+        self.assertEqual(dandelion.protocol.create_message_id_list_from_ids(tc, [m.id for m in msgs]),
+                         dandelion.protocol.create_message_id_list(tc, msgs))
+        self.assertEqual(dandelion.protocol.create_message_id_list_from_ids(tc),
+                         dandelion.protocol.create_message_id_list(tc))
+
+        """Testing bad input"""
+        self.assertRaises(TypeError, dandelion.protocol.create_message_id_list_from_ids, 1337, None)
+        self.assertRaises(ValueError, dandelion.protocol.create_message_id_list_from_ids, None, [])
+        self.assertRaises(TypeError, dandelion.protocol.create_message_id_list_from_ids, tc, 1337)
+        self.assertRaises(TypeError, dandelion.protocol.create_message_id_list_from_ids, tc, ['fo'])
+
     def test_parse_message_id_list(self):
         """Test parsing the message ID list request string"""
 
@@ -615,6 +679,82 @@ class ProtocolTest(unittest.TestCase):
         self.assertTrue(id2.fingerprint in identityids)
         self.assertTrue(id3.fingerprint in identityids)
 
+    def test_delta_request(self):
+        """Test delta request creation and parsing"""
+
+        tc = b'\x01\x03\x03\x07'
+        tc_str = encode_b64_bytes(tc).decode()
+
+        self.assertEqual(dandelion.protocol.create_delta_request(), 'GETDELTA\n')
+        self.assertEqual(dandelion.protocol.create_delta_request(tc), 'GETDELTA {0}\n'.format(tc_str))
+        self.assertRaises(TypeError, dandelion.protocol.create_delta_request, tc_str)
+
+        self.assertTrue(dandelion.protocol.is_delta_request('GETDELTA\n'))
+        self.assertFalse(dandelion.protocol.is_delta_request(dandelion.protocol.create_message_id_list_request(tc)))
+        self.assertFalse(dandelion.protocol.is_message_id_list_request(dandelion.protocol.create_delta_request(tc)))
+        self.assertFalse(dandelion.protocol.is_identity_id_list_request(dandelion.protocol.create_delta_request(tc)))
+
+        self.assertEqual(dandelion.protocol.parse_delta_request(dandelion.protocol.create_delta_request()), None)
+        self.assertEqual(dandelion.protocol.parse_delta_request(dandelion.protocol.create_delta_request(tc)), tc)
+
+        self.assertRaises(ValueError, dandelion.protocol.parse_delta_request, None)
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta_request, 'GETMESSAGELIST\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta_request, 'GETDELTA ???\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta_request, 'GETDELTA {0} {0}\n'.format(tc_str))
+
+    def test_delta(self):
+        """Test delta response creation and parsing"""
+
+        tc = b'24'
+        msgids = [b'\x01\x02', b'\x03\x04\x05']
+        id1 = dandelion.identity.generate()
+        id2 = dandelion.identity.generate()
+
+        delta = dandelion.protocol.create_delta(tc, msgids, [id1.fingerprint, id2.fingerprint])
+        tc_str, msgids_str, ids_str = delta[:-1].split(';')
+        self.assertEqual(tc_str, encode_b64_bytes(tc).decode())
+        self.assertEqual(msgids_str.split('|'), [encode_b64_bytes(m).decode() for m in msgids])
+        self.assertEqual(len(ids_str.split('|')), 2)
+
+        self.assertEqual(dandelion.protocol.parse_delta(delta), (tc, msgids, [id1.fingerprint, id2.fingerprint]))
+
+        self.assertEqual(dandelion.protocol.create_delta(tc), 'MjQ=;;\n')
+        self.assertEqual(dandelion.protocol.parse_delta(dandelion.protocol.create_delta(tc)), (tc, [], []))
+        self.assertEqual(dandelion.protocol.parse_delta(dandelion.protocol.create_delta(tc, None, [id1.fingerprint])),
+                         (tc, [], [id1.fingerprint]))
+
+        self.assertRaises(ValueError, dandelion.protocol.create_delta, None)
+        self.assertRaises(TypeError, dandelion.protocol.create_delta, 'MjQ=')
+        self.assertRaises(TypeError, dandelion.protocol.create_delta, tc, 1337)
+
+        self.assertRaises(ValueError, dandelion.protocol.parse_delta, None)
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, '')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, 'MjQ=\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, 'MjQ=;AQI=\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, ';;\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, 'MjQ=;AQI=||AQI=;\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_delta, 'MjQ=;AQI=;;\n')
+
+    def test_turn_and_heartbeat(self):
+        """Test the turn and heartbeat requests"""
+
+        self.assertEqual(dandelion.protocol.create_turn_request(), 'TURN\n')
+        self.assertEqual(dandelion.protocol.create_turn_request(True), 'TURN KEEPALIVE\n')
+        self.assertTrue(dandelion.protocol.is_turn_request('TURN\n'))
+        self.assertTrue(dandelion.protocol.is_turn_request('TURN KEEPALIVE\n'))
+        self.assertFalse(dandelion.protocol.is_turn_request('TURN OK\n'))
+        self.assertFalse(dandelion.protocol.parse_turn_request(dandelion.protocol.create_turn_request()))
+        self.assertTrue(dandelion.protocol.parse_turn_request(dandelion.protocol.create_turn_request(True)))
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_turn_request, 'TURN FOO\n')
+        self.assertRaises(ValueError, dandelion.protocol.parse_turn_request, None)
+        self.assertTrue(dandelion.protocol.parse_turn_reply(dandelion.protocol.create_turn_reply()))
+
+        self.assertTrue(dandelion.protocol.is_heartbeat_request(dandelion.protocol.create_heartbeat_request()))
+        self.assertFalse(dandelion.protocol.is_heartbeat_request(dandelion.protocol.create_turn_request()))
+        self.assertTrue(dandelion.protocol.parse_heartbeat_reply(dandelion.protocol.create_heartbeat_reply()))
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_heartbeat_reply, dandelion.protocol.create_turn_reply())
+        self.assertRaises(ValueError, dandelion.protocol.parse_heartbeat_reply, None)
+
     def test_create_identity_list_request(self):
         """Test identity list request creation"""
 
@@ -761,6 +901,40 @@ class ProtocolTest(unittest.TestCase):
         self.assertTrue(id2 in identities)
         self.assertTrue(id3 in identities)
 
+    def test_snapshot_request(self):
+        """Test creating and detecting the snapshot request"""
+
+        req = dandelion.protocol.create_snapshot_request()
+        self.assertEqual(req, 'GETSNAPSHOT\n')
+        self.assertTrue(dandelion.protocol.is_snapshot_request(req))
+        self.assertFalse(dandelion.protocol.is_snapshot_request('GETSNAPSHOT 1\n'))
+        self.assertFalse(dandelion.protocol.is_message_id_list_request(req))
+        self.assertRaises(ValueError, dandelion.protocol.is_snapshot_request, None)
+        self.assertRaises(TypeError, dandelion.protocol.is_snapshot_request, b'GETSNAPSHOT\n')
+
+    def test_announcement(self):
+        """Test creating and parsing the announcement datagram"""
+
+        dbid, tc = b'\x01\x02\x03', b'\x04\x05\x06'
+        ann = dandelion.protocol.create_announcement(dbid, tc, 1337)
+        self.assertEqual(ann, 'DMS;{0};ANNOUNCE;1337;AQID;BAUG\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertEqual(dandelion.protocol.parse_announcement(ann), (dbid, tc, 1337))
+
+        self.assertRaises(ValueError, dandelion.protocol.create_announcement, b'', tc, 1337)
+        self.assertRaises(ValueError, dandelion.protocol.create_announcement, dbid, tc, 0)
+        self.assertRaises(TypeError, dandelion.protocol.create_announcement, 'AQID', tc, 1337)
+        self.assertRaises(TypeError, dandelion.protocol.create_announcement, dbid, tc, '1337')
+
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_announcement, 
+                          'DMS;{0};ANNOUNCE;1337;AQID\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_announcement, 
+                          'DMS;{0};ANNOUNCE;99999;AQID;BAUG\n'.format(dandelion.protocol.PROTOCOL_VERSION))
+        self.assertRaises(ProtocolVersionError, dandelion.protocol.parse_announcement, 'DMS;1.0;ANNOUNCE;1337;AQID;BAUG\n')
+        self.assertRaises(ProtocolParseError, dandelion.protocol.parse_announcement, 
+                          dandelion.protocol.create_greeting_message(dbid))
+        self.assertRaises(ProtocolVersionError, dandelion.protocol.parse_announcement, 'DMS;0.1;ANNOUNCE;1337;AQID;BAUG\n')
+        self.assertRaises(ValueError, dandelion.protocol.parse_announcement, None)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,120 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import tempfile
+import time
+import dandelion.identity
+import dandelion.message
+from dandelion.database import SQLiteContentDB
+from dandelion.message import Message
+from dandelion.retention import RetentionPolicy, Pruner
+
+class RetentionTest(unittest.TestCase):
+    """Unit test suite for the retention policy and pruner"""
+
+    def test_policy(self):
+        policy = RetentionPolicy()
+        self.assertTrue(policy.unlimited)
+        self.assertTrue(policy.keep_own_messages)
+
+        policy = RetentionPolicy(max_age_sec=10, max_messages=100, max_db_bytes=1000, keep_own_messages=False)
+        self.assertFalse(policy.unlimited)
+        self.assertEqual(policy.max_age_sec, 10)
+        self.assertEqual(policy.max_messages, 100)
+        self.assertEqual(policy.max_db_bytes, 1000)
+        self.assertFalse(policy.keep_own_messages)
+
+        self.assertRaises(TypeError, RetentionPolicy, '10')
+        self.assertRaises(TypeError, RetentionPolicy, None, 1.5)
+        self.assertRaises(ValueError, RetentionPolicy, None, None, -1)
+        self.assertRaises(TypeError, RetentionPolicy, keep_own_messages=None)
+
+    def test_apply(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        db.add_messages([Message('Old', timestamp=1000), Message('New', timestamp=2000), Message('Untimed')])
+
+        self.assertEqual(RetentionPolicy().apply(db), 0)
+        self.assertEqual(RetentionPolicy(max_age_sec=500).apply(db, now=2000), 1)
+        self.assertEqual(RetentionPolicy(max_messages=1).apply(db), 1)
+        self.assertEqual(db.message_count, 1)
+
+    def test_apply_partitions(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name, partition_sec=1000)
+        now = int(time.time())
+        w = now - now % 1000 # Partitions are only created near the current time
+        db.add_messages([Message('Old', timestamp=w - 1000), Message('Old too', timestamp=w - 500), Message('New', timestamp=w + 500)])
+
+        self.assertEqual(RetentionPolicy(max_age_sec=500).apply(db, now=w + 500), 2)
+        self.assertEqual(db.partition_windows, [(w, w + 1000)])
+        self.assertEqual(db.message_count, 1)
+
+    def test_pruner(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        me = dandelion.identity.generate()
+        db.add_private_identity(me)
+
+        now = int(time.time())
+        own = dandelion.message.create('Mine', timestamp=now - 1000, sender=me)
+        msgs = [Message(str(i), timestamp=now - 1000) for i in range(25)]
+        for m in msgs:
+            db.add_messages([m])
+        db.add_messages([own])
+
+        self.assertRaises(TypeError, Pruner, db, None)
+        self.assertRaises(ValueError, Pruner, db, RetentionPolicy(), 1, 0)
+
+        pruner = Pruner(db, RetentionPolicy(max_age_sec=100), batch_size=10)
+        self.assertEqual(pruner.prune(), 25)
+        self.assertEqual(db.get_messages()[1], [own])
+        self.assertEqual(pruner.prune(), 0)
+
+        # Only the current cookie and the one of the own message remain
+        with db._reading() as c:
+            self.assertEqual(c.execute("SELECT count(*) FROM time_cookies").fetchone()[0], 2)
+
+        # As a service
+        db.add_messages([Message('Expired', timestamp=now - 1000)])
+        pruner = Pruner(db, RetentionPolicy(max_age_sec=100), interval_sec=0)
+        pruner.start()
+        for _ in range(100):
+            if db.message_count == 1:
+                break
+            time.sleep(0.01)
+        pruner.stop()
+        self.assertEqual(db.get_messages()[1], [own])
+
+    def test_pruner_keeps_synced_cookies(self):
+        """A node that synced before the pruning continues from its time cookie"""
+
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        now = int(time.time())
+        db.add_messages([Message('Old', timestamp=now - 1000)])
+        db.add_messages([Message('Late', timestamp=now)])
+        db.add_messages([Message('Late but old', timestamp=now - 1000)])
+        synced = db.get_last_time_cookie()
+        new = Message('New', timestamp=now)
+        db.add_messages([new])
+
+        self.assertEqual(Pruner(db, RetentionPolicy(max_age_sec=100)).prune(), 2)
+        self.assertTrue(db.contains_time_cookie(synced))
+        self.assertEqual(db.get_message_ids(synced)[1], [new.id])
+
+if __name__ == '__main__':
+    unittest.main()
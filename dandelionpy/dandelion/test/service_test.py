@@ -18,18 +18,21 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
+import random
 import time
 import os
 import tempfile
+import threading
 
 import dandelion.service
 import dandelion.synchronizer
 import dandelion.discoverer
+import dandelion.announcer
 import dandelion.config
-from dandelion.database import ContentDB
-from dandelion.network import Server
+from dandelion.database import SQLiteContentDB
+from dandelion.network import Server, Client, ConnectionPool
 from dandelion.message import Message
-from dandelion.config import ServerConfig
+from dandelion.config import ServerConfig, AnnouncerConfig
 
 def _wait_for_cnt(lst, limit=1, time_out=0.5):
     """Helper function for synchronization. Will return when the lists length 
@@ -113,6 +116,7 @@ class RepetitiveWorkerTest(unittest.TestCase):
         self.assertTrue(rw.running)
         rw.restart()
         self.assertTrue(rw.running)
+        rw.stop()
 
 class DiscovererTest(unittest.TestCase):
     """Unit test suite for the Discoverer class."""
@@ -129,6 +133,36 @@ class DiscovererTest(unittest.TestCase):
         d.stop()
         self.assertFalse(d.running)
 
+    def test_backend_failure(self):
+        """Test that a backend failing to open fails the start."""
+
+        class FailingBackend(dandelion.discoverer.DiscoveryBackend):
+            def open(self, regtype, port, found):
+                raise OSError # E.g. address in use
+
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config, FailingBackend())
+        self.assertRaises(OSError, d.start)
+        self.assertFalse(d.running)
+
+    def test_mdns_backend(self):
+        """Test that two discoverers on the loopback interface find each other."""
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        self.assertEqual(cfg_mgr.discoverer_config.backend, 'mdns')
+
+        mdns_port = random.randint(20000, 60000)
+        discoverers = [dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config,
+                                                       dandelion.discoverer.MulticastDNSBackend('127.0.0.1', mdns_port=mdns_port)) 
+                       for _ in range(2)]
+        for d in discoverers:
+            d.start()
+
+        time.sleep(0.5)
+
+        for d in discoverers:
+            d.stop()
+            self.assertTrue(d.contains_node('127.0.0.1', cfg_mgr.server_config.port))
+
     def test_add_remove(self):
         cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
         d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, server_config=cfg_mgr.server_config)
@@ -260,6 +294,111 @@ class DiscovererTest(unittest.TestCase):
         self.assertEqual(ip, "127.0.0.1")
         self.assertEqual(port, 1)
 
+class AnnouncerTest(unittest.TestCase):
+    """Unit test suite for the Announcer class."""
+
+    TEST_FILE = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                             'config_test_data.conf')
+
+    def _wait_for_announcement(self, d, ip, port, time_cookie, time_out=2):
+        t1 = time.time()
+        while time.time() - t1 < time_out:
+            nodes = [n for n in d._nodes if n['ip'] == ip and n['port'] == port]
+            if nodes and nodes[0]['time_cookie'] == time_cookie:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_announcements(self):
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        ac = AnnouncerConfig()
+        ac.address = '127.255.255.255'
+        ac.port = random.randint(20000, 60000)
+
+        sc_a, sc_b = ServerConfig(), ServerConfig()
+        sc_a.port, sc_b.port = 2001, 2002
+        db_a = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        db_b = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        d_a = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config)
+        d_b = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config)
+        a = dandelion.announcer.Announcer(ac, sc_a, db_a, d_a)
+        b = dandelion.announcer.Announcer(ac, sc_b, db_b, d_b)
+
+        self.assertFalse(a.running)
+        a.start()
+        b.start()
+        self.assertTrue(a.running)
+
+        try:
+            # Announced on start (b wasn't listening yet when a started, so a announces again)
+            self.assertTrue(self._wait_for_announcement(d_a, '127.0.0.1', 2002, db_b.get_last_time_cookie()))
+            a.announce()
+            self.assertTrue(self._wait_for_announcement(d_b, '127.0.0.1', 2001, db_a.get_last_time_cookie()))
+            self.assertFalse(d_a.contains_node('127.0.0.1', 2001)) # Not itself
+
+            # And when content is added
+            tc = db_a.add_messages([Message('News')])
+            self.assertTrue(self._wait_for_announcement(d_b, '127.0.0.1', 2001, tc))
+        finally:
+            a.stop()
+            b.stop()
+
+        self.assertFalse(a.running)
+        a.stop() # Stopping twice is a nop
+        db_a.add_messages([Message('Not announced')])
+        db_a.wait_for_listeners()
+
+    def test_concurrent_announcements(self):
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config)
+        known = len(d._nodes)
+
+        threads = [threading.Thread(target=d.announced, args=('127.0.0.1', 2001, b'db', bytes([i]))) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(d._nodes), known + 1) # Added once
+
+    def test_acquire_news_first(self):
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config)
+        d.add_node('127.0.0.1', 1)
+        d.announced('127.0.0.1', 2, b'db2', b'old')
+        d.announced('127.0.0.1', 3, b'db3', b'new')
+
+        self.assertRaises(TypeError, d.announced, '127.0.0.1', 3, 'db3', b'new')
+
+        recorded = {b'db2' : b'old', b'db3' : b'seen'}
+        def has_news(dbid, time_cookie):
+            return None if dbid is None else time_cookie != recorded[dbid]
+
+        self.assertEqual(d.acquire_node(has_news), ('127.0.0.1', 3)) # News
+        self.assertEqual(d.acquire_node(has_news), ('127.0.0.1', 1)) # Unknown
+        self.assertRaises(dandelion.discoverer.DiscovererException, d.acquire_node, has_news) # No news from 2
+        self.assertEqual(d.acquire_node(), ('127.0.0.1', 2))
+
+    def test_acquire_news_unlocked(self):
+        cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
+        d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, cfg_mgr.server_config)
+        for node in list(d._nodes):
+            d.remove_node(node['ip'], node['port'])
+        d.announced('127.0.0.1', 2, b'db2', b'new')
+        d.announced('127.0.0.1', 3, b'db3', b'new')
+
+        def has_news(dbid, time_cookie):
+            """Announcements aren't blocked meanwhile, and node 3 (with news) goes away"""
+            d.announced('127.0.0.1', 4, b'db4', b'new')
+            if dbid != b'db3':
+                return None
+            d.remove_node('127.0.0.1', 3)
+            return True
+
+        self.assertEqual(d.acquire_node(has_news), ('127.0.0.1', 2))
+        self.assertTrue(d.contains_node('127.0.0.1', 4))
+        self.assertRaises(dandelion.discoverer.DiscovererException, d.acquire_node, lambda dbid, tc: dbid == b'db3')
+
 class SynchronizerTest(unittest.TestCase):
     """Unit test suite for the Synchronizer class."""
 
@@ -268,12 +407,12 @@ class SynchronizerTest(unittest.TestCase):
 
     def test_start_stop(self):
         # Create synchronizer with already running discoverer
-        db = ContentDB(":memory:")
+        db = SQLiteContentDB(":memory:")
         cfg_mgr = dandelion.config.ConfigManager(self.TEST_FILE)
         d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, server_config=cfg_mgr.server_config)
 
         d.start()
-        s = dandelion.synchronizer.Synchronizer(cfg_mgr.synchronizer_config, d, db)
+        s = dandelion.synchronizer.Synchronizer(d, cfg_mgr.synchronizer_config, db)
         self.assertFalse(s.running)
         s.start()
         self.assertTrue(s.running)
@@ -283,7 +422,7 @@ class SynchronizerTest(unittest.TestCase):
 
         # Create synchronizer with discoverer started later
         d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, server_config=cfg_mgr.server_config)
-        s = dandelion.synchronizer.Synchronizer(dandelion.config.ConfigManager(self.TEST_FILE), d, db)
+        s = dandelion.synchronizer.Synchronizer(d, cfg_mgr.synchronizer_config, db)
         d.start()
         self.assertFalse(s.running)
         s.start()
@@ -294,7 +433,7 @@ class SynchronizerTest(unittest.TestCase):
 
         # Start synchronizer before discoverer
         d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, server_config=cfg_mgr.server_config)
-        s = dandelion.synchronizer.Synchronizer(dandelion.config.ConfigManager(self.TEST_FILE), d, db)
+        s = dandelion.synchronizer.Synchronizer(d, cfg_mgr.synchronizer_config, db)
         self.assertFalse(s.running)
         s.start()
         self.assertTrue(s.running)
@@ -306,7 +445,7 @@ class SynchronizerTest(unittest.TestCase):
         # Stop discoverer while synchronizer is running
         d = dandelion.discoverer.Discoverer(cfg_mgr.discoverer_config, server_config=cfg_mgr.server_config)
         d.start()
-        s = dandelion.synchronizer.Synchronizer(dandelion.config.ConfigManager(self.TEST_FILE), d, db)
+        s = dandelion.synchronizer.Synchronizer(d, cfg_mgr.synchronizer_config, db)
         s.start()
         self.assertTrue(s.running)
         d.stop()
@@ -316,11 +455,11 @@ class SynchronizerTest(unittest.TestCase):
 
     def test_do_sync(self):
         cm = dandelion.config.ConfigManager(self.TEST_FILE)
-        remote_db = ContentDB(tempfile.NamedTemporaryFile().name)
-        local_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        remote_db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        local_db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
         d = dandelion.discoverer.Discoverer(cm.discoverer_config, cm.server_config)
         d.start()
-        s = dandelion.synchronizer.Synchronizer(d, cm, local_db)
+        s = dandelion.synchronizer.Synchronizer(d, cm.synchronizer_config, local_db)
         s.start()
 
         # Start the "remote" server
@@ -350,6 +489,60 @@ class SynchronizerTest(unittest.TestCase):
         d.stop()
         server.stop()
 
+    def test_keep_alive(self):
+        cm = dandelion.config.ConfigManager(self.TEST_FILE)
+        remote_db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        local_db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        d = dandelion.discoverer.Discoverer(cm.discoverer_config, cm.server_config)
+        s = dandelion.synchronizer.Synchronizer(d, cm.synchronizer_config, local_db)
+
+        sc = ServerConfig()
+        sc.ip = "127.0.0.1"
+        sc.port = 12346
+        server = Server(sc, remote_db)
+        server.start()
+
+        try:
+            remote_db.add_messages([Message("fubar")])
+            s.sync("127.0.0.1", 12346)
+            self.assertEqual(local_db.message_count, 1)
+            self.assertEqual(s._pool.size, 1)
+            conn = s._pool._connections[("127.0.0.1", 12346)]
+
+            # The next sync (in both directions) reuses the connection
+            remote_db.add_messages([Message("foo")])
+            local_db.add_messages([Message("bar")])
+            s.sync("127.0.0.1", 12346)
+            self.assertEqual(local_db.message_count, 3)
+            self.assertEqual(remote_db.message_count, 3)
+            self.assertIs(s._pool._connections[("127.0.0.1", 12346)], conn)
+
+            # Idle sync on the reused connection
+            s.sync("127.0.0.1", 12346)
+            self.assertIs(s._pool._connections[("127.0.0.1", 12346)], conn)
+
+            # Closed by the synchronizer when stopped
+            s.stop()
+            self.assertEqual(s._pool.size, 0)
+
+            # Heartbeats keep a connection, the idle timeout closes it
+            pool = ConnectionPool(idle_timeout=0.5, heartbeat=0.1)
+            with Client("127.0.0.1", 12346, local_db, pool=pool) as client:
+                client.execute_transaction()
+            self.assertEqual(pool.size, 1)
+            time.sleep(0.2)
+            pool.maintain()
+            self.assertEqual(pool.size, 1)
+            time.sleep(0.4)
+            pool.maintain()
+            self.assertEqual(pool.size, 0)
+            pool.close()
+
+            self.assertRaises(ValueError, ConnectionPool, 0, 5)
+            self.assertRaises(TypeError, ConnectionPool, 60, None)
+        finally:
+            server.stop()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,153 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+import struct
+import tempfile
+import unittest
+import unittest.mock
+import dandelion.identity
+import dandelion.message
+from dandelion.database import SQLiteContentDB
+from dandelion.memorydb import MemoryContentDB
+from dandelion.message import Message
+from dandelion.snapshot import SnapshotReader, SnapshotWriter, SnapshotError
+
+class SnapshotTest(unittest.TestCase):
+    """Unit test suite for the data base snapshots"""
+
+    def _create_source(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        self.id1 = dandelion.identity.generate()
+        self.id2 = dandelion.identity.generate()
+        db.add_identities([self.id1, self.id2])
+        self.msgs = [Message(str(i), timestamp=i) for i in range(2 * SnapshotWriter.BLOCK_SIZE + 1)]
+        self.msgs.append(dandelion.message.create('Secret', sender=self.id1, receiver=self.id2))
+        self.msgs.append(Message('Untimed'))
+        db.add_messages(self.msgs)
+        return db
+
+    def _export(self, db):
+        out = io.BytesIO()
+        tc = db.export_snapshot(out)
+        return tc, out.getvalue()
+
+    def test_roundtrip(self):
+        """Test exporting and importing the content of a data base"""
+
+        src = self._create_source()
+        tc, data = self._export(src)
+        self.assertEqual(tc, src.get_last_time_cookie())
+
+        dst = MemoryContentDB()
+        self.assertEqual(dst.import_snapshot(io.BytesIO(data)), (src.id, tc))
+        self.assertEqual(dst.message_count, len(self.msgs))
+        self.assertEqual(dst.identity_count, 2)
+        self.assertEqual(set(m.id for m in dst.get_messages()[1]), set(m.id for m in self.msgs))
+        self.assertTrue(all(m in self.msgs for m in dst.get_messages()[1]))
+        self.assertEqual(dst.get_identities()[1], [self.id1, self.id2])
+        self.assertFalse(dst.get_identities()[1][0].rsa_key.is_private)
+
+        # The synchronization continues from the snapshot
+        self.assertEqual(dst.get_last_time_cookie(src.id), tc)
+
+        # Importing again adds nothing
+        last_tc = dst.get_last_time_cookie()
+        dst.import_snapshot(io.BytesIO(data))
+        self.assertEqual(dst.get_last_time_cookie(), last_tc)
+
+    def test_empty(self):
+        """Test the snapshot of an empty data base"""
+
+        src = MemoryContentDB()
+        tc, data = self._export(src)
+        reader = SnapshotReader(io.BytesIO(data))
+        self.assertEqual(reader.dbid, src.id)
+        self.assertEqual(reader.time_cookie, tc)
+        self.assertEqual(list(reader), [])
+
+    def test_verify(self):
+        """Test filtering the imported messages"""
+
+        src = self._create_source()
+        _, data = self._export(src)
+
+        dst = MemoryContentDB()
+        dst.import_snapshot(io.BytesIO(data), lambda msgs: [m for m in msgs if m.has_sender])
+        self.assertEqual(dst.message_count, 1)
+
+    def test_corrupt(self):
+        """Test that corrupt and truncated snapshots are detected"""
+
+        src = self._create_source()
+        _, data = self._export(src)
+
+        self.assertRaises(SnapshotError, SnapshotReader, io.BytesIO(b'NOTSNAP' + data[7:]))
+        self.assertRaises(SnapshotError, SnapshotReader, io.BytesIO(data[:10]))
+
+        # A corrupt block is not imported, nor is the time cookie recorded
+        corrupt = bytearray(data)
+        corrupt[-100] ^= 0xff
+        dst = MemoryContentDB()
+        self.assertRaises(SnapshotError, dst.import_snapshot, io.BytesIO(bytes(corrupt)))
+        self.assertTrue(0 < dst.message_count < len(self.msgs))
+        self.assertIsNone(dst.get_last_time_cookie(src.id))
+
+        dst = MemoryContentDB()
+        self.assertRaises(SnapshotError, dst.import_snapshot, io.BytesIO(data[:-1]))
+        self.assertIsNone(dst.get_last_time_cookie(src.id))
+
+    def test_block_length(self):
+        """Test that the blocks are bounded in size when written and read"""
+
+        header = io.BytesIO()
+        SnapshotWriter(header, b'db', b'tc')
+
+        # A block header claiming more than the limit is rejected before reading the payload
+        too_long = header.getvalue() + struct.pack('>cII', b'M', SnapshotWriter.MAX_BLOCK_LENGTH + 1, 0)
+        self.assertRaises(SnapshotError, list, SnapshotReader(io.BytesIO(too_long)))
+
+        # The writer starts a new block before the limit is reached
+        out = io.BytesIO()
+        writer = SnapshotWriter(out, b'db', b'tc')
+        msgs = [Message('M' * 140) for _ in range(3)]
+        with unittest.mock.patch.object(SnapshotWriter, 'MAX_BLOCK_LENGTH', 300):
+            writer.write_messages(msgs)
+            writer.close()
+            blocks = list(SnapshotReader(io.BytesIO(out.getvalue())))
+        self.assertEqual([len(block) for _, block in blocks], [2, 1])
+
+    def test_stream(self):
+        """Test reading a snapshot from a stream returning short reads"""
+
+        class Trickle:
+            def __init__(self, data):
+                self._data = io.BytesIO(data)
+
+            def read(self, n):
+                return self._data.read(min(n, 7))
+
+        src = self._create_source()
+        tc, data = self._export(src)
+        dst = MemoryContentDB()
+        self.assertEqual(dst.import_snapshot(Trickle(data)), (src.id, tc))
+        self.assertEqual(dst.message_count, len(self.msgs))
+
+if __name__ == '__main__':
+    unittest.main()
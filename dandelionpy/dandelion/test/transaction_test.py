@@ -17,7 +17,8 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from dandelion.database import ContentDB
+from dandelion.database import SQLiteContentDB
+from dandelion.memorydb import MemoryContentDB
 from dandelion.message import Message
 from dandelion.network import SocketTransaction, ServerTransaction, \
     ClientTransaction
@@ -63,6 +64,7 @@ class TestServerHelper:
 
     def __enter__(self):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.bind((HOST, PORT))
         self._sock.listen(1)
         self._sock.settimeout(TIMEOUT)
@@ -91,6 +93,10 @@ def recv_n(sock, nbytes):
 class TransactionTest(unittest.TestCase):
     """Unit test suite for the DMS network transactions"""
 
+    def _create_db(self):
+        """Create an empty data base of the backend under test"""
+        return SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+
     def test_helper_classes(self):
         """This test case tests the helper server and client classes used in the other test cases."""
 
@@ -219,7 +225,7 @@ class TransactionTest(unittest.TestCase):
     def test_basic_server_transaction(self):
         """Tests the server transaction protocol and logic"""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
         db.add_identities([dandelion.identity.generate(), dandelion.identity.generate()])
         tc = db.add_messages([Message('fubar'), Message('foo'), Message('bar')])
 
@@ -233,7 +239,7 @@ class TransactionTest(unittest.TestCase):
 
             """Check greeting from server"""
             rcv = test_client._read()
-            self.assertEqual(rcv, dandelion.protocol.create_greeting_message(db.id).encode())
+            self.assertEqual(rcv, dandelion.protocol.create_greeting_message(db.id, db.get_last_time_cookie()).encode())
 
             """Check response to mdgid list req"""
             test_client._write(dandelion.protocol.create_message_id_list_request(tc).encode())
@@ -258,11 +264,36 @@ class TransactionTest(unittest.TestCase):
             """Wait for server (will time out if no requests)"""
             thread.join(2 * TIMEOUT)
 
+    def test_server_transaction_unknown_time_cookie(self):
+        """Tests that the server sends everything for time cookies it no longer knows"""
+
+        db = self._create_db()
+        msgs = [Message('fubar'), Message('foo'), Message('bar')]
+        tc = db.add_messages(msgs)
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+            srv_transaction = ServerTransaction(server_helper.sock, db)
+            test_client = SocketTransaction(client_helper.sock, b'\n')
+
+            thread = threading.Thread(target=srv_transaction.process)
+            thread.start()
+
+            rcv = test_client._read()
+            self.assertEqual(rcv, dandelion.protocol.create_greeting_message(db.id, db.get_last_time_cookie()).encode())
+
+            test_client._write(dandelion.protocol.create_message_id_list_request(b'compacted').encode())
+            rcv_tc, rcv_msgids = dandelion.protocol.parse_message_id_list(test_client._read().decode())
+            self.assertEqual(rcv_tc, tc)
+            self.assertEqual(set(rcv_msgids), set(m.id for m in msgs))
+
+            """Wait for server (will time out if no requests)"""
+            thread.join(2 * TIMEOUT)
+
     def test_basic_client_transaction(self):
         """Tests the client transaction protocol and logic"""
 
-        client_db = ContentDB(tempfile.NamedTemporaryFile().name)
-        srv_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        client_db = self._create_db()
+        srv_db = self._create_db()
 
         self.assertEqual(client_db.message_count, 0)
         srv_db.add_identities([dandelion.identity.generate(), dandelion.identity.generate()])
@@ -283,7 +314,7 @@ class TransactionTest(unittest.TestCase):
             thread = threading.Thread(target=client_transaction.process)
             thread.start()
             """Send a greeting (should be req. by client)"""
-            srv_sock._write(dandelion.protocol.create_greeting_message(srv_db.id).encode())
+            srv_sock._write(dandelion.protocol.create_greeting_message(srv_db.id, version='1.0').encode())
 
             """Reading msg id list request"""
             rcv = srv_sock._read()
@@ -292,16 +323,6 @@ class TransactionTest(unittest.TestCase):
             """Sending the msg id list"""
             srv_sock._write(dandelion.protocol.create_message_id_list(tc, srv_db.get_messages()[1]).encode())
 
-            """Reading msg list request"""
-            rcv = srv_sock._read()
-            expected_msgs = dandelion.protocol.create_message_list_request([msg.id for msg in srv_db.get_messages()[1]]).split(" ")[1][:-1].split(";")
-            for msg in expected_msgs:
-                self.assertNotEqual(rcv.find(msg.encode()), -1)
-
-            """Sending the msg id list"""
-            srv_sock._write(dandelion.protocol.create_message_list(srv_db.get_messages()[1]).encode())
-
-
             """Reading identity id list request"""
             rcv = srv_sock._read()
             self.assertEqual(rcv, dandelion.protocol.create_identity_id_list_request().encode())
@@ -309,15 +330,24 @@ class TransactionTest(unittest.TestCase):
             """Sending the identity id list"""
             srv_sock._write(dandelion.protocol.create_identity_id_list(tc, srv_db.get_identities()[1]).encode())
 
-            """Reading identity list request"""
+            """Reading identity list request (identities are fetched before the messages)"""
             rcv = srv_sock._read()
             expected_ids = dandelion.protocol.create_identity_list_request([id.fingerprint for id in srv_db.get_identities()[1]]).split(" ")[1][:-1].split(";")
             for id in expected_ids:
                 self.assertNotEqual(rcv.find(id.encode()), -1)
 
-            """Sending the msg id list"""
+            """Sending the identity list"""
             srv_sock._write(dandelion.protocol.create_identity_list(srv_db.get_identities()[1]).encode())
 
+            """Reading msg list request"""
+            rcv = srv_sock._read()
+            expected_msgs = dandelion.protocol.create_message_list_request([msg.id for msg in srv_db.get_messages()[1]]).split(" ")[1][:-1].split(";")
+            for msg in expected_msgs:
+                self.assertNotEqual(rcv.find(msg.encode()), -1)
+
+            """Sending the msg list"""
+            srv_sock._write(dandelion.protocol.create_message_list(srv_db.get_messages()[1]).encode())
+
             """Wait for client to hang up"""
             thread.join(2 * TIMEOUT)
 
@@ -326,10 +356,129 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(srv_db.message_count, 3)
         self.assertEqual(len([srvmsg for srvmsg in srv_db.get_messages()[1] if srvmsg not in client_db.get_messages()[1]]), 0)
 
+    def test_client_transaction_up_to_date(self):
+        """Tests that the client skips the list requests if the greeting time cookie is already known"""
+
+        client_db = self._create_db()
+        srv_db = self._create_db()
+        tc = srv_db.add_messages([Message('fubar')])
+        client_db.update_last_time_cookie(srv_db.id, tc)
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db)
+            srv_sock = SocketTransaction(server_helper.sock, b'\n')
+
+            thread = threading.Thread(target=client_transaction.process)
+            thread.start()
+
+            """Greeting with the known time cookie; client should hang up without requests"""
+            srv_sock._write(dandelion.protocol.create_greeting_message(srv_db.id, tc).encode())
+            thread.join(TIMEOUT)
+            self.assertFalse(thread.is_alive())
+            self.assertRaises(socket.timeout, srv_sock._read)
+
+        self.assertEqual(client_db.message_count, 0)
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db)
+            srv_sock = SocketTransaction(server_helper.sock, b'\n')
+
+            thread = threading.Thread(target=client_transaction.process)
+            thread.start()
+
+            """Greeting with a new time cookie; client should ask for what's new since the known one"""
+            srv_sock._write(dandelion.protocol.create_greeting_message(srv_db.id, b'\x01\x02\x03').encode())
+            rcv = srv_sock._read()
+            self.assertEqual(rcv, dandelion.protocol.create_delta_request(tc).encode())
+
+            """Nothing new since the known time cookie; client should hang up"""
+            srv_sock._write(dandelion.protocol.create_delta(b'\x01\x02\x03', [], []).encode())
+            thread.join(2 * TIMEOUT)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(client_db.message_count, 0)
+        self.assertEqual(client_db.get_last_time_cookie(srv_db.id), b'\x01\x02\x03')
+
+    def test_server_transaction_delta(self):
+        """Tests the server response to delta requests"""
+
+        db = self._create_db()
+        id1 = dandelion.identity.generate()
+        db.add_identities([id1])
+        msgs = [Message('fubar'), Message('foo')]
+        tc = db.add_messages(msgs)
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+            srv_transaction = ServerTransaction(server_helper.sock, db)
+            test_client = SocketTransaction(client_helper.sock, b'\n')
+
+            thread = threading.Thread(target=srv_transaction.process)
+            thread.start()
+
+            test_client._read() # Greeting
+
+            """Everything without a time cookie"""
+            test_client._write(dandelion.protocol.create_delta_request().encode())
+            rcv_tc, rcv_msgids, rcv_ids = dandelion.protocol.parse_delta(test_client._read().decode())
+            self.assertEqual(rcv_tc, tc)
+            self.assertEqual(set(rcv_msgids), set(m.id for m in msgs))
+            self.assertEqual(rcv_ids, [id1.fingerprint])
+
+            """Only the identity added after the time cookie"""
+            id2 = dandelion.identity.generate()
+            tc2 = db.add_identities([id2])
+            test_client._write(dandelion.protocol.create_delta_request(tc).encode())
+            rcv_tc, rcv_msgids, rcv_ids = dandelion.protocol.parse_delta(test_client._read().decode())
+            self.assertEqual(rcv_tc, tc2)
+            self.assertEqual(rcv_msgids, [])
+            self.assertEqual(rcv_ids, [id2.fingerprint])
+
+            thread.join(2 * TIMEOUT)
+
+    def test_client_transaction_delta(self):
+        """Tests that the client uses a delta request when the server greets with a time cookie"""
+
+        client_db = self._create_db()
+        srv_db = self._create_db()
+        id1 = dandelion.identity.generate()
+        srv_db.add_identities([id1])
+        tc = srv_db.add_messages([dandelion.message.create('foo', None, id1), Message('bar')])
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db)
+            srv_sock = SocketTransaction(server_helper.sock, b'\n')
+
+            thread = threading.Thread(target=client_transaction.process)
+            thread.start()
+
+            srv_sock._write(dandelion.protocol.create_greeting_message(srv_db.id, tc).encode())
+
+            rcv = srv_sock._read()
+            self.assertEqual(rcv, dandelion.protocol.create_delta_request().encode())
+            srv_sock._write(dandelion.protocol.create_delta(tc, [m.id for m in srv_db.get_messages()[1]], [id1.fingerprint]).encode())
+
+            """Identities are requested before the messages"""
+            rcv = srv_sock._read()
+            self.assertEqual(rcv, dandelion.protocol.create_identity_list_request([id1.fingerprint]).encode())
+            srv_sock._write(dandelion.protocol.create_identity_list(srv_db.get_identities()[1]).encode())
+
+            rcv = srv_sock._read()
+            self.assertTrue(dandelion.protocol.is_message_list_request(rcv.decode()))
+            srv_sock._write(dandelion.protocol.create_message_list(srv_db.get_messages()[1]).encode())
+
+            thread.join(2 * TIMEOUT)
+
+        self.assertEqual(client_db.message_count, 2)
+        self.assertEqual(client_db.identity_count, 1)
+        self.assertEqual(client_db.get_last_time_cookie(srv_db.id), tc)
+
     def test_server_transaction_protocol_violation(self):
         """Tests the servers response to an invalid request"""
 
-        db = ContentDB(tempfile.NamedTemporaryFile().name)
+        db = self._create_db()
 
         with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
             srv_transaction = ServerTransaction(server_helper.sock, db)
@@ -341,7 +490,7 @@ class TransactionTest(unittest.TestCase):
 
             """Check greeting from server"""
             rcv = test_client._read()
-            self.assertEqual(rcv, dandelion.protocol.create_greeting_message(db.id).encode())
+            self.assertEqual(rcv, dandelion.protocol.create_greeting_message(db.id, db.get_last_time_cookie()).encode())
 
             """Check response to mdgid list req"""
             test_client._write(b'NON PROTOCOL MESSAGE\n')
@@ -355,7 +504,7 @@ class TransactionTest(unittest.TestCase):
     def test_client_transaction_protocol_violation(self):
         """Tests the client transaction protocol and logic"""
 
-        client_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        client_db = self._create_db()
 
         with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
 
@@ -376,8 +525,8 @@ class TransactionTest(unittest.TestCase):
     def test_client_server_transaction(self):
         """Tests the whole, client driven transaction protocol and logic"""
 
-        client_db = ContentDB(tempfile.NamedTemporaryFile().name)
-        server_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        client_db = self._create_db()
+        server_db = self._create_db()
 
         id1 = dandelion.identity.generate()
         id2 = dandelion.identity.generate()
@@ -413,11 +562,51 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(len([srvmsg for srvmsg in server_db.get_messages()[1] if srvmsg not in client_db.get_messages()[1]]), 0)
         self.assertEqual(len([srvid for srvid in server_db.get_identities()[1] if srvid not in client_db.get_identities()[1]]), 0)
 
+    def test_client_server_transaction_version_1_0(self):
+        """Tests the transaction with a server talking version 1.0 of the protocol"""
+
+        client_db = self._create_db()
+        server_db = self._create_db()
+        server_db.add_identities([dandelion.identity.generate()])
+        server_db.add_messages([Message('fubar'), Message('bar')])
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+            server_transaction = ServerTransaction(server_helper.sock, server_db, version='1.0')
+            test_client = SocketTransaction(client_helper.sock, b'\n')
+
+            thread = threading.Thread(target=server_transaction.process)
+            thread.start()
+
+            """The 1.0 greeting has no time cookie"""
+            self.assertEqual(test_client._read(), dandelion.protocol.create_greeting_message(server_db.id, version='1.0').encode())
+
+            thread.join(2 * TIMEOUT)
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db)
+            server_transaction = ServerTransaction(server_helper.sock, server_db, version='1.0')
+
+            server_thread = threading.Thread(target=server_transaction.process)
+            client_thread = threading.Thread(target=client_transaction.process)
+            server_thread.start()
+            client_thread.start()
+
+            client_thread.join(1)
+            server_thread.join(2 * TIMEOUT)
+
+        """The client falls back to the 1.0 requests and can't keep the connection alive"""
+        self.assertTrue(client_transaction.completed)
+        self.assertEqual(client_transaction.version, '1.0')
+        self.assertFalse(client_transaction.keep_alive)
+        self.assertEqual(client_db.message_count, 2)
+        self.assertEqual(client_db.identity_count, 1)
+
     def test_client_server_transaction_empty_db(self):
         """Tests the whole, client driven transaction protocol and logic with an empty db"""
 
-        client_db = ContentDB(tempfile.NamedTemporaryFile().name)
-        server_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        client_db = self._create_db()
+        server_db = self._create_db()
 
         self.assertEqual(client_db.message_count, 0)
         self.assertEqual(server_db.message_count, 0)
@@ -445,11 +634,53 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(client_db.identity_count, 0)
         self.assertEqual(server_db.identity_count, 0)
 
+    def _sync(self, client_db, server_db):
+        """Run a full client driven transaction between the data bases"""
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db)
+            server_transaction = ServerTransaction(server_helper.sock, server_db)
+
+            server_thread = threading.Thread(target=server_transaction.process)
+            client_thread = threading.Thread(target=client_transaction.process)
+            server_thread.start()
+            client_thread.start()
+
+            client_thread.join(1) # One sec should be plenty
+            server_thread.join(2 * TIMEOUT)
+
+    def test_client_server_transaction_incremental(self):
+        """Tests that content added between synchronizations is picked up by the next one"""
+
+        client_db = self._create_db()
+        server_db = self._create_db()
+
+        server_db.add_identities([dandelion.identity.generate()])
+        server_db.add_messages([Message('fubar')])
+        self._sync(client_db, server_db)
+        self.assertEqual(client_db.identity_count, 1)
+        self.assertEqual(client_db.message_count, 1)
+        self.assertEqual(client_db.get_last_time_cookie(server_db.id), server_db.get_last_time_cookie())
+
+        """Only identities added"""
+        server_db.add_identities([dandelion.identity.generate()])
+        self._sync(client_db, server_db)
+        self.assertEqual(client_db.identity_count, 2)
+        self.assertEqual(client_db.message_count, 1)
+
+        """Only messages added"""
+        server_db.add_messages([Message('foo')])
+        self._sync(client_db, server_db)
+        self.assertEqual(client_db.identity_count, 2)
+        self.assertEqual(client_db.message_count, 2)
+        self.assertEqual(client_db.get_last_time_cookie(server_db.id), server_db.get_last_time_cookie())
+
     def test_client_server_transaction_partial_sync(self):
         """Tests the whole, client driven transaction protocol and logic"""
 
-        client_db = ContentDB(tempfile.NamedTemporaryFile().name)
-        server_db = ContentDB(tempfile.NamedTemporaryFile().name)
+        client_db = self._create_db()
+        server_db = self._create_db()
 
         id1 = dandelion.identity.generate()
         id2 = dandelion.identity.generate()
@@ -487,6 +718,44 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(len([srvmsg for srvmsg in server_db.get_messages()[1] if srvmsg not in client_db.get_messages()[1]]), 0)
         self.assertEqual(len([srvids for srvids in server_db.get_identities()[1] if srvids not in client_db.get_identities()[1]]), 0)
 
+    def test_client_server_transaction_snapshot(self):
+        """Tests bootstrapping an empty data base from a snapshot"""
+
+        client_db = self._create_db()
+        server_db = self._create_db()
+
+        id1 = dandelion.identity.generate()
+        id2 = dandelion.identity.generate()
+        server_db.add_identities([id1, id2])
+        tc = server_db.add_messages([Message('fubar'), dandelion.message.create('foo', None, id1, id2), Message('bar')])
+
+        with TestServerHelper() as server_helper, TestClientHelper() as client_helper:
+
+            client_transaction = ClientTransaction(client_helper.sock, client_db, bootstrap=True)
+            server_transaction = ServerTransaction(server_helper.sock, server_db)
+
+            """Run the client transactions asynchronously"""
+            server_thread = threading.Thread(target=server_transaction.process)
+            client_thread = threading.Thread(target=client_transaction.process)
+            server_thread.start()
+            client_thread.start()
+
+            """Wait for client to hang up"""
+            client_thread.join(1) # One sec should be plenty
+            server_thread.join(2 * TIMEOUT)
+
+        """Make sure the client has imported the snapshot and continued from it"""
+        self.assertEqual(client_db.message_count, 3)
+        self.assertEqual(client_db.identity_count, 2)
+        self.assertEqual(client_db.get_last_time_cookie(server_db.id), tc)
+        self.assertEqual(len([srvmsg for srvmsg in server_db.get_messages()[1] if srvmsg not in client_db.get_messages()[1]]), 0)
+
+class MemoryTransactionTest(TransactionTest):
+    """Unit test suite for the DMS network transactions with the MemoryContentDB backend"""
+
+    def _create_db(self):
+        return MemoryContentDB()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -18,7 +18,9 @@ along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
-from dandelion.util import encode_b64_bytes, encode_b64_int, decode_b64_bytes, decode_b64_int
+from dandelion.util import encode_b64_bytes, encode_b64_int, decode_b64_bytes, decode_b64_int, \
+    encode_int, decode_int, encode_int_list, decode_int_list, encode_b64_int_list, \
+    decode_b64_int_list, encode_b64_bytes_list, decode_b64_bytes_list, LRUCache
 
 class UtilTest(unittest.TestCase):
 
@@ -67,5 +69,74 @@ class UtilTest(unittest.TestCase):
         self.assertRaises(TypeError, decode_b64_int, 123)
         self.assertRaises(ValueError, decode_b64_int, b'\x01')
 
+    def test_encode_int(self):
+
+        self.assertEqual(encode_int(0), b'\x00')
+        self.assertEqual(encode_int(1), b'\x01')
+        self.assertEqual(encode_int(255), b'\xFF')
+        self.assertEqual(encode_int(256), b'\x01\x00')
+        self.assertEqual(encode_int(2 ** 64 - 1), b'\xFF' * 8)
+        self.assertEqual(len(encode_int(2 ** 2047)), 256)
+
+        self.assertRaises(ValueError, encode_int, -1)
+        self.assertRaises(TypeError, encode_int, '')
+        self.assertRaises(TypeError, encode_int, None)
+
+    def test_decode_int(self):
+
+        self.assertEqual(decode_int(b'\x00'), 0)
+        self.assertEqual(decode_int(b'\x00\x01'), 1)
+        self.assertEqual(decode_int(bytearray(b'\x01\x00')), 256)
+        self.assertEqual(decode_int(encode_int(2 ** 2048 - 1)), 2 ** 2048 - 1)
+
+        self.assertRaises(ValueError, decode_int, b'')
+        self.assertRaises(TypeError, decode_int, '')
+        self.assertRaises(TypeError, decode_int, None)
+
+    def test_batch_codecs(self):
+
+        ints = [0, 1, 2 ** 24 - 1, 2 ** 64 + 1, 2 ** 2048 - 3]
+        self.assertEqual(encode_int_list(ints), [encode_int(x) for x in ints])
+        self.assertEqual(decode_int_list(encode_int_list(ints)), ints)
+        self.assertEqual(encode_b64_int_list(ints), [encode_b64_int(x) for x in ints])
+        self.assertEqual(decode_b64_int_list(encode_b64_int_list(ints)), ints)
+
+        bstrs = [b'', b'123', b'1337']
+        self.assertEqual(encode_b64_bytes_list(bstrs), [b'', b'MTIz', b'MTMzNw=='])
+        self.assertEqual(decode_b64_bytes_list(encode_b64_bytes_list(bstrs)), bstrs)
+        self.assertEqual(encode_int_list([]), [])
+
+        self.assertRaises(ValueError, encode_int_list, [1, -1])
+        self.assertRaises(TypeError, decode_b64_int_list, [b'AA==', None])
+
+    def test_lru_cache(self):
+
+        cache = LRUCache(2)
+        self.assertEqual(cache.maxsize, 2)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 1337), 1337)
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1) # a is now most recently used
+
+        cache.put('c', 3) # Evicts b
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertIsNone(cache.pop('a'))
+        self.assertFalse('a' in cache)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        self.assertRaises(TypeError, LRUCache, None)
+        self.assertRaises(ValueError, LRUCache, 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,151 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import unittest.mock
+import tempfile
+import gc
+import weakref
+import dandelion.identity
+import dandelion.message
+from dandelion.message import Message
+from dandelion.database import SQLiteContentDB
+from dandelion.identity import Identity
+from dandelion.verifier import MessageVerifier
+
+class MessageVerifierTest(unittest.TestCase):
+    """Unit test suite for the MessageVerifier class"""
+
+    def test_construction(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+
+        self.assertTrue(MessageVerifier(db).workers > 0)
+        self.assertEqual(MessageVerifier(db, workers=2).workers, 2)
+        self.assertIs(MessageVerifier.shared(db), MessageVerifier.shared(db))
+        self.assertIsNot(MessageVerifier.shared(db), MessageVerifier.shared(SQLiteContentDB(tempfile.NamedTemporaryFile().name)))
+
+        self.assertRaises(TypeError, MessageVerifier, db, 'fu')
+        self.assertRaises(TypeError, MessageVerifier, db, 1, None)
+        self.assertRaises(ValueError, MessageVerifier, db, 0)
+        self.assertRaises(ValueError, MessageVerifier, db, 1, 0)
+
+    def test_verify(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        id_known = dandelion.identity.generate()
+        id_unknown = dandelion.identity.generate()
+        db.add_identities([id_known])
+
+        m_anon = Message('anon')
+        m_signed = dandelion.message.create('signed', sender=id_known)
+        m_signed_to = dandelion.message.create('signed to', sender=id_known, receiver=id_unknown)
+        m_unknown = dandelion.message.create('unknown', sender=id_unknown)
+        msgs = [m_anon, m_signed, m_signed_to, m_unknown]
+
+        verifier = MessageVerifier(db, workers=1)
+        self.assertEqual(verifier.verify(msgs), [m_anon, m_signed, m_signed_to])
+        self.assertEqual(verifier.verify([]), [])
+
+        stats = verifier.stats
+        self.assertEqual(stats['verified'], 2)
+        self.assertEqual(stats['rejected'], 0)
+        self.assertEqual(stats['cache_hits'], 0)
+        self.assertEqual(stats['unknown_sender'], 1)
+
+        # Verified messages are cached
+        self.assertEqual(verifier.verify(msgs), [m_anon, m_signed, m_signed_to])
+        self.assertEqual(verifier.stats['verified'], 2)
+        self.assertEqual(verifier.stats['cache_hits'], 2)
+        self.assertEqual(verifier.stats['unknown_sender'], 2)
+
+    def test_unknown_sender(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        id_a = dandelion.identity.generate()
+        m_signed = dandelion.message.create('signed', sender=id_a)
+
+        # Dropped (and not cached) until the sender identity is known
+        verifier = MessageVerifier(db, workers=1)
+        self.assertEqual(verifier.verify([m_signed]), [])
+        self.assertEqual(verifier.stats['verified'], 0)
+
+        db.add_identities([id_a])
+        self.assertEqual(verifier.verify([m_signed]), [m_signed])
+        self.assertEqual(verifier.stats['verified'], 1)
+        self.assertEqual(verifier.stats['unknown_sender'], 1)
+
+    def test_release_shared(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        verifier = MessageVerifier.shared(db)
+        with unittest.mock.patch.object(verifier, 'close') as close:
+            db.close()
+            close.assert_called_once_with()
+        self.assertIsNot(MessageVerifier.shared(db), verifier)
+
+    def test_shared_collected(self):
+        """The shared verifier doesn't keep a data base that wasn't closed alive"""
+
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        db_ref = weakref.ref(db)
+        verifier = MessageVerifier.shared(db)
+        verifier._pool = pool = unittest.mock.Mock()
+
+        del db
+        gc.collect()
+
+        self.assertIsNone(db_ref())
+        pool.shutdown.assert_called_once_with()
+        self.assertFalse(verifier in MessageVerifier._shared_verifiers.values())
+
+    def test_drop_invalid(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        id_a = dandelion.identity.generate()
+        db.add_identities([id_a])
+
+        m_anon = Message('anon')
+        m_signed = dandelion.message.create('signed', sender=id_a)
+
+        verifier = MessageVerifier(db, workers=1)
+        with unittest.mock.patch.object(Identity, 'verify', return_value=False) as verify:
+            self.assertEqual(verifier.verify([m_anon, m_signed]), [m_anon])
+            verify.assert_called_once_with(b'signed', m_signed.signature)
+
+            # Rejection is cached as well
+            self.assertEqual(verifier.verify([m_signed]), [])
+            self.assertEqual(verify.call_count, 1)
+
+        self.assertEqual(verifier.stats['rejected'], 1)
+
+    def test_worker_processes(self):
+        db = SQLiteContentDB(tempfile.NamedTemporaryFile().name)
+        id_a = dandelion.identity.generate()
+        db.add_identities([id_a])
+
+        msgs = [dandelion.message.create(str(i), sender=id_a) for i in range(10)]
+
+        verifier = MessageVerifier(db, workers=2, batch_size=2)
+        try:
+            self.assertEqual(verifier.verify(msgs), msgs)
+            self.assertIsNotNone(verifier._pool)
+        finally:
+            verifier.close()
+
+        self.assertIsNone(verifier._pool)
+        self.assertEqual(verifier.stats['verified'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
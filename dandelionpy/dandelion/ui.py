@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from dandelion.util import encode_b64_bytes
+from dandelion.util import encode_b64_bytes, decode_b64_bytes
 import cmd
 import dandelion
 import time
@@ -57,12 +57,25 @@ class CmdLine(cmd.Cmd):
         self._ui.say(args, sign=True, receiver_name='RECV')
 
     def do_msgs(self, args):
-        """msgs : Show messages"""
-        self._ui.show_messages()
+        """msgs [limit=N] [offset=N] [since=COOKIE] [from=FP] [to=FP] [text] : Show messages"""
+        try:
+            filters = self._parse_filters(args, {'limit' : 'limit', 'offset' : 'offset', 'since' : 'since',
+                                                 'from' : 'sender', 'to' : 'receiver'}, 'text')
+            self._ui.show_messages(**filters)
+        except:
+            print("SYNTAX ERROR")
+
+    def do_inbox(self, args):
+        """inbox : Show (decrypted) messages to me"""
+        self._ui.show_inbox()
 
     def do_identities(self, args):
-        """identities : Show identities"""
-        self._ui.show_identities()
+        """identities [limit=N] [offset=N] [since=COOKIE] [nick] : Show identities"""
+        try:
+            filters = self._parse_filters(args, {'limit' : 'limit', 'offset' : 'offset', 'since' : 'since'}, 'nick')
+            self._ui.show_identities(**filters)
+        except:
+            print("SYNTAX ERROR")
 
     def do_server(self, args):
         """server [op] : Perform a server operation [start|stop|restart|stat|bind]"""
@@ -126,6 +139,22 @@ class CmdLine(cmd.Cmd):
         else:
             raise Exception
 
+    def _parse_filters(self, args, options, rest):
+        """Parse name=value options (mapped to keyword names) with the remaining words as the rest keyword"""
+        filters = {}
+        words = []
+        for word in args.split():
+            name, sep, value = word.partition('=')
+            if sep and name in options:
+                filters[options[name]] = value
+            else:
+                words.append(word)
+
+        if words:
+            filters[rest] = ' '.join(words)
+
+        return filters
+
 OP_START, OP_STOP, OP_RESTART, OP_STATUS = range(4)
 
 class UI:
@@ -164,8 +193,13 @@ class UI:
             m = dandelion.message.create(msg, timestamp=int(time.time()))
             self._db.add_messages([m])
 
-    def show_messages(self):
-        _, msgs = self._db.get_messages()
+    def show_messages(self, limit=None, offset=None, since=None, sender=None, receiver=None, text=None):
+        msgs = self._db.find_messages(limit=None if limit is None else int(limit),
+                                      offset=None if offset is None else int(offset),
+                                      time_cookie=None if since is None else decode_b64_bytes(since.encode()),
+                                      sender=None if sender is None else decode_b64_bytes(sender.encode()),
+                                      receiver=None if receiver is None else decode_b64_bytes(receiver.encode()),
+                                      text=text)
         print(' --- MESSAGES BEGIN --- ')
 
         for m in msgs:
@@ -176,8 +210,21 @@ class UI:
 
         print(' --- MESSAGES END --- ')
 
-    def show_identities(self):
-        _, identities = self._db.get_identities()
+    def show_inbox(self):
+        print(' --- INBOX BEGIN --- ')
+
+        for m, plaintext in self._db.get_inbox():
+            print(' : '.join([encode_b64_bytes(m.id).decode(),
+                              plaintext,
+                              'N/A' if not m.has_sender else encode_b64_bytes(m.sender).decode()]))
+
+        print(' --- INBOX END --- ')
+
+    def show_identities(self, limit=None, offset=None, since=None, nick=None):
+        identities = self._db.find_identities(limit=None if limit is None else int(limit),
+                                              offset=None if offset is None else int(offset),
+                                              time_cookie=None if since is None else decode_b64_bytes(since.encode()),
+                                              nick=nick)
         print(' --- IDENTITIES BEGIN --- ')
 
         for id in identities:
@@ -17,50 +17,127 @@ You should have received a copy of the GNU General Public License
 along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import base64
+from collections import OrderedDict
 import binascii
+import threading
 
 def encode_b64_bytes(bstr):
     """bytes to Base64 encoding"""
-    if not isinstance(bstr, bytes) and not isinstance(bstr, bytearray):
+    if not isinstance(bstr, (bytes, bytearray)):
         raise TypeError
 
-    return base64.b64encode(bstr)
+    return binascii.b2a_base64(bstr, newline=False)
 
 def decode_b64_bytes(bstr):
     """Base64 to bytes decoding"""
-    if not isinstance(bstr, bytes) and not isinstance(bstr, bytearray):
+    if not isinstance(bstr, (bytes, bytearray)):
         raise TypeError
 
-    return base64.b64decode(bstr)
+    return binascii.a2b_base64(bstr)
 
 def encode_b64_int(x):
     """int to Base64 encoding"""
-    return encode_b64_bytes(encode_int(x))
+    return binascii.b2a_base64(encode_int(x), newline=False)
 
 def decode_b64_int(bstr):
     """Base64 str to int decoding"""
     return decode_int(decode_b64_bytes(bstr))
 
 def encode_int(x):
-    """int to bytes conversion"""
+    """int to bytes conversion (big endian, shortest form, at least one byte)"""
     if not isinstance(x, int):
         raise TypeError
 
     if x < 0:
         raise ValueError
 
-    hstr = '{0:X}'.format(x)
-
-    if len(hstr) % 2 != 0:
-        hstr = ''.join(['0', hstr])
-
-    return binascii.a2b_hex(hstr.encode())
+    return x.to_bytes((x.bit_length() + 7) // 8 or 1, 'big')
 
 def decode_int(bstr):
     """bytes to int conversion"""
-    if not isinstance(bstr, bytes) and not isinstance(bstr, bytearray):
+    if not isinstance(bstr, (bytes, bytearray)):
         raise TypeError
 
-    return int(binascii.b2a_hex(bstr), 16)
+    if len(bstr) == 0:
+        raise ValueError
 
+    return int.from_bytes(bstr, 'big')
+
+def encode_b64_bytes_list(bstrs):
+    """Batch version of encode_b64_bytes"""
+    return [encode_b64_bytes(b) for b in bstrs]
+
+def decode_b64_bytes_list(bstrs):
+    """Batch version of decode_b64_bytes"""
+    return [decode_b64_bytes(b) for b in bstrs]
+
+def encode_b64_int_list(xs):
+    """Batch version of encode_b64_int"""
+    return [encode_b64_int(x) for x in xs]
+
+def decode_b64_int_list(bstrs):
+    """Batch version of decode_b64_int"""
+    return [decode_b64_int(b) for b in bstrs]
+
+def encode_int_list(xs):
+    """Batch version of encode_int"""
+    return [encode_int(x) for x in xs]
+
+def decode_int_list(bstrs):
+    """Batch version of decode_int"""
+    return [decode_int(b) for b in bstrs]
+
+class LRUCache:
+    """A bounded, thread safe, least recently used cache."""
+
+    def __init__(self, maxsize=1024):
+
+        if not isinstance(maxsize, int):
+            raise TypeError
+
+        if maxsize <= 0:
+            raise ValueError
+
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        """The maximum number of items in the cache"""
+        return self._maxsize
+
+    def get(self, key, default=None):
+        """Get the item for the key (and mark it as recently used) or default if it isn't cached."""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        """Cache an item. Evicts the least recently used item if the cache is full."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove and return an item or default if it isn't cached."""
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        """Remove all items."""
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,187 @@
+"""
+Copyright (c) 2011 Anders Sundman <anders@4zm.org>
+
+This file is part of Dandelion Messaging System.
+
+Dandelion is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Dandelion is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Dandelion.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dandelion.util import LRUCache
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+
+def _verify_batch(batch):
+    """Verify a batch of (identity, data, signature) tuples. Return a list of bools.
+    
+    Module level function so that it can be run in a worker process.
+    """
+    return [identity.verify(data, signature) for identity, data, signature in batch]
+
+class MessageVerifier:
+    """Verifies the signatures of received messages before they are stored.
+    
+    Results are cached by message id so that messages that are received again 
+    (from other nodes) aren't verified again. Large message lists are verified 
+    in batches by a pool of worker processes.
+    """
+
+    _CACHE_SIZE = 65536
+    _BATCH_SIZE = 64
+
+    _shared_verifiers = weakref.WeakKeyDictionary()
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, db):
+        """Get the verifier shared by all transactions for the data base.
+        
+        The verifier only has a weak reference to the data base, so that 
+        it is shut down when a data base that wasn't closed is collected.
+        """
+
+        with cls._shared_lock:
+            verifier = cls._shared_verifiers.get(db)
+            if verifier is None:
+                verifier = cls(weakref.proxy(db))
+                weakref.finalize(db, verifier.close)
+                cls._shared_verifiers[db] = verifier
+            return verifier
+
+    @classmethod
+    def release_shared(cls, db):
+        """Shut down and forget the verifier shared for the data base (if any)"""
+
+        with cls._shared_lock:
+            verifier = cls._shared_verifiers.pop(db, None)
+
+        if verifier is not None:
+            verifier.close()
+
+    def __init__(self, db, workers=None, batch_size=_BATCH_SIZE, cache_size=_CACHE_SIZE):
+        """Create a verifier that looks up the sender identities in the data base.
+        
+        The workers is the number of worker processes (defaults to the number of 
+        cores). Message lists shorter than two batches are verified in the 
+        calling thread.
+        """
+
+        if workers is not None and not isinstance(workers, int):
+            raise TypeError
+
+        if not isinstance(batch_size, int):
+            raise TypeError
+
+        if (workers is not None and workers <= 0) or batch_size <= 0:
+            raise ValueError
+
+        self._db = db
+        self._workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._batch_size = batch_size
+        self._cache = LRUCache(cache_size)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats = {'verified' : 0, 'rejected' : 0, 'cache_hits' : 0, 'unknown_sender' : 0, 'seconds' : 0.0}
+
+    @property
+    def workers(self):
+        """The number of worker processes used for large message lists"""
+        return self._workers
+
+    @property
+    def stats(self):
+        """A copy of the verification counters.
+        
+        verified/rejected count signature checks, cache_hits and unknown_sender 
+        count messages that were not checked and seconds is the time spent checking.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def verify(self, msgs):
+        """Return the messages from the list that have a valid signature.
+        
+        Unsigned messages are always valid. Signed messages from a sender whose 
+        identity isn't in the data base (yet) can't be checked and are dropped 
+        (without caching the result), so the identities should be added first.
+        """
+
+        msgs = list(msgs)
+        signed = [m for m in msgs if m.has_sender]
+        valid = {}
+
+        """Use cached results where we have them"""
+        unchecked = []
+        for m in signed:
+            result = self._cache.get(m.id)
+            if result is None:
+                unchecked.append(m)
+            else:
+                valid[m.id] = result
+
+        _, identities = self._db.get_identities(fingerprints={m.sender for m in unchecked})
+        identities = {identity.fingerprint : identity for identity in identities}
+
+        checkable = [m for m in unchecked if m.sender in identities]
+        jobs = [(identities[m.sender], m.text if m.has_receiver else m.text.encode(), m.signature) for m in checkable]
+
+        t1 = time.time()
+        results = self._run(jobs)
+        t2 = time.time()
+
+        for m, result in zip(checkable, results):
+            valid[m.id] = result
+            self._cache.put(m.id, result)
+
+        with self._lock:
+            self._stats['verified'] += len(results)
+            self._stats['rejected'] += results.count(False)
+            self._stats['cache_hits'] += len(signed) - len(unchecked)
+            self._stats['unknown_sender'] += len(unchecked) - len(checkable)
+            self._stats['seconds'] += t2 - t1
+
+        return [m for m in msgs if not m.has_sender or valid.get(m.id, False)]
+
+    def close(self):
+        """Shut down the worker processes (if any were started)"""
+
+        with self._lock:
+            pool, self._pool = self._pool, None
+
+        if pool is not None:
+            pool.shutdown()
+
+    def _run(self, jobs):
+        """Verify the jobs, in worker processes if there are enough of them"""
+
+        if len(jobs) < 2 * self._batch_size or self._workers == 1:
+            return _verify_batch(jobs)
+
+        batches = [jobs[i:i + self._batch_size] for i in range(0, len(jobs), self._batch_size)]
+        results = []
+        for batch_result in self._get_pool().map(_verify_batch, batches):
+            results.extend(batch_result)
+        return results
+
+    def _get_pool(self):
+        """Lazily start the worker processes"""
+
+        with self._lock:
+            if self._pool is None:
+                # Don't fork, the node is multi threaded 
+                self._pool = ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool